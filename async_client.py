@@ -0,0 +1,288 @@
+"""
+An asynchronous client for driving many long-running workflows from a single process.
+
+A controller firmware upgrade spends tens of minutes waiting, and only a fraction of a second actually talking to the
+API. Run from a thread, the thread is tied up for the whole time. Here a workflow is instead written as a coroutine:
+a generator that yields a Future whenever it has to wait, and is resumed with the result once it is available.
+
+    def wait_for_state(client, url):
+        response = yield client.get(url)
+        response.raise_for_status()
+        yield client.sleep(10)
+        state = yield client.poll('state', probe, is_done)
+        raise Return(state)
+
+The samples target Python 2.7, which has no asyncio, so coroutines use plain generators (and raise Return(value)
+rather than 'return value'). Another coroutine can be yielded directly to wait for its result, or a list of Futures
+and coroutines to wait for all of them.
+
+Coroutine steps run on a PollScheduler that serves as the event loop. Sleeps and polls don't hold a thread while they
+wait, and the blocking HTTP requests themselves run on a bounded pool of I/O threads. AsyncClient.run() drives any
+number of workflows, with at most a given number of them active at once.
+"""
+import functools
+import logging
+import threading
+import types
+from multiprocessing.pool import ThreadPool
+
+from client import new_session
+from poller import PollScheduler, SchedulerShutdown
+
+LOG = logging.getLogger(__name__)
+
+
+class Return(Exception):
+    """Raised by a coroutine to finish with a value"""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+class Future(object):
+    """The eventual result of an asynchronous operation"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._complete()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._complete()
+
+    def _complete(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once the future is done"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        self._event.wait(timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        """Wait for the result, raising the exception of the operation if it failed"""
+        if not self._event.wait(timeout):
+            raise RuntimeError('The operation has not finished.')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def from_operation(operation):
+    """Get a Future for a poller Operation"""
+    future = Future()
+
+    def finished(operation):
+        if operation.error is not None:
+            future.set_exception(operation.error)
+        else:
+            future.set_result(operation.value)
+
+    operation.add_done_callback(finished)
+    return future
+
+
+class Task(Future):
+    """Drives a coroutine to completion"""
+
+    def __init__(self, client, coroutine):
+        super(Task, self).__init__()
+        self.client = client
+        self._coroutine = coroutine
+        client.call_soon(self._step, None, None)
+
+    def _step(self, value, error):
+        try:
+            if error is not None:
+                yielded = self._coroutine.throw(error)
+            else:
+                yielded = self._coroutine.send(value)
+        except Return as e:
+            self.set_result(e.value)
+            return
+        except StopIteration as e:
+            self.set_result(getattr(e, 'value', None))
+            return
+        except Exception as e:
+            self.set_exception(e)
+            return
+
+        try:
+            future = self.client.wrap(yielded)
+        except TypeError as e:
+            self.client.call_soon(self._step, None, e)
+            return
+        future.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        if future._exception is not None:
+            self.client.call_soon(self._step, None, future._exception)
+        else:
+            self.client.call_soon(self._step, future._result, None)
+
+
+class AsyncClient(object):
+    """Issues requests and runs coroutines for many concurrent workflows"""
+
+    def __init__(self, session=None, max_in_flight=32, scheduler=None):
+        """
+        :param session: the session used for requests, a new pooled session is used by default
+        :param max_in_flight: the maximum number of HTTP requests in flight at once
+        :param scheduler: the PollScheduler used as the event loop, one is created by default
+        """
+        self.session = session or new_session()
+        self.scheduler = scheduler or PollScheduler(workers=max_in_flight)
+        self._io = ThreadPool(max_in_flight)
+
+    def call_soon(self, callback, *args):
+        try:
+            self.scheduler.call_later(0, functools.partial(callback, *args))
+        except SchedulerShutdown:
+            # Run it here, so that a task woken by the shutdown still finishes (with its error)
+            callback(*args)
+
+    def wrap(self, yielded):
+        """Get a Future for anything a coroutine may yield: a Future, a coroutine or a list of those"""
+        if isinstance(yielded, Future):
+            return yielded
+        if isinstance(yielded, types.GeneratorType):
+            return self.spawn(yielded)
+        if isinstance(yielded, (list, tuple)):
+            return self.gather(yielded)
+        raise TypeError('A coroutine yielded {!r}, expected a Future, coroutine or list.'.format(yielded))
+
+    def spawn(self, coroutine):
+        """Start running a coroutine
+        :return: the Task running it
+        """
+        return Task(self, coroutine)
+
+    def gather(self, items):
+        """Wait for several Futures or coroutines
+        :return: a Future of the list of their results, failing with the first exception
+        """
+        futures = [self.wrap(item) for item in items]
+        gathered = Future()
+        if not futures:
+            gathered.set_result([])
+            return gathered
+
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def finished(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [future._exception for future in futures if future._exception is not None]
+            if errors:
+                gathered.set_exception(errors[0])
+            else:
+                gathered.set_result([future._result for future in futures])
+
+        for future in futures:
+            future.add_done_callback(finished)
+        return gathered
+
+    def request(self, method, url, session=None, **kwargs):
+        """Make an HTTP request on the I/O pool
+        :param session: the session to make the request with, the client's session by default
+        :return: a Future of the requests Response
+        """
+        future = Future()
+
+        def perform():
+            try:
+                response = (session or self.session).request(method, url, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(response)
+
+        self._io.apply_async(perform)
+        return future
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def sleep(self, seconds):
+        """A Future that completes after a number of seconds, without holding a thread"""
+        future = Future()
+        self.scheduler.call_later(seconds, lambda: future.set_result(None), on_shutdown=future.set_exception)
+        return future
+
+    def poll(self, name, probe, is_done, **kwargs):
+        """Poll an operation on the scheduler, see PollScheduler.submit()
+        :return: a Future of the terminal state
+        """
+        return from_operation(self.scheduler.submit(name, probe, is_done, **kwargs))
+
+    def run(self, coroutines, concurrency=100):
+        """Run coroutines to completion, with at most concurrency of them active at once
+        :param coroutines: an iterable of coroutines (generators are only started when a slot is free)
+        :param concurrency: the maximum number of active coroutines
+        :return: the Task of every coroutine, in order
+        """
+        pending = iter(enumerate(coroutines))
+        tasks = {}
+        lock = threading.Lock()
+        all_done = threading.Event()
+        active = [0]
+
+        def start_next():
+            with lock:
+                try:
+                    index, coroutine = next(pending)
+                except StopIteration:
+                    if not active[0]:
+                        all_done.set()
+                    return
+                active[0] += 1
+                task = tasks[index] = self.spawn(coroutine)
+            task.add_done_callback(finished)
+
+        def finished(_):
+            with lock:
+                active[0] -= 1
+            start_next()
+
+        for _ in range(concurrency):
+            start_next()
+        # Wait in short intervals so that the wait can be interrupted on Python 2
+        while not all_done.wait(1):
+            pass
+        return [tasks[index] for index in sorted(tasks)]
+
+    def run_until_complete(self, coroutine):
+        """Run a single coroutine and return its result"""
+        return self.run([coroutine], concurrency=1)[0].result()
+
+    def close(self):
+        self._io.close()
+        self._io.join()
+        self.scheduler.shutdown()
@@ -0,0 +1,176 @@
+"""
+Asynchronous versions of the sample workflows, for use with AsyncClient.
+
+Each workflow is a coroutine (see async_client) that makes the same requests as its blocking counterpart, so a single
+process can run thousands of them at once:
+
+    client = AsyncClient(new_session(auth=('admin', 'admin'), verify=False), max_in_flight=64)
+    tasks = client.run((controller_firmware_upgrade_async(client, addresses, firmware_file)
+                        for addresses in fleet), concurrency=500)
+
+The URLs come from the same API tables as the blocking samples.
+"""
+import logging
+import os
+
+import requests
+
+from async_client import Return
+from client import probe_session, upload_timeout
+from drive_firmware_upgrade.drive_firmware_upgrade import API as DRIVE_API, DRIVE_STATE_BACKOFF, \
+    compatibility_index, optimal_drives, resolve_compatible_drives
+from firmware_upgrade.controller_firmware_upgrade import API as CONTROLLER_API, AVAILABILITY_BACKOFF, \
+    AVAILABILITY_TIMEOUT, HEALTH_CHECK_BACKOFF, PROBE_CONNECT_TIMEOUT, PROBE_READ_TIMEOUT, ControllerProbe
+from streaming_upload import MultipartFileStream
+
+LOG = logging.getLogger(__name__)
+
+JSON_HEADERS = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+
+
+def _json(response):
+    response.raise_for_status()
+    return response.json()
+
+
+def upload_file_async(client, url, field, path):
+    """Stream a file to the API as a multipart/form-data body"""
+    body = MultipartFileStream(field, path)
+    try:
+        response = yield client.post(url, data=body, headers={'Content-Type': body.content_type},
+                                     timeout=upload_timeout())
+    finally:
+        body.close()
+    response.raise_for_status()
+    raise Return(response)
+
+
+def health_check_async(client, health_url, device_ids=('1',)):
+    """Run a health check on one or more storage-systems
+    :return: True if every storage-system passed
+    """
+    response = yield client.post(health_url, json={'storageDeviceIds': list(device_ids)}, headers=JSON_HEADERS)
+    response.raise_for_status()
+
+    poll_session = probe_session(client.session)
+    result = yield client.poll('health check', lambda: _json(poll_session.get(health_url, headers=JSON_HEADERS)),
+                               lambda state: not state['healthCheckRunning'], backoff=HEALTH_CHECK_BACKOFF,
+                               initial_delay=1)
+    passed = all(entry['successful'] for entry in result['results'])
+    if not passed:
+        LOG.error("The healthCheck has failed: %s", result)
+    raise Return(passed)
+
+
+def controller_firmware_upgrade_async(client, controller_addresses, firmware_file, ignore_health_check=False):
+    """Upgrade the controller firmware of a storage-system
+    :param client: the AsyncClient
+    :param controller_addresses: the addresses of the controllers, the first is used to drive the upgrade
+    :param firmware_file: path to the controller firmware file
+    :param ignore_health_check: proceed even if the health check fails
+    :return: the result of waiting for each controller, see wait_for_availability(), or None if the health check
+     failed
+    """
+    apis = [dict((key, address + CONTROLLER_API[key]) for key in CONTROLLER_API) for address in controller_addresses]
+    system_urls = [api['system'] for api in apis]
+
+    healthy = yield health_check_async(client, apis[0]['health_check'])
+    if not healthy and not ignore_health_check:
+        raise Return(None)
+
+    previous = yield [client.get(url, session=probe_session(client.session), headers=JSON_HEADERS,
+                                 timeout=(PROBE_CONNECT_TIMEOUT, PROBE_READ_TIMEOUT))
+                      for url in system_urls]
+    probes = [ControllerProbe(client.session, url, _json(response).get('fwVersion'))
+              for url, response in zip(system_urls, previous)]
+
+    LOG.info('Uploading file %s', firmware_file)
+    yield upload_file_async(client, apis[0]['embedded_firmware'], 'dlpfile', firmware_file)
+
+    versions = yield [client.poll('availability of {}'.format(probe.system_url), probe, probe.is_done,
+                                  backoff=AVAILABILITY_BACKOFF, deadline=AVAILABILITY_TIMEOUT,
+                                  retry_on=(requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+                      for probe in probes]
+    raise Return(dict((probe.system_url, {'fwVersion': version, 'downtime': probe.downtime})
+                      for probe, version in zip(probes, versions)))
+
+
+def drive_firmware_upgrade_async(client, address, filename, system_id='1'):
+    """Upgrade the firmware of every compatible, optimal drive of a storage-system
+    :param client: the AsyncClient
+    :param address: the address of the Web Services instance
+    :param filename: path to the drive firmware file
+    :param system_id: the id of the storage-system
+    :return: the final drive upgrade state, or None if no drive was compatible
+    """
+    api = dict((key, address + DRIVE_API[key]) for key in DRIVE_API)
+    yield upload_file_async(client, api['drive_file_upload'], 'file', filename)
+
+    drives, compatibilities = yield [client.get(api['drives'].format(systemId=system_id)),
+                                     client.get(api['compatibilities'].format(systemId=system_id))]
+    drives = _json(drives)
+    drive_refs = optimal_drives(None, api, drives, system_id=system_id) if drives else []
+    index = compatibility_index(_json(compatibilities)['compatibilities'])
+    compatible = resolve_compatible_drives(index, drive_refs, [filename])[filename]
+    if not compatible:
+        LOG.debug("Chosen firmware was not compatible with any drives in this array.")
+        raise Return(None)
+
+    response = yield client.post(api['firmware_drives_initiate_upgrade'].format(systemId=system_id),
+                                 json={'filename': os.path.basename(filename), 'driveRefList': compatible})
+    response.raise_for_status()
+
+    state_url = api['firmware_drives_state'].format(systemId=system_id)
+    poll_session = probe_session(client.session)
+    state = yield client.poll('drive firmware download on {}'.format(state_url),
+                              lambda: _json(poll_session.get(state_url)),
+                              lambda state: state['overallStatus'] != 'downloadInProgress',
+                              backoff=DRIVE_STATE_BACKOFF)
+    raise Return(state)
+
+
+def create_volume_async(client, server, sys_id, vol_name, pool_name=None, size='1'):
+    """Define a new volume, see provisioning.volume.create_volume()
+    :return: the new volume, or None if the API rejected the definition
+    """
+    pools = yield client.get('http://{server}/devmgr/v2/storage-systems/{id}/storage-pools'.format(server=server,
+                                                                                                 id=sys_id),
+                             headers=JSON_HEADERS)
+    pools = _json(pools)
+    if pool_name is not None:
+        pools = [pool for pool in pools if pool['name'] == pool_name]
+    if not pools:
+        raise NameError('No such pool!')
+
+    result = yield client.post('http://{server}/devmgr/v2/storage-systems/{id}/volumes'.format(server=server,
+                                                                                             id=sys_id),
+                               json={'name': vol_name, 'size': size, 'poolId': pools[0]['id']}, headers=JSON_HEADERS)
+    if result.status_code == 422:
+        LOG.warn("Volume creation failed: %s", result.json().get('errorMessage'))
+        raise Return(None)
+    raise Return(_json(result))
+
+
+def trigger_auto_support_bundle_async(client, server, operation_type, dispatch_type):
+    """Trigger an AutoSupport bundle, see auto_support.trigger_auto_support_bundle
+    :return: the AutoSupport job data
+    """
+    result = yield client.post('http://{server}/devmgr/v2/auto-support'.format(server=server),
+                               json={'operationType': operation_type, 'dispatchType': dispatch_type},
+                               headers=JSON_HEADERS)
+    job = _json(result)
+    result = yield client.get('http://{server}/devmgr/v2/auto-support/jobs/{id}'.format(server=server,
+                                                                                      id=job['jobId']),
+                              headers=JSON_HEADERS)
+    raise Return(_json(result))
+
+
+def update_auto_support_configuration_async(client, server, configuration):
+    """Update the AutoSupport configuration, see auto_support.update_auto_support_configuration
+    :return: the resulting configuration
+    """
+    url = 'http://{server}/devmgr/v2/auto-support/configuration'.format(server=server)
+    result = yield client.post(url, json=configuration, headers=JSON_HEADERS)
+    result.raise_for_status()
+    result = yield client.get(url, headers=JSON_HEADERS)
+    raise Return(_json(result))
@@ -27,15 +27,15 @@ Description:
 import logging
 
 import docopt
-import requests
+
+from client import new_session
 
 LOG = logging.getLogger(__name__)
 
 
 def login(server, username, password):
     # Define a re-usable Session object and set some standard headers
-    con = requests.Session()
-    con.headers.update({'Accept': 'application/json', 'Content-Type': 'application/json'})
+    con = new_session(headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
 
     # Here we do a login that will define a persistent session on the server-side upon successful authentication
     result = con.post(server + "/devmgr/utils/login", json={'userId': username, 'password': password})
@@ -51,26 +51,27 @@ def login(server, username, password):
     result = con.get(server + "/devmgr/v2/storage-systems")
     assert result.cookies.get('JSESSIONID') == con.cookies.get('JSESSIONID')
 
-    # Now let's avoid using a persistent session with the login
-    result1 = requests.post(server + "/devmgr/utils/login", json={'userId': username, 'password': password})
+    # Now let's avoid using a persistent session with the login. A new session starts without any cookies (it still
+    #  re-uses the pooled connections, but the server tracks sessions by cookie, not by connection).
+    result1 = new_session().post(server + "/devmgr/utils/login", json={'userId': username, 'password': password})
     # Okay, now we have a different JSESSIONID, that's okay, that's what we expected.
     assert result1.cookies.get('JSESSIONID') != con.cookies.get('JSESSIONID')
 
-    result2 = requests.get(server + "/devmgr/v2/storage-systems", auth=(username, password))
+    result2 = new_session().get(server + "/devmgr/v2/storage-systems")
     # Uh oh, we got an authentication error!?! That's because the JESSIONID wasn't set on a persistent session,
     #  and we didn't use Basic-Auth to authenticate directly!
     LOG.warn("Request without a session or auth: %s", result2.status_code)
 
     # This time we'll provide credentials using Basic-Authentication
-    result2 = requests.get(server + "/devmgr/v2/storage-systems", auth=(username, password))
+    result2 = new_session().get(server + "/devmgr/v2/storage-systems", auth=(username, password))
     # It works, but we got a new session.
     assert result1.cookies.get('JSESSIONID') != result2.cookies.get('JSESSIONID')
 
     # We can do something similar to what requests does for us by manually persisting the cookie. This may be necessary
     #  for less full-featured clients.
-    result1 = requests.post(server + "/devmgr/utils/login", json={'userId': username, 'password': password})
+    result1 = new_session().post(server + "/devmgr/utils/login", json={'userId': username, 'password': password})
 
-    result2 = requests.get(server + "/devmgr/v2/storage-systems", cookies=result1.cookies)
+    result2 = new_session().get(server + "/devmgr/v2/storage-systems", cookies=result1.cookies)
     # See, they match, and we don't have to provide authentication for this request!
     assert result1.cookies.get('JSESSIONID') == result2.cookies.get('JSESSIONID')
 
@@ -0,0 +1,186 @@
+"""
+Re-using a login session (JSESSIONID) instead of sending Basic-Authentication with every request.
+
+With Basic-Authentication the server validates the credentials, and creates a new server-side session, for every
+request (see login.py). A SessionManager logs in once per server through /devmgr/utils/login and hands the JSESSIONID
+it receives to every request made to that server, from any session or thread. The token can optionally be persisted
+to disk so that it survives across process runs.
+
+    session = new_session(auth=session_auth('admin', 'admin'))
+
+When the server rejects a token (because it expired or the server restarted), JSessionAuth logs in again and re-sends
+the request once. Concurrent callers that hit the same expired token share a single re-login.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from requests.auth import AuthBase
+from requests.compat import urlparse
+
+from client import new_session
+
+LOG = logging.getLogger(__name__)
+
+LOGIN_PATH = '/devmgr/utils/login'
+COOKIE_NAME = 'JSESSIONID'
+
+_managers_lock = threading.Lock()
+_managers = {}
+
+
+def server_of(url):
+    """Get the scheme://host:port a url refers to"""
+    parsed = urlparse(url)
+    return '{}://{}'.format(parsed.scheme, parsed.netloc)
+
+
+class SessionManager(object):
+    """Logs in once per server and caches the JSESSIONID for every caller"""
+
+    def __init__(self, username, password, verify=True, token_file=None, max_idle=None):
+        """
+        :param username: the userId to log in with
+        :param password: the password to log in with
+        :param verify: whether to verify TLS certificates when logging in
+        :param token_file: an optional file to persist the tokens in across process runs
+        :param max_idle: log in again, rather than risk a rejected request, once a token has been unused this long
+        """
+        self.username = username
+        self.password = password
+        self.verify = verify
+        self.token_file = token_file
+        self.max_idle = max_idle
+        self.logins = 0
+        self._lock = threading.Lock()
+        self._server_locks = {}
+        self._tokens = {}
+        if token_file and os.path.exists(token_file):
+            with open(token_file) as fp:
+                self._tokens = json.load(fp)
+
+    def _server_lock(self, server):
+        with self._lock:
+            return self._server_locks.setdefault(server, threading.Lock())
+
+    def token(self, server):
+        """Get the JSESSIONID for a server, logging in if we don't have a usable one
+        :param server: the scheme://host:port of the server
+        """
+        with self._lock:
+            entry = self._tokens.get(server)
+            if entry is not None and (self.max_idle is None or time.time() - entry['last_used'] < self.max_idle):
+                entry['last_used'] = time.time()
+                return entry['token']
+            stale = entry['token'] if entry is not None else None
+        return self.login(server, stale)
+
+    def login(self, server, stale=None):
+        """Log in to a server
+        :param server: the scheme://host:port of the server
+        :param stale: the token that was found to be invalid, if another caller has already replaced it we use theirs
+        :return: the new JSESSIONID
+        :raise HTTPError if the login was rejected
+        """
+        with self._server_lock(server):
+            with self._lock:
+                entry = self._tokens.get(server)
+                if entry is not None and entry['token'] != stale:
+                    return entry['token']
+
+            LOG.debug("Logging in to %s as %s.", server, self.username)
+            result = new_session(verify=self.verify).post(server + LOGIN_PATH,
+                                                          json={'userId': self.username, 'password': self.password})
+            result.raise_for_status()
+            token = result.cookies.get(COOKIE_NAME)
+
+            with self._lock:
+                self.logins += 1
+                self._tokens[server] = {'token': token, 'last_used': time.time()}
+                self._save()
+            return token
+
+    def invalidate(self, server):
+        """Forget the token of a server"""
+        with self._lock:
+            self._tokens.pop(server, None)
+            self._save()
+
+    def _save(self):
+        if not self.token_file:
+            return
+        # The tokens are credentials, so don't let anyone else read them
+        fd = os.open(self.token_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self._tokens, fp)
+        os.rename(self.token_file + '.tmp', self.token_file)
+
+
+def set_cookie(request, token):
+    """Set the JSESSIONID of a prepared request, keeping any other cookies it carries"""
+    cookies = [cookie for cookie in request.headers.get('Cookie', '').split('; ')
+               if cookie and not cookie.startswith(COOKIE_NAME + '=')]
+    cookies.append('{}={}'.format(COOKIE_NAME, token))
+    request.headers['Cookie'] = '; '.join(cookies)
+
+
+class JSessionAuth(AuthBase):
+    """Authenticates requests with the JSESSIONID of a SessionManager"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def __call__(self, request):
+        token = self.manager.token(server_of(request.url))
+        set_cookie(request, token)
+        request.headers.pop('Authorization', None)
+        # Remember where the body started so it can be sent again after a re-login
+        position = None
+        if hasattr(request.body, 'tell'):
+            try:
+                position = request.body.tell()
+            except (IOError, OSError):
+                pass
+        request.register_hook('response', self._retry_after_login(token, position))
+        return request
+
+    def _retry_after_login(self, token, position):
+        def handle_401(response, **kwargs):
+            if response.status_code != 401 or getattr(response.request, '_jsession_retried', False):
+                return response
+
+            server = server_of(response.request.url)
+            LOG.debug("The session for %s was rejected, logging in again.", server)
+            new_token = self.manager.login(server, stale=token)
+
+            # Consume the content so the connection can be released back to the pool
+            response.content
+            response.close()
+            request = response.request.copy()
+            set_cookie(request, new_token)
+            request._jsession_retried = True
+            if position is not None:
+                request.body.seek(position)
+
+            retry = response.connection.send(request, **kwargs)
+            retry.history.append(response)
+            retry.request = request
+            return retry
+
+        return handle_401
+
+
+def get_session_manager(username, password, verify=True, token_file=None):
+    """Get the SessionManager shared by every caller using the same credentials"""
+    key = (username, password, verify, token_file)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = SessionManager(username, password, verify=verify, token_file=token_file)
+        return _managers[key]
+
+
+def session_auth(username, password, verify=True, token_file=None):
+    """Get an auth object that logs in once and re-uses the JSESSIONID, for use with new_session(auth=...)"""
+    return JSessionAuth(get_session_manager(username, password, verify=verify, token_file=token_file))
@@ -3,25 +3,49 @@ Triggering a Webservices AutoSupport bundle example.
 
 Usage:
     trigger_auto_support_bundle <operation_type> <dispatch_type>
+    trigger_auto_support_bundle batch <operation_type> <dispatch_type> <server>... [--download=<dir>] [--workers=<n>]
     trigger_auto_support_bundle -h
 Arguments:
     operation_type the AutoSupport operation type
     dispatch_type the AutoSupport dispatch type
+    server the host:port of a Web Services instance to collect a bundle from
 Options:
     -h --help Show this screen.
     --version Show version.
+    --download=<dir>  Download the finished bundles into this directory
+    --workers=<n>  The maximum number of requests in flight at once [default: 8]
+
+Batch mode:
+    Triggers a bundle on every server at once, then follows every job to completion from a single poller. Each bundle
+    is downloaded in chunks as soon as its job has finished, and the time taken by every job is reported along with
+    the overall throughput.
 """
 
 import docopt
 import json
 import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from pprint import pprint
+
 import requests
 
 from base import Properties, get_session
+from client import probe_session
+from poller import Backoff, PollScheduler
 
 PROPS = Properties()
 LOG = logging.getLogger(__name__)
 
+# Collecting a bundle takes from seconds to several minutes
+JOB_BACKOFF = Backoff(initial=2, factor=1.5, maximum=15)
+JOB_TIMEOUT = 1800
+# The states of a job that is still collecting its bundle
+JOB_RUNNING = ('queued', 'pending', 'inProgress', 'running')
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 def trigger_auto_support_bundle(operation_type, dispatch_type):
     # Get a connection
     connection = get_session()
@@ -63,8 +87,157 @@ def trigger_auto_support_bundle(operation_type, dispatch_type):
         LOG.error("Server connection failure")
         raise
 
+def trigger_job(connection, server, operation_type, dispatch_type):
+    """Start collecting an AutoSupport bundle
+    :param connection: the session to use
+    :param server: the host:port of the Web Services instance
+    :return: the job data, including its jobId
+    """
+    result = connection.post('http://{server}/devmgr/v2/auto-support'.format(server=server),
+                             data=json.dumps({'operationType': operation_type, 'dispatchType': dispatch_type}))
+    result.raise_for_status()
+    return result.json()
+
+
+def get_job(connection, server, job_id):
+    """Get the current state of an AutoSupport job"""
+    result = connection.get('http://{server}/devmgr/v2/auto-support/jobs/{id}'.format(server=server, id=job_id))
+    result.raise_for_status()
+    return result.json()
+
+
+def download_bundle(connection, server, job, directory, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Stream the bundle collected by a job to a file, a chunk at a time
+    :param connection: the session to use
+    :param server: the host:port of the Web Services instance
+    :param job: the data of the finished job
+    :param directory: where to write the bundle
+    :param chunk_size: the number of bytes read and written at a time
+    :return: the path of the bundle and its size in bytes
+    """
+    name = job.get('fileName') or '{}-{}.7z'.format(server.replace(':', '_'), job['jobId'])
+    path = os.path.join(directory, os.path.basename(name))
+    result = connection.get('http://{server}/devmgr/v2/auto-support/jobs/{id}/file'.format(server=server,
+                                                                                          id=job['jobId']),
+                            stream=True)
+    try:
+        result.raise_for_status()
+        size = 0
+        # Write to a temporary name, so that a partial download is never mistaken for a bundle
+        with open(path + '.part', 'wb') as fp:
+            for chunk in result.iter_content(chunk_size):
+                fp.write(chunk)
+                size += len(chunk)
+    finally:
+        result.close()
+    os.rename(path + '.part', path)
+    return path, size
+
+
+def trigger_auto_support_bundles(servers, operation_type, dispatch_type, directory=None, workers=8, connection=None):
+    """Collect an AutoSupport bundle from many Web Services instances at once
+    :param servers: the host:port of every Web Services instance
+    :param operation_type: the AutoSupport operation type
+    :param dispatch_type: the AutoSupport dispatch type
+    :param directory: an optional directory to download the finished bundles into
+    :param workers: the maximum number of requests in flight at once
+    :param connection: the session to use, a new one is created by default
+    :return: a tuple of the result of every server and a summary of the batch
+    """
+    connection = connection or get_session()
+    # The jobs are polled on their own schedule, so each probe is a single request
+    poll_connection = probe_session(connection)
+    if directory is not None and not os.path.isdir(directory):
+        os.makedirs(directory)
+    results = dict((server, {'server': server, 'jobId': None, 'status': 'failed', 'error': None, 'path': None,
+                             'bytes': 0, 'trigger_seconds': None, 'job_seconds': None, 'download_seconds': None})
+                   for server in servers)
+    finished = dict((server, threading.Event()) for server in servers)
+    scheduler = PollScheduler(workers=workers)
+    pool = ThreadPool(max(1, workers))
+
+    def download(server, job):
+        result = results[server]
+        start = time.time()
+        try:
+            result['path'], result['bytes'] = download_bundle(connection, server, job, directory)
+        except Exception as e:
+            LOG.error("Unable to download the bundle of [%s]: %s", server, e)
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        finally:
+            result['download_seconds'] = time.time() - start
+            finished[server].set()
+
+    def job_done(server, operation):
+        result = results[server]
+        result['job_seconds'] = operation.elapsed
+        if operation.error is not None:
+            result['error'] = str(operation.error)
+        else:
+            result['status'] = operation.value.get('status')
+            LOG.info("The AutoSupport job on [%s] is %s after %.1fs.", server, result['status'], operation.elapsed)
+            if directory is not None and result['status'] == 'complete':
+                pool.apply_async(download, (server, operation.value))
+                return
+        finished[server].set()
+
+    def start(server):
+        result = results[server]
+        begin = time.time()
+        try:
+            job = trigger_job(connection, server, operation_type, dispatch_type)
+        except Exception as e:
+            LOG.error("Unable to trigger an AutoSupport bundle on [%s]: %s", server, e)
+            result['error'] = str(e)
+            finished[server].set()
+            return
+        result['trigger_seconds'] = time.time() - begin
+        result['jobId'] = job['jobId']
+        operation = scheduler.submit('AutoSupport job {} on {}'.format(job['jobId'], server),
+                                     lambda: get_job(poll_connection, server, job['jobId']),
+                                     lambda state: state.get('status') not in JOB_RUNNING,
+                                     backoff=JOB_BACKOFF, deadline=JOB_TIMEOUT, initial_delay=JOB_BACKOFF.initial)
+        operation.add_done_callback(lambda operation: job_done(server, operation))
+
+    begin = time.time()
+    try:
+        pool.map(start, servers)
+        for event in finished.values():
+            event.wait()
+    finally:
+        scheduler.shutdown()
+        pool.close()
+        pool.join()
+    wall_time = time.time() - begin
+
+    statuses = {}
+    for result in results.values():
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    job_seconds = [result['job_seconds'] for result in results.values() if result['job_seconds'] is not None]
+    size = sum(result['bytes'] for result in results.values())
+    summary = {'servers': len(servers),
+               'statuses': statuses,
+               'wall_time': wall_time,
+               'job_seconds_mean': sum(job_seconds) / len(job_seconds) if job_seconds else 0.0,
+               'job_seconds_max': max(job_seconds) if job_seconds else 0.0,
+               'bundles_per_minute': 60.0 * statuses.get('complete', 0) / wall_time if wall_time else 0.0,
+               'bytes_downloaded': size,
+               'download_mib_per_second': size / 1048576.0 / wall_time if wall_time else 0.0,
+               'polling': scheduler.stats.summary()}
+    return [results[server] for server in servers], summary
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG,
         format='%(relativeCreated)dms %(levelname)s %(module)s.%(funcName)s:%(lineno)d\n %(message)s')
     args = docopt.docopt(__doc__)
-    trigger_auto_support_bundle(str(args.get('<operation_type>')), str(args.get('<dispatch_type>')))
+    if args.get('batch'):
+        results, summary = trigger_auto_support_bundles(args.get('<server>'), str(args.get('<operation_type>')),
+                                                        str(args.get('<dispatch_type>')),
+                                                        directory=args.get('--download'),
+                                                        workers=int(args.get('--workers')))
+        pprint(results)
+        pprint(summary)
+    else:
+        trigger_auto_support_bundle(str(args.get('<operation_type>')), str(args.get('<dispatch_type>')))
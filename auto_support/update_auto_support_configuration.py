@@ -3,15 +3,30 @@ Updating the Webservices AutoSupport configuration example.
 
 Usage:
     update_auto_support_configuration
+    update_auto_support_configuration apply <configuration> <server>... [--workers=<n>] [--dry-run]
     update_auto_support_configuration -h
+Arguments:
+    configuration a JSON file holding the desired AutoSupport configuration
+    server the host:port of a Web Services instance to configure
 Options:
     -h --help Show this screen.
     --version Show version.
+    --workers=<n>  The maximum number of servers configured at once [default: 8]
+    --dry-run  Only report the differences, without updating any server
+
+Apply mode:
+    Reads the current configuration of every server concurrently and compares it with the desired configuration.
+    Servers that already match are left alone; the others are sent only the settings that differ, and read back to
+    verify that the update took effect.
 """
 
 import docopt
 import json
 import logging
+import time
+from multiprocessing.pool import ThreadPool
+from pprint import pprint
+
 import requests
 
 from base import Properties, get_session
@@ -19,6 +34,9 @@ from base import Properties, get_session
 PROPS = Properties()
 LOG = logging.getLogger(__name__)
 
+# The configuration has to be current to be compared, so it is never taken from the response cache
+FRESH = {'Cache-Control': 'no-cache'}
+
 def update_auto_support_configuration():
     # Get a connection
     connection = get_session()
@@ -50,8 +68,106 @@ def update_auto_support_configuration():
         LOG.error("Server connection failured")
         raise
 
+def get_configuration(connection, server):
+    """Get the current AutoSupport configuration of a Web Services instance"""
+    result = connection.get('http://{server}/devmgr/v2/auto-support/configuration'.format(server=server),
+                            headers=FRESH)
+    result.raise_for_status()
+    return result.json()
+
+
+def configuration_changes(current, desired):
+    """Find the settings of the desired configuration that the current configuration doesn't match
+    :param current: the current configuration
+    :param desired: the desired configuration, settings it doesn't mention are left as they are
+    :return: a dict of the settings to update, empty if the configuration already matches. A nested setting (such as
+     a schedule) that differs is given in full, the desired values over the current ones.
+    """
+    changes = {}
+    for key, value in desired.items():
+        existing = current.get(key)
+        if isinstance(value, dict) and isinstance(existing, dict):
+            if configuration_changes(existing, value):
+                merged = dict(existing)
+                merged.update(value)
+                changes[key] = merged
+        elif existing != value:
+            changes[key] = value
+    return changes
+
+
+def apply_configuration(connection, server, desired, dry_run=False):
+    """Bring the AutoSupport configuration of a Web Services instance in line with the desired configuration
+    :param connection: the session to use
+    :param server: the host:port of the Web Services instance
+    :param desired: the desired configuration
+    :param dry_run: only find the differences, without updating the server
+    :return: a result dict, its status is 'compliant', 'updated', 'would-update', 'drifted' (the update did not take
+     effect) or 'failed'
+    """
+    result = {'server': server, 'status': 'failed', 'changes': None, 'error': None}
+    start = time.time()
+    try:
+        changes = configuration_changes(get_configuration(connection, server), desired)
+        result['changes'] = changes
+        if not changes:
+            result['status'] = 'compliant'
+        elif dry_run:
+            result['status'] = 'would-update'
+        else:
+            LOG.info("Updating %s on [%s].", ', '.join(sorted(changes)), server)
+            response = connection.post('http://{server}/devmgr/v2/auto-support/configuration'.format(server=server),
+                                       data=json.dumps(changes))
+            response.raise_for_status()
+            remaining = configuration_changes(get_configuration(connection, server), desired)
+            result['status'] = 'drifted' if remaining else 'updated'
+            if remaining:
+                LOG.warn("The AutoSupport configuration of [%s] still differs: %s", server, remaining)
+    except Exception as e:
+        LOG.error("Unable to configure AutoSupport on [%s]: %s", server, e)
+        result['error'] = str(e)
+    result['elapsed'] = time.time() - start
+    return result
+
+
+def apply_configuration_bulk(servers, desired, workers=8, dry_run=False, connection=None):
+    """Apply the desired AutoSupport configuration to many Web Services instances, only updating those that differ
+    :param servers: the host:port of every Web Services instance
+    :param desired: the desired configuration
+    :param workers: the maximum number of servers configured at once
+    :param dry_run: only find the differences, without updating any server
+    :param connection: the session to use, a new one is created by default
+    :return: a tuple of the result of every server and a summary
+    """
+    connection = connection or get_session()
+    start = time.time()
+    pool = ThreadPool(max(1, min(workers, len(servers))))
+    try:
+        results = pool.map(lambda server: apply_configuration(connection, server, desired, dry_run=dry_run), servers)
+    finally:
+        pool.close()
+        pool.join()
+
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    summary = {'servers': len(servers),
+               'statuses': statuses,
+               'updates': statuses.get('updated', 0) + statuses.get('drifted', 0),
+               'wall_time': time.time() - start}
+    return results, summary
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG,
         format='%(relativeCreated)dms %(levelname)s %(module)s.%(funcName)s:%(lineno)d\n %(message)s')
     args = docopt.docopt(__doc__)
-    update_auto_support_configuration()
+    if args.get('apply'):
+        with open(args.get('<configuration>')) as fp:
+            desired = json.load(fp)
+        results, summary = apply_configuration_bulk(args.get('<server>'), desired, workers=int(args.get('--workers')),
+                                                    dry_run=args.get('--dry-run'))
+        pprint(results)
+        pprint(summary)
+    else:
+        update_auto_support_configuration()
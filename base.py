@@ -1,30 +1,187 @@
+"""
+The configuration of the samples, read from configuration.json.
+
+Besides the Web Services 'server' and credentials, the configuration may describe a fleet of storage-systems, either
+inline as 'systems' or in a separate JSON file named by 'fleet':
+
+    {"server": "wsapi.example.com:8080", "username": "rw", "password": "mypassword",
+     "fleet": "fleet.json"}
+
+    [{"name": "array-01", "address": "https://proxy.example.com:8443", "systemId": "1",
+      "groups": ["rtp", "production"], "tags": {"model": "5700"}, "username": "admin", "password": "admin"}]
+
+A system without credentials uses the configured username and password. Systems are indexed by name, group and tag,
+so a selection only visits the systems it returns:
+
+    Properties().fleet.select(group='production', tags={'model': '5700'})
+
+Files are parsed once per process and shared by every Properties object. A file is only read when a setting is first
+looked up, not when a Properties object is created, and it is read again after it has been modified.
+"""
 import json
-import requests
 import os.path
+import threading
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configuration.json')
+
+_lock = threading.Lock()
+# path -> (mtime, size, parsed contents)
+_files = {}
+# (configuration path, its stamp, fleet path, its stamp) -> Fleet
+_fleets = {}
 
 
 def main():
     config = Properties()
-    print config
+    print(config)
 
 
 def get_session():
+    # The client is configured from Properties, so it can only be imported once they are defined
+    from client import new_session
+    from authentication.session_manager import session_auth
+
     props = Properties()
-    con = requests.Session()
-    con.headers.update({'Accept': 'application/json', 'Content-Type': 'application/json'})
-    con.auth = (props.username, props.password)
-    return con
+    auth = (props.username, props.password)
+    if props.session_login:
+        # Log in once and re-use the JSESSIONID rather than sending Basic-Auth with every request
+        auth = session_auth(props.username, props.password, token_file=props.session_file)
+    return new_session(auth=auth, props=props,
+                       headers={'Accept': 'application/json', 'Content-Type': 'application/json'})
+
+
+def get_system_session(system):
+    """Define a re-usable Session object for a single system, every system shares the connection pools and logs in
+    once per address
+    :param system: a system definition, with its 'username' and 'password'
+    """
+    from client import new_session
+    from authentication.session_manager import session_auth
+
+    return new_session(auth=session_auth(system.get('username'), system.get('password'), verify=False), verify=False)
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def load_json(path):
+    """Get the parsed contents of a JSON file, only reading it again once it has been modified
+    :param path: the path to the file
+    :return: the contents, which are shared by every caller and should not be modified
+    """
+    stamp = _stamp(path)
+    with _lock:
+        cached = _files.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    with open(path) as fp:
+        contents = json.load(fp)
+    with _lock:
+        _files[path] = (stamp, contents)
+    return contents
+
+
+class Fleet(object):
+    """The storage-systems of the configuration, indexed by name, group and tag"""
+
+    def __init__(self, systems, username=None, password=None):
+        """
+        :param systems: a list of system definitions
+        :param username: the username of the systems that don't define one
+        :param password: the password of the systems that don't define one
+        """
+        self.systems = []
+        self.by_name = {}
+        self.by_group = {}
+        self.by_tag = {}
+        for index, definition in enumerate(systems):
+            system = dict(definition)
+            system.setdefault('systemId', '1')
+            system.setdefault('name', '{}/{}'.format(system.get('address'), system['systemId']))
+            system.setdefault('username', username)
+            system.setdefault('password', password)
+            system['groups'] = list(system.get('groups') or [])
+            system['tags'] = dict(system.get('tags') or {})
+            self.systems.append(system)
+            self.by_name[system['name']] = index
+            for group in system['groups']:
+                self.by_group.setdefault(group, []).append(index)
+            for tag in system['tags'].items():
+                self.by_tag.setdefault(tag, []).append(index)
+
+    def __len__(self):
+        return len(self.systems)
+
+    def __iter__(self):
+        return iter(self.systems)
+
+    def get(self, name):
+        """Get a system by its name, or None"""
+        index = self.by_name.get(name)
+        return self.systems[index] if index is not None else None
+
+    def groups(self):
+        """Get the number of systems in each group"""
+        return dict((group, len(indexes)) for group, indexes in self.by_group.items())
+
+    def select(self, group=None, tags=None, names=None):
+        """Get the systems that match every criterion given, in the order they are configured
+        :param group: the name of a group the systems belong to
+        :param tags: a dict of tags the systems carry, with their values
+        :param names: the names of the systems
+        :return: a list of system definitions, every system if no criterion is given
+        """
+        candidates = []
+        if group is not None:
+            candidates.append(self.by_group.get(group, []))
+        for tag in (tags or {}).items():
+            candidates.append(self.by_tag.get(tag, []))
+        if names is not None:
+            candidates.append([self.by_name[name] for name in names if name in self.by_name])
+        if not candidates:
+            return list(self.systems)
+
+        # Intersect from the smallest index, so the work is bounded by the most selective criterion
+        candidates.sort(key=len)
+        selected = set(candidates[0])
+        for indexes in candidates[1:]:
+            if not selected:
+                break
+            selected.intersection_update(indexes)
+        return [self.systems[index] for index in sorted(selected)]
 
 
 class Properties(object):
     def __init__(self, config_file=None):
-        if config_file is None:
-            self.config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configuration.json')
-        else:
-            self.config_file = config_file
+        # The file is read on first use, so that creating a Properties object (e.g. at import time) does no I/O
+        self.config_file = config_file or CONFIG_FILE
+
+    @property
+    def json(self):
+        return load_json(self.config_file)
 
-        with open(self.config_file) as fp:
-            self.json = json.load(fp)
+    @property
+    def fleet(self):
+        """The Fleet of storage-systems defined by the configuration, built once for every version of its files"""
+        config = self.json
+        fleet_file = config.get('fleet')
+        if fleet_file is not None:
+            fleet_file = os.path.join(os.path.dirname(os.path.abspath(self.config_file)), fleet_file)
+        key = (self.config_file, _stamp(self.config_file), fleet_file,
+               _stamp(fleet_file) if fleet_file is not None else None)
+        with _lock:
+            fleet = _fleets.get(key)
+        if fleet is None:
+            systems = load_json(fleet_file) if fleet_file is not None else config.get('systems') or []
+            fleet = Fleet(systems, username=config.get('username'), password=config.get('password'))
+            with _lock:
+                # Only the current version of each configuration is kept
+                for stale in [other for other in _fleets if other[0] == self.config_file]:
+                    del _fleets[stale]
+                _fleets[key] = fleet
+        return fleet
 
     def __str__(self):
         return self.__repr__()
@@ -39,6 +196,8 @@ class Properties(object):
         return self.json.get(item)
 
     def __getattr__(self, item):
+        if item.startswith('__'):
+            raise AttributeError(item)
         return self.__getitem__(item)
 
 
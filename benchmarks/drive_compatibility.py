@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of drive firmware compatibility resolution on synthetic drive inventories.
+
+Usage:
+  drive_compatibility [--drives=<n>] [--firmware=<n>] [--repeat=<n>]
+  drive_compatibility -h
+Options:
+  -h --help        Show this screen.
+  --drives=<n>     Comma separated drive inventory sizes [default: 1000,10000]
+  --firmware=<n>   The number of firmware files known to the array [default: 20]
+  --repeat=<n>     The number of timed runs; the best is reported [default: 3]
+
+Description:
+    Compares the original nested-loop matching that fw_compatible_drives() used with the indexed resolution, both for
+     a single firmware file and for resolving every firmware file in one batch.
+"""
+import random
+import timeit
+
+import docopt
+
+from drive_firmware_upgrade.drive_firmware_upgrade import compatibility_index, resolve_compatible_drives
+
+
+def synthetic_inventory(drive_count, firmware_count, seed=1):
+    """Build driveRefs and compatibilities where every drive model has its own firmware file"""
+    rand = random.Random(seed)
+    drive_refs = ['0100000050000396{:024X}'.format(index) for index in range(drive_count)]
+    models = [[] for _ in range(firmware_count)]
+    for drive in drive_refs:
+        models[rand.randrange(firmware_count)].append(drive)
+
+    compatibilities = [{'filename': 'D_MODEL{:02}_MS0{}.dlp'.format(model, model % 3),
+                        'compatibleDrives': [{'driveRef': drive} for drive in drives]}
+                       for model, drives in enumerate(models)]
+    return drive_refs, compatibilities
+
+
+def legacy_compatible_drives(compatibilities, drives, filename):
+    """The matching that fw_compatible_drives() originally performed"""
+    comp_drives = []
+    for firmware in compatibilities:
+        compatible = firmware['compatibleDrives']
+        if filename == firmware['filename']:
+            for drive in drives:
+                for compatible_drive in compatible:
+                    if drive in compatible_drive['driveRef']:
+                        comp_drives.append(drive)
+    return comp_drives
+
+
+def best(statement, repeat):
+    return min(timeit.repeat(statement, number=1, repeat=repeat))
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    firmware_count = int(args.get('--firmware'))
+    repeat = int(args.get('--repeat'))
+
+    print('{:>8} {:>18} {:>18} {:>18} {:>18}'.format('drives', 'legacy one (ms)', 'indexed one (ms)',
+                                                   'legacy all (ms)', 'indexed all (ms)'))
+    for drive_count in [int(count) for count in args.get('--drives').split(',')]:
+        drive_refs, compatibilities = synthetic_inventory(drive_count, firmware_count)
+        filenames = [firmware['filename'] for firmware in compatibilities]
+
+        # the indexed timings include building the index
+        legacy_one = best(lambda: legacy_compatible_drives(compatibilities, drive_refs, filenames[0]), repeat)
+        indexed_one = best(lambda: resolve_compatible_drives(compatibility_index(compatibilities), drive_refs,
+                                                             filenames[:1]), repeat)
+        legacy_all = best(lambda: [legacy_compatible_drives(compatibilities, drive_refs, filename)
+                                   for filename in filenames], repeat)
+        indexed_all = best(lambda: resolve_compatible_drives(compatibility_index(compatibilities), drive_refs,
+                                                             filenames), repeat)
+
+        expected = legacy_compatible_drives(compatibilities, drive_refs, filenames[0])
+        assert resolve_compatible_drives(compatibility_index(compatibilities), drive_refs,
+                                         filenames[:1])[filenames[0]] == expected
+
+        print('{:>8} {:>18.2f} {:>18.2f} {:>18.2f} {:>18.2f}'.format(drive_count, legacy_one * 1000,
+                                                                     indexed_one * 1000, legacy_all * 1000,
+                                                                     indexed_all * 1000))
+
+
+if __name__ == '__main__':
+    main()
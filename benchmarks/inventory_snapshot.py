@@ -0,0 +1,95 @@
+"""
+Benchmark of inventory queries on a columnar snapshot compared with the equivalent JSON document.
+
+Usage:
+  inventory_snapshot [--drives=<n>] [--systems=<n>] [--repeat=<n>] [--directory=<dir>]
+  inventory_snapshot -h
+Options:
+  -h --help          Show this screen.
+  --drives=<n>       The number of drives in the synthetic fleet [default: 100000]
+  --systems=<n>      The number of storage-systems in the synthetic fleet [default: 500]
+  --repeat=<n>       The number of timed runs; the best is reported [default: 3]
+  --directory=<dir>  Where to write the files, a temporary directory by default
+
+Description:
+    Writes the same synthetic inventory as a snapshot and as JSON, then times opening each file and finding the
+     non-optimal drives and the pools above 80% full.
+"""
+import json
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+import docopt
+
+from inventory.snapshot import Snapshot, encode_table, non_optimal_drives, pools_above, write_snapshot
+
+STATUSES = ['optimal'] * 200 + ['failed', 'removed', 'incompatible', 'bypassed']
+
+
+def synthetic_fleet(drive_count, system_count, seed=1):
+    """Build the storage-systems, pools and drives of a fleet, as the API returns them"""
+    rand = random.Random(seed)
+    fleet = {}
+    for system in range(system_count):
+        sys_id = 'system{:05}'.format(system)
+        pools = [{'id': '{}-pool{}'.format(sys_id, pool), 'name': 'pool{}'.format(pool), 'raidLevel': 'raid6',
+                  'totalRaidedSpace': str(100 * 2 ** 40), 'usedSpace': str(int(rand.uniform(10, 95) * 2 ** 40)),
+                  'freeSpace': '0'} for pool in range(4)]
+        drives = [{'driveRef': '{}-drive{:04}'.format(sys_id, drive), 'status': rand.choice(STATUSES),
+                   'firmwareVersion': rand.choice(['MS02', 'MS03', 'MS04']), 'productID': 'X446_1606030',
+                   'serialNumber': 'SN{:08}{:05}'.format(system, drive), 'rawCapacity': str(4 * 2 ** 40),
+                   'physicalLocation': {'trayRef': '{}-tray{}'.format(sys_id, drive // 60), 'slot': drive % 60},
+                   'currentVolumeGroupRef': pools[drive % 4]['id'], 'hotSpare': False}
+                  for drive in range(drive_count // system_count)]
+        fleet[sys_id] = {'pools': pools, 'volumes': [], 'drives': drives}
+    return fleet
+
+
+def json_queries(path):
+    with open(path) as fp:
+        fleet = json.load(fp)
+    drives = [drive for inventory in fleet.values() for drive in inventory['drives'] if drive['status'] != 'optimal']
+    pools = [pool for inventory in fleet.values() for pool in inventory['pools']
+             if float(pool['usedSpace']) > 0.8 * float(pool['totalRaidedSpace'])]
+    return len(drives), len(pools)
+
+
+def snapshot_queries(path):
+    with Snapshot(path) as snapshot:
+        return len(non_optimal_drives(snapshot)), len(pools_above(snapshot, 0.8))
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    repeat = int(args.get('--repeat'))
+    directory = args.get('--directory') or tempfile.mkdtemp()
+    fleet = synthetic_fleet(int(args.get('--drives')), int(args.get('--systems')))
+
+    json_path = os.path.join(directory, 'inventory.json')
+    snapshot_path = os.path.join(directory, 'inventory.snap')
+    with open(json_path, 'w') as fp:
+        json.dump(fleet, fp)
+    tables = {'systems': encode_table('systems', None, [{'id': sys_id} for sys_id in fleet])}
+    for table in ('pools', 'volumes', 'drives'):
+        tables[table] = None
+        for sys_id, inventory in fleet.items():
+            tables[table] = encode_table(table, sys_id, inventory[table], tables[table])
+    write_snapshot(snapshot_path, tables)
+
+    try:
+        print('{:>10} {:>12} {:>10} {:>10}'.format('format', 'size (KiB)', 'best ms', 'matches'))
+        for name, path, query in (('json', json_path, json_queries), ('snapshot', snapshot_path, snapshot_queries)):
+            matches = query(path)
+            elapsed = min(timeit.repeat(lambda: query(path), number=1, repeat=repeat))
+            print('{:>10} {:>12} {:>10.1f} {:>10}'.format(name, os.path.getsize(path) // 1024, 1000 * elapsed,
+                                                          '{}/{}'.format(*matches)))
+    finally:
+        if not args.get('--directory'):
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Compare the peak memory and latency of streamed JSON parsing with Response.json() on a large drives listing.
+
+Usage:
+  json_streaming [--drives=<n>] [--repeat=<n>]
+  json_streaming --serve <drives>
+  json_streaming --child <mode> <url>
+  json_streaming -h
+Options:
+  -h --help     Show this screen.
+  --drives=<n>  The number of drives in the listing [default: 200000]
+  --repeat=<n>  The number of runs of each mode; the fastest is reported [default: 3]
+
+Description:
+    A local server process returns a synthetic drives listing, and every run is made by a fresh child process, so the
+     peak RSS that is reported only covers the client side. Three modes are compared:
+
+        json    Response.json(), then filter the non-optimal drives (the original path)
+        filter  iter_json(), filtering the non-optimal drives as they are parsed
+        first   iter_json(), stopping at the first non-optimal drive, as a lookup by name does
+
+    'first to item' is the time until the first non-optimal drive is available to the caller.
+"""
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import docopt
+import requests
+
+from json_stream import iter_json
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+LOG = logging.getLogger(__name__)
+
+MODES = ('json', 'filter', 'first')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def synthetic_drives(count):
+    """Build a drives listing with a non-optimal drive near the start and a few more scattered through it"""
+    return json.dumps([{'driveRef': '010000005000039{:09X}'.format(drive), 'id': '010000005000039{:09X}'.format(drive),
+                        'status': 'failed' if drive % 5000 == 10 else 'optimal', 'firmwareVersion': 'MS02',
+                        'productID': 'X446_1606030', 'serialNumber': 'SN{:012}'.format(drive),
+                        'rawCapacity': str(4 * 2 ** 40), 'hotSpare': False,
+                        'physicalLocation': {'trayRef': '0E00000000000000000000000000000{}'.format(drive // 60 % 10),
+                                             'slot': drive % 60, 'locationPosition': drive % 60}}
+                       for drive in range(count)]).encode('utf-8')
+
+
+class ListingHandler(BaseHTTPRequestHandler):
+    """Return the same JSON body to every request"""
+    protocol_version = 'HTTP/1.1'
+    body = b'[]'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        for offset in range(0, len(self.body), 64 * 1024):
+            self.wfile.write(self.body[offset:offset + 64 * 1024])
+
+    def log_message(self, *args):
+        pass
+
+
+class ListingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The 'first' mode closes the connection without reading the rest of the listing
+        pass
+
+
+def max_rss_kib():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and KiB on Linux
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def run_child(mode, url):
+    """Fetch and filter the listing once and print the measurements as JSON"""
+    session = requests.Session()
+    baseline = max_rss_kib()
+    start = time.time()
+    first = None
+    matches = 0
+    if mode == 'json':
+        response = session.get(url)
+        response.raise_for_status()
+        failed = [drive for drive in response.json() if drive['status'] != 'optimal']
+        first = time.time() - start
+        matches = len(failed)
+    else:
+        response = session.get(url, stream=True)
+        response.raise_for_status()
+        drives = iter_json(response)
+        for drive in drives:
+            if drive['status'] != 'optimal':
+                matches += 1
+                if first is None:
+                    first = time.time() - start
+                if mode == 'first':
+                    drives.close()
+                    break
+    elapsed = time.time() - start
+    print(json.dumps({'seconds': elapsed, 'first': first, 'matches': matches, 'baseline_rss_kib': baseline,
+                      'max_rss_kib': max_rss_kib()}))
+
+
+def measure(mode, url):
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.json_streaming', '--child', mode, url],
+                                     cwd=ROOT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def serve(drive_count):
+    """Serve the listing until stdin is closed, the port is printed once the server is listening"""
+    ListingHandler.body = synthetic_drives(drive_count)
+    server = ListingServer(('127.0.0.1', 0), ListingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print(json.dumps({'port': server.server_address[1], 'size': len(ListingHandler.body)}))
+    sys.stdout.flush()
+    sys.stdin.read()
+    server.shutdown()
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    if args.get('--serve'):
+        serve(int(args.get('<drives>')))
+        return
+    if args.get('--child'):
+        run_child(args.get('<mode>'), args.get('<url>'))
+        return
+
+    # The server runs in its own process: the peak RSS of a child includes that of its parent when it was started
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.json_streaming', '--serve', args.get('--drives')],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=ROOT)
+    try:
+        listing = json.loads(server.stdout.readline().decode('utf-8'))
+        url = 'http://127.0.0.1:{}/devmgr/v2/storage-systems/1/drives'.format(listing['port'])
+        print('listing: {} drives, {:.1f} MiB'.format(args.get('--drives'), listing['size'] / 1048576.0))
+        print('{:>7} {:>10} {:>16} {:>14} {:>12} {:>8}'.format('mode', 'total ms', 'first to item ms',
+                                                             'peak RSS MiB', 'RSS delta', 'matches'))
+        for mode in MODES:
+            results = [measure(mode, url) for _ in range(int(args.get('--repeat')))]
+            result = min(results, key=lambda result: result['seconds'])
+            print('{:>7} {:>10.1f} {:>16.1f} {:>14.1f} {:>12.1f} {:>8}'.format(
+                mode, 1000 * result['seconds'], 1000 * result['first'], result['max_rss_kib'] / 1024.0,
+                (result['max_rss_kib'] - result['baseline_rss_kib']) / 1024.0, result['matches']))
+    finally:
+        server.stdin.close()
+        server.wait()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    main()
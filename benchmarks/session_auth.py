@@ -0,0 +1,106 @@
+"""
+Compare the request latency and server-side session churn of Basic-Authentication with a re-used login session.
+
+Usage:
+  session_auth <server> <username> <password> [--requests=<n>] [--threads=<n>] [--path=<path>] [--insecure]
+  session_auth -h
+Arguments:
+  server    API endpoint, ex: https://proxy.example.com:8443
+  username  ID to provide for authentication
+  password  Password corresponding to specified userid.
+Options:
+  -h --help        Show this screen.
+  --requests=<n>   The number of requests made in each mode [default: 200]
+  --threads=<n>    The number of concurrent callers [default: 4]
+  --path=<path>    The resource to request [default: /devmgr/v2/storage-systems]
+  --insecure       Don't verify the server's TLS certificate
+
+Description:
+    Every new server-side session is announced with a new JSESSIONID cookie, so the number of distinct JSESSIONIDs
+     returned by the server (plus the logins made) is the number of sessions each mode made it create.
+"""
+import time
+from multiprocessing.pool import ThreadPool
+
+import docopt
+
+from authentication.session_manager import COOKIE_NAME, SessionManager, JSessionAuth
+from client import new_session
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[int(round(fraction * (len(ordered) - 1)))] if ordered else 0.0
+
+
+def run(session, url, count, threads):
+    """Make count requests and collect their latency and the JSESSIONIDs the server handed out"""
+    def request(_):
+        start = time.time()
+        response = session.get(url)
+        response.raise_for_status()
+        return time.time() - start, response.cookies.get(COOKIE_NAME)
+
+    pool = ThreadPool(threads)
+    try:
+        start = time.time()
+        results = pool.map(request, range(count))
+        elapsed = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+
+    latencies = [latency for latency, _ in results]
+    return {'requests_per_second': count / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'server_sessions': len(set(token for _, token in results if token))}
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    server, username, password = args.get('<server>'), args.get('<username>'), args.get('<password>')
+    url = server + args.get('--path')
+    count, threads = int(args.get('--requests')), int(args.get('--threads'))
+    verify = not args.get('--insecure')
+
+    # Every request has to reach the server, so the response cache is not used
+    # Basic-Auth, without keeping the cookies that the server sends back
+    basic = new_session(auth=(username, password), verify=verify, cache=False)
+    basic.cookies.set_policy(_RejectCookies())
+
+    manager = SessionManager(username, password, verify=verify)
+    login = new_session(auth=JSessionAuth(manager), verify=verify, cache=False)
+
+    print('{:>8} {:>10} {:>9} {:>9} {:>9} {:>16} {:>7}'.format('mode', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                              'server sessions', 'logins'))
+    for mode, session in (('basic', basic), ('session', login)):
+        result = run(session, url, count, threads)
+        logins = manager.logins if mode == 'session' else 0
+        print('{:>8} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>16} {:>7}'.format(
+            mode, result['requests_per_second'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['server_sessions'] + logins, logins))
+
+
+class _RejectCookies(object):
+    """A cookie policy that neither stores nor sends any cookie"""
+    netscape = True
+    rfc2965 = False
+    hide_cookie2 = False
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+    def domain_return_ok(self, domain, request):
+        return False
+
+    def path_return_ok(self, path, request):
+        return False
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Compare the peak memory and throughput of streamed firmware uploads with requests' files= encoding.
+
+Usage:
+  upload_streaming [--sizes=<mib>] [--buffer=<kib>] [--dir=<dir>]
+  upload_streaming --child <mode> <path> <url> [--buffer=<kib>]
+  upload_streaming -h
+Options:
+  -h --help       Show this screen.
+  --sizes=<mib>   Comma separated image sizes in MiB [default: 100,512,1024]
+  --buffer=<kib>  The streaming buffer size in KiB [default: 1024]
+  --dir=<dir>     Where to write the temporary images (default: the system temp directory)
+
+Description:
+    Every upload is made by a fresh child process against a local server that discards what it receives, so the
+     peak RSS that is reported only covers the client side of the upload. Three modes are compared:
+
+        files   requests' files= multipart encoding (the original upload path)
+        stream  MultipartFileStream with buffered reads
+        mmap    MultipartFileStream reading through a memory map
+
+    Pages of a memory-mapped file count towards RSS while they are resident, but they are clean page cache that the
+     kernel can drop at any time, unlike the heap memory used by the files= path.
+"""
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import docopt
+import requests
+
+from streaming_upload import upload_file
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+LOG = logging.getLogger(__name__)
+
+MODES = ('files', 'stream', 'mmap')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SinkHandler(BaseHTTPRequestHandler):
+    """Accept an upload and throw it away"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SinkServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def max_rss_kib():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and KiB on Linux
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def run_child(mode, path, url, buffer_size):
+    """Perform a single upload and print the measurements as JSON"""
+    session = requests.Session()
+    baseline = max_rss_kib()
+    start = time.time()
+    if mode == 'files':
+        with open(path, 'rb') as firmware_file:
+            response = session.post(url, files={'file': firmware_file})
+    else:
+        response = upload_file(session, url, 'file', path, buffer_size=buffer_size, use_mmap=(mode == 'mmap'))
+    response.raise_for_status()
+    elapsed = time.time() - start
+    print(json.dumps({'seconds': elapsed, 'baseline_rss_kib': baseline, 'max_rss_kib': max_rss_kib()}))
+
+
+def make_image(directory, size_mib):
+    """Write a test image of the given size"""
+    block = os.urandom(1024 * 1024)
+    fd, path = tempfile.mkstemp(suffix='.dlp', dir=directory)
+    with os.fdopen(fd, 'wb') as fp:
+        for _ in range(size_mib):
+            fp.write(block)
+    return path
+
+
+def measure(mode, path, url, buffer_kib):
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.upload_streaming', '--child', mode, path, url,
+                                      '--buffer={}'.format(buffer_kib)], cwd=ROOT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    buffer_kib = int(args.get('--buffer'))
+    if args.get('--child'):
+        run_child(args.get('<mode>'), args.get('<path>'), args.get('<url>'), buffer_kib * 1024)
+        return
+
+    server = SinkServer(('127.0.0.1', 0), SinkHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}/upload'.format(server.server_address[1])
+
+    print('{:>8} {:>7} {:>10} {:>14} {:>12}'.format('size', 'mode', 'MiB/s', 'peak RSS MiB', 'RSS delta'))
+    try:
+        for size_mib in [int(size) for size in args.get('--sizes').split(',')]:
+            path = make_image(args.get('--dir'), size_mib)
+            try:
+                for mode in MODES:
+                    result = measure(mode, path, url, buffer_kib)
+                    print('{:>8} {:>7} {:>10.1f} {:>14.1f} {:>12.1f}'.format(
+                        size_mib, mode, size_mib / result['seconds'], result['max_rss_kib'] / 1024.0,
+                        (result['max_rss_kib'] - result['baseline_rss_kib']) / 1024.0))
+            finally:
+                os.remove(path)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    main()
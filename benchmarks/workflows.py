@@ -0,0 +1,223 @@
+"""
+End-to-end benchmark of every workflow against a mock SANtricity Web Services fleet of increasing size.
+
+Usage:
+  workflows [--systems=<list>] [--workflows=<list>] [--latency=<ms>] [--failure-rate=<f>] [--workers=<n>] [--report=<f>]
+  workflows -h
+Options:
+  -h --help           Show this screen.
+  --systems=<list>    The fleet sizes to run every workflow against, comma separated [default: 1,100,1000]
+  --workflows=<list>  The workflows to run, comma separated, all of them by default
+  --latency=<ms>      The mean time the mock takes to serve a request, in milliseconds [default: 5]
+  --failure-rate=<f>  The fraction of requests the mock fails with a 500 [default: 0]
+  --workers=<n>       The concurrency of every workflow [default: 16]
+  --report=<f>        Also write the measurements to this file as JSON
+
+Description:
+    For every fleet size a MockServer (see mock_santricity) is started, and each workflow is run against it through
+     the same functions the command line tools use:
+
+        inventory       inventory.collector.collect() of every storage-system through the proxy
+        drive_rollout   drive_firmware_upgrade.fleet_rollout.FleetRollout of every storage-system through the proxy
+        controller      firmware_upgrade.orchestrator.WaveOrchestrator, in waves of a tenth of the fleet, over the
+                        embedded controllers of every storage-system
+        health_gate     firmware_upgrade.controller_firmware_upgrade.health_gate() of every storage-system
+        provisioning    provisioning.volume.bulk_create_volumes() of a volume on every storage-system
+        asup_bundles    trigger_auto_support_bundles() of every embedded Web Services instance, with downloads
+        asup_config     apply_configuration_bulk() of an AutoSupport configuration to every embedded instance
+
+    The mock completes drive firmware downloads, health checks, AutoSupport jobs and controller reboots in a fraction
+     of the time an array takes, so the poll backoffs of the modules are shortened to match. The measurements
+     therefore reflect the overhead of the client (requests, polling, concurrency), not the time an array would take.
+
+    Each workflow reports the storage-systems it completed, its wall time and throughput, and the number and latency
+     percentiles of the requests the mock served during it.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import docopt
+
+from poller import Backoff
+
+LOG = logging.getLogger(__name__)
+
+# The time the mock takes for each long-running operation, in seconds
+MOCK_TIMINGS = {'reboot_time': 1.0, 'drive_download_time': 0.5, 'health_check_time': 0.2, 'asup_job_time': 0.5,
+                'asup_size': 256 * 1024}
+
+# Poll the mock at the pace of its timings rather than that of an array
+FAST_BACKOFF = Backoff(initial=0.1, factor=1.5, maximum=1.0)
+
+DESIRED_ASUP_CONFIGURATION = {'autoSupportEnabled': True, 'onDemandEnabled': True, 'remoteDiagsEnabled': False,
+                              'schedule': {'dailyMinTime': 120, 'dailyMaxTime': 240}}
+
+
+def shorten_backoffs():
+    """Replace the poll backoffs of the modules with FAST_BACKOFF"""
+    from auto_support import trigger_auto_support_bundle
+    from drive_firmware_upgrade import drive_firmware_upgrade
+    from firmware_upgrade import controller_firmware_upgrade
+
+    controller_firmware_upgrade.HEALTH_CHECK_BACKOFF = FAST_BACKOFF
+    controller_firmware_upgrade.AVAILABILITY_BACKOFF = FAST_BACKOFF
+    controller_firmware_upgrade.AVAILABILITY_TIMEOUT = 60
+    drive_firmware_upgrade.DRIVE_STATE_BACKOFF = FAST_BACKOFF
+    trigger_auto_support_bundle.JOB_BACKOFF = FAST_BACKOFF
+
+
+def size_connection_pool(workers):
+    """Create the shared connection pools with room for every worker, as the configuration would for a fleet"""
+    from base import Properties
+    from client import get_adapter
+
+    # Pollers, downloads and the pipelined stages of a rollout run alongside the workers
+    get_adapter(pool_size=max(Properties().pool_size or 0, 4 * workers))
+
+
+def firmware_file(directory, name, size=1024 * 1024):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as fp:
+        fp.write(os.urandom(size))
+    return path
+
+
+def inventory(mock, workers, directory):
+    from base import get_session
+    from inventory.collector import collect
+
+    stats = collect(os.path.join(directory, 'inventory.snap'), server=mock.address, workers=workers, con=get_session())
+    return stats['systems'] - stats['failed']
+
+
+def drive_rollout(mock, workers, directory):
+    from drive_firmware_upgrade.fleet_rollout import FleetRollout
+
+    systems = [{'name': system['name'], 'address': mock.url, 'systemId': system['id']}
+               for system in mock.fleet.systems]
+    rollout = FleetRollout(firmware_file(directory, 'D_X446_MS03.dlp'), workers=workers, per_endpoint=workers)
+    results, _ = rollout.run(systems)
+    return sum(1 for result in results if result['status'] == 'upgraded')
+
+
+def controller(mock, workers, directory):
+    from firmware_upgrade.orchestrator import WaveOrchestrator
+
+    systems = [{'name': system['name'], 'controllers': mock.controllers(system['index'])}
+               for system in mock.fleet.systems]
+    orchestrator = WaveOrchestrator(firmware_file(directory, 'RCB_08.50.00.00.dlp'),
+                                    wave_size=max(1, len(systems) // 10), max_in_flight=workers)
+    results, _ = orchestrator.run(systems)
+    return sum(1 for result in results if result['status'] == 'upgraded')
+
+
+def health_gate(mock, workers, directory):
+    from firmware_upgrade.controller_firmware_upgrade import API, get_session, health_gate
+
+    session = get_session((None, None))
+    try:
+        passed = health_gate(session, mock.url + API['health_check'], [system['id'] for system in mock.fleet.systems])
+    finally:
+        session.close()
+    return sum(passed.values())
+
+
+def provisioning(mock, workers, directory):
+    from provisioning import volume
+
+    report = volume.bulk_create_volumes([{'system': system['id'], 'name': 'benchmark', 'pool': None, 'size': '10'}
+                                         for system in mock.fleet.systems], workers=workers, server=mock.address)
+    return len(report['created'])
+
+
+def asup_bundles(mock, workers, directory):
+    from auto_support.trigger_auto_support_bundle import trigger_auto_support_bundles
+    from base import get_session
+
+    servers = [mock.embedded_server(system['index']) for system in mock.fleet.systems]
+    results, _ = trigger_auto_support_bundles(servers, 'collect', 'REST_API', directory=os.path.join(directory, 'asup'),
+                                              workers=workers, connection=get_session())
+    return sum(1 for result in results if result['status'] == 'complete' and result['path'] is not None)
+
+
+def asup_config(mock, workers, directory):
+    from auto_support.update_auto_support_configuration import apply_configuration_bulk
+    from base import get_session
+
+    servers = [mock.embedded_server(system['index']) for system in mock.fleet.systems]
+    results, _ = apply_configuration_bulk(servers, DESIRED_ASUP_CONFIGURATION, workers=workers,
+                                          connection=get_session())
+    return sum(1 for result in results if result['status'] == 'updated')
+
+
+WORKFLOWS = OrderedDict([('inventory', inventory),
+                         ('drive_rollout', drive_rollout),
+                         ('controller', controller),
+                         ('health_gate', health_gate),
+                         ('provisioning', provisioning),
+                         ('asup_bundles', asup_bundles),
+                         ('asup_config', asup_config)])
+
+
+def run_workflow(name, mock, workers):
+    """Run a workflow against a fresh fleet and describe its performance"""
+    directory = tempfile.mkdtemp(prefix='workflows-')
+    mock.reset_stats()
+    start = time.time()
+    error = None
+    try:
+        completed = WORKFLOWS[name](mock, workers, directory)
+    except Exception as e:
+        LOG.exception("The %s workflow failed.", name)
+        completed, error = 0, str(e)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    elapsed = time.time() - start
+    stats = mock.stats()
+    return {'workflow': name, 'systems': len(mock.fleet.systems), 'completed': completed, 'seconds': elapsed,
+            'systems_per_second': completed / elapsed if elapsed else 0.0, 'requests': stats['requests'],
+            'requests_per_second': stats['requests'] / elapsed if elapsed else 0.0,
+            'p50_ms': 1000 * stats['p50'], 'p95_ms': 1000 * stats['p95'], 'p99_ms': 1000 * stats['p99'],
+            'error': error}
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    from mock_santricity import MockServer
+
+    names = args.get('--workflows').split(',') if args.get('--workflows') else list(WORKFLOWS)
+    unknown = [name for name in names if name not in WORKFLOWS]
+    if unknown:
+        raise SystemExit('Unknown workflows: {}, choose from {}'.format(', '.join(unknown), ', '.join(WORKFLOWS)))
+    workers = int(args.get('--workers'))
+    shorten_backoffs()
+    size_connection_pool(workers)
+
+    print('{:>6} {:>14} {:>11} {:>9} {:>10} {:>9} {:>8} {:>8} {:>8}'.format(
+        'fleet', 'workflow', 'completed', 'seconds', 'systems/s', 'requests', 'p50 ms', 'p95 ms', 'p99 ms'))
+    measurements = []
+    for size in [int(size) for size in args.get('--systems').split(',')]:
+        for name in names:
+            # Every workflow starts from a fresh fleet, so it isn't affected by what the others changed
+            with MockServer(systems=size, latency=float(args.get('--latency')) / 1000.0,
+                            failure_rate=float(args.get('--failure-rate')), **MOCK_TIMINGS) as mock:
+                result = run_workflow(name, mock, workers)
+            measurements.append(result)
+            print('{:>6} {:>14} {:>11} {:>9.2f} {:>10.1f} {:>9} {:>8.1f} {:>8.1f} {:>8.1f}{}'.format(
+                size, name, '{}/{}'.format(result['completed'], size), result['seconds'],
+                result['systems_per_second'], result['requests'], result['p50_ms'], result['p95_ms'],
+                result['p99_ms'], '  ' + result['error'] if result['error'] else ''))
+
+    if args.get('--report'):
+        with open(args.get('--report'), 'w') as fp:
+            json.dump(measurements, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s')
+    main()
@@ -0,0 +1,239 @@
+"""
+A response cache for the read-mostly inventory endpoints.
+
+The samples repeatedly GET resources that rarely change: the storage-systems, their storage-pools, drives and drive
+firmware compatibilities, and the AutoSupport configuration. A ResponseCache sits under the session, as a transport
+adapter wrapping the shared connection pools (see client.new_session()), and answers those requests from memory for a
+short, per-endpoint time-to-live:
+
+    session = new_session(auth=auth, cache=ResponseCache())
+
+Only the endpoints listed in the TTL rules are cached, so operation states that are polled are always fetched. Once an
+entry expires it is revalidated with If-None-Match/If-Modified-Since if the server sent an ETag or Last-Modified header,
+and re-used if the server answers 304 Not Modified.
+
+Any request that may change state (anything but GET, HEAD and OPTIONS) invalidates every entry of the server it was
+sent to, so a GET that follows a POST always sees its effect. Entries can also be dropped explicitly with invalidate(),
+or skipped for a single request by sending 'Cache-Control: no-cache'.
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from requests.adapters import BaseAdapter
+from requests.compat import urlparse
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_ENTRY_SIZE = 4 * 1024 * 1024
+
+# (path pattern, time-to-live in seconds), the first matching rule applies
+DEFAULT_TTLS = [(r'/devmgr/v2/storage-systems$', 60),
+                (r'/devmgr/v2/storage-systems/[^/]+/storage-pools$', 30),
+                (r'/devmgr/v2/storage-systems/[^/]+/drives$', 30),
+                (r'/devmgr/v2/storage-systems/[^/]+/firmware/drives$', 300),
+                (r'/devmgr/v2/auto-support/configuration$', 300)]
+
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+# Requests that are sent with a mutating method, but don't change any resource
+NON_MUTATING_PATHS = frozenset(['/devmgr/utils/login'])
+
+
+def _server(url):
+    parsed = urlparse(url)
+    return '{}://{}'.format(parsed.scheme, parsed.netloc)
+
+
+class CacheEntry(object):
+    """A cached response"""
+
+    def __init__(self, response, expires):
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = dict(response.headers)
+        self.content = response.content
+        self.expires = expires
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+    def response(self, request, connection):
+        """Build a new Response to a request from the cached one"""
+        response = Response()
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = self.content
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.connection = connection
+        return response
+
+
+class ResponseCache(object):
+    """A thread-safe, size-bounded (LRU) cache of responses with per-endpoint time-to-live"""
+
+    def __init__(self, ttls=None, max_entries=DEFAULT_MAX_ENTRIES, max_entry_size=DEFAULT_MAX_ENTRY_SIZE):
+        """
+        :param ttls: a list of (path pattern, time-to-live in seconds), DEFAULT_TTLS by default
+        :param max_entries: the number of responses to keep, the least recently used are evicted first
+        :param max_entry_size: streamed responses larger than this many bytes (or of unknown length) are not cached,
+         so that they can still be parsed incrementally
+        """
+        self.rules = [(re.compile(pattern), ttl) for pattern, ttl in (DEFAULT_TTLS if ttls is None else ttls)]
+        self.max_entries = max_entries
+        self.max_entry_size = max_entry_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def ttl(self, url):
+        """Get the time-to-live for a url, or None if it isn't cached"""
+        path = urlparse(url).path.rstrip('/')
+        for pattern, ttl in self.rules:
+            if pattern.search(path):
+                return ttl
+        return None
+
+    def _key(self, request):
+        # Keep responses to different credentials (and unauthenticated requests) apart
+        return (request.url, request.headers.get('Accept'), request.headers.get('Authorization'),
+                request.headers.get('Cookie'))
+
+    def fetch(self, request, send, connection=None, stream=False):
+        """Answer a GET request from the cache, or send it and cache the response
+        :param request: the PreparedRequest
+        :param send: a callable that sends a PreparedRequest and returns the Response
+        :param connection: the adapter set on responses built from the cache
+        :param stream: whether the body of the response was requested as a stream
+        :return: the Response
+        """
+        ttl = self.ttl(request.url)
+        if ttl is None or 'no-cache' in request.headers.get('Cache-Control', ''):
+            return send(request)
+
+        key = self._key(request)
+        server = _server(request.url)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Re-insert the entry to mark it as the most recently used
+                self._entries[key] = entry
+            generation = self._generation(server)
+
+        if entry is not None and entry.expires > time.time():
+            with self._lock:
+                self.hits += 1
+            return entry.response(request, connection)
+
+        if entry is not None and (entry.etag or entry.last_modified):
+            conditional = request.copy()
+            if entry.etag:
+                conditional.headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                conditional.headers['If-Modified-Since'] = entry.last_modified
+            response = send(conditional)
+            if response.status_code == 304:
+                response.close()
+                with self._lock:
+                    self.revalidations += 1
+                    entry.expires = time.time() + ttl
+                return entry.response(request, connection)
+        else:
+            response = send(request)
+
+        with self._lock:
+            self.misses += 1
+        if response.status_code == 200 and (not stream or self._small(response)):
+            self._store(key, server, generation, CacheEntry(response, time.time() + ttl))
+        return response
+
+    def _small(self, response):
+        """Whether a streamed response can be read into the cache without defeating the streaming"""
+        length = response.headers.get('Content-Length')
+        return length is not None and length.isdigit() and int(length) <= self.max_entry_size
+
+    def _store(self, key, server, generation, entry):
+        with self._lock:
+            # Don't cache a response that may predate a change made while it was in flight
+            if self._generation(server) != generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _generation(self, server):
+        # Changes every time the responses of a server are invalidated
+        return self._epoch, self._generations.get(server, 0)
+
+    def invalidate(self, url=None):
+        """Drop cached responses
+        :param url: drop the responses of urls starting with this prefix, or every response if not given
+        """
+        with self._lock:
+            if url is None:
+                keys = list(self._entries)
+                self._epoch += 1
+            else:
+                keys = [key for key in self._entries if key[0].startswith(url)]
+                server = _server(url)
+                self._generations[server] = self._generations.get(server, 0) + 1
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+        if keys:
+            LOG.debug("Invalidated %s cached responses of %s.", len(keys), url or 'every server')
+
+    def summary(self):
+        """Describe how well the cache performed"""
+        with self._lock:
+            lookups = self.hits + self.revalidations + self.misses
+            return {'entries': len(self._entries),
+                    'hits': self.hits,
+                    'revalidations': self.revalidations,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'hit_ratio': float(self.hits + self.revalidations) / lookups if lookups else 0.0}
+
+
+class CachingAdapter(BaseAdapter):
+    """A transport adapter that answers requests from a ResponseCache before handing them to another adapter"""
+
+    def __init__(self, adapter, cache):
+        """
+        :param adapter: the adapter that sends requests, usually the shared pooled adapter
+        :param cache: the ResponseCache
+        """
+        super(CachingAdapter, self).__init__()
+        self.adapter = adapter
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method not in SAFE_METHODS:
+            response = self.adapter.send(request, **kwargs)
+            if urlparse(request.url).path not in NON_MUTATING_PATHS:
+                self.cache.invalidate(_server(request.url) + '/')
+            return response
+        if request.method != 'GET':
+            return self.adapter.send(request, **kwargs)
+        return self.cache.fetch(request, lambda prepared: self.adapter.send(prepared, **kwargs), self,
+                                stream=kwargs.get('stream', False))
+
+    def close(self):
+        """The wrapped adapter is shared, so it is not closed"""
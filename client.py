@@ -0,0 +1,267 @@
+"""
+A shared, pooled HTTP client for the samples.
+
+Every session created through new_session() is mounted on the same transport adapter, so all of them share one
+connection pool per host. Connections are kept alive and re-used between requests and between sessions, which avoids
+paying for a new TCP connection and TLS handshake on every request when scripting against many arrays.
+
+The pools are configured from the optional keys of configuration.json (see base.Properties):
+
+    pool_hosts     the number of hosts to keep a connection pool for (default: 32)
+    pool_size      the number of connections to keep open to each host (default: 10)
+    timeout        the default [connect, read] timeout in seconds (default: [10, 300]), firmware uploads only use the
+                   connect timeout, see upload_timeout()
+    retries        the number of times an idempotent request is retried on connection errors and 502/503/504
+                   responses (default: 3). Probes and polls are never retried, see probe_session()
+    response_cache whether sessions answer read-mostly inventory requests from a shared ResponseCache, see cache.py
+                   (default: false)
+    cache_entries  the number of responses the shared cache keeps (default: 256)
+    tracing        whether sessions record the latency, size and retries of their requests in the shared Tracer, see
+                   tracing.py (default: true)
+
+pool_metrics() reports how many connections (and so TLS handshakes) were made, and how many requests re-used one.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from base import Properties
+from cache import DEFAULT_MAX_ENTRIES, CachingAdapter, ResponseCache
+from tracing import get_tracer, request_size, response_size, retry_count
+
+DEFAULT_POOL_HOSTS = 32
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (10, 300)
+DEFAULT_RETRIES = 3
+
+IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+_lock = threading.Lock()
+_adapter = None
+_probe_adapter = None
+_timeout = None
+_cache = None
+_tracing = True
+
+# The configuration keys of the pools, see get_adapter()
+SETTINGS = ('pool_hosts', 'pool_size', 'timeout', 'retries', 'response_cache', 'cache_entries', 'tracing')
+
+
+class PooledAdapter(HTTPAdapter):
+    """An HTTPAdapter that keeps count of the connections and requests made through its pools"""
+
+    def __init__(self, *args, **kwargs):
+        self._counter_lock = threading.Lock()
+        self._retired = {}
+        super(PooledAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        # Keep the counts of pools that are evicted, so that the totals stay accurate
+        pools = self.poolmanager.pools
+        dispose = pools.dispose_func
+
+        def retire(pool):
+            self._count(self._retired, pool)
+            if dispose is not None:
+                dispose(pool)
+
+        pools.dispose_func = retire
+
+    def _count(self, totals, pool):
+        key = '{}://{}:{}'.format(pool.scheme, pool.host, pool.port)
+        with self._counter_lock:
+            counts = totals.setdefault(key, {'connections': 0, 'requests': 0})
+            counts['connections'] += pool.num_connections
+            counts['requests'] += pool.num_requests
+
+    def close(self):
+        """The adapter is shared by every session; it is only closed by close_pools()"""
+
+    def metrics(self):
+        """Get the number of connections opened and requests made, per host"""
+        with self._counter_lock:
+            totals = dict((key, dict(counts)) for key, counts in self._retired.items())
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                self._count(totals, pool)
+        return totals
+
+
+class ClientSession(requests.Session):
+    """A Session that is mounted on the shared connection pools, applies a default timeout and traces its requests"""
+
+    def __init__(self, adapter, timeout=None, cache=None, tracer=None):
+        super(ClientSession, self).__init__()
+        self.timeout = timeout
+        self.cache = cache
+        self.tracer = tracer
+        if cache is not None:
+            adapter = CachingAdapter(adapter, cache)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.tracer is None:
+            return super(ClientSession, self).request(method, url, **kwargs)
+
+        start = time.time()
+        try:
+            response = super(ClientSession, self).request(method, url, **kwargs)
+        except Exception:
+            self.tracer.record_request(method.upper(), url, None, time.time() - start)
+            raise
+        self.tracer.record_request(method.upper(), url, response.status_code, time.time() - start,
+                                   sent=request_size(response.request),
+                                   received=response_size(response, stream=kwargs.get('stream', False)),
+                                   retries=retry_count(response), cached=response.raw is None)
+        return response
+
+
+def retry_policy(retries):
+    """Retry idempotent requests on connection errors and RETRY_STATUSES
+    :param retries: the number of times a request is retried
+    :return: the urllib3 Retry
+    """
+    kwargs = dict(total=retries, connect=retries, read=retries, status=retries, backoff_factor=0.5,
+                  status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    try:
+        return Retry(allowed_methods=IDEMPOTENT_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 before 1.26 only knows the option as method_whitelist, which 2.0 removed
+        return Retry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
+
+
+def _configure(settings):
+    global _adapter, _probe_adapter, _timeout, _cache, _tracing
+    retries = settings['retries'] if settings['retries'] is not None else DEFAULT_RETRIES
+    retry = retry_policy(retries)
+    _adapter = PooledAdapter(pool_connections=settings['pool_hosts'] or DEFAULT_POOL_HOSTS,
+                             pool_maxsize=settings['pool_size'] or DEFAULT_POOL_SIZE, max_retries=retry)
+    _probe_adapter = PooledAdapter(pool_connections=settings['pool_hosts'] or DEFAULT_POOL_HOSTS,
+                                   pool_maxsize=settings['pool_size'] or DEFAULT_POOL_SIZE, max_retries=0)
+    _timeout = tuple(settings['timeout']) if settings['timeout'] is not None else DEFAULT_TIMEOUT
+    _cache = ResponseCache(max_entries=settings['cache_entries'] or DEFAULT_MAX_ENTRIES) \
+        if settings['response_cache'] else None
+    _tracing = settings['tracing'] is None or bool(settings['tracing'])
+
+
+def get_adapter(props=None, **settings):
+    """Get the transport adapter shared by every session, creating it on first use
+    :param props: the Properties to configure the pools from, configuration.json is used by default
+    :param settings: settings that take precedence over the Properties when the pools are created, see SETTINGS
+    """
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise TypeError('Unknown settings: {}'.format(', '.join(sorted(unknown))))
+    with _lock:
+        if _adapter is None:
+            props = props or Properties()
+            _configure(dict((key, settings[key] if key in settings else props[key]) for key in SETTINGS))
+        return _adapter
+
+
+def new_session(auth=None, verify=None, headers=None, timeout=None, props=None, cache=None, tracer=None):
+    """Define a re-usable Session object on the shared connection pools
+    :param auth: optional credentials for Basic-Authentication, or a requests AuthBase
+    :param verify: whether to verify TLS certificates, requests' default is used if not given
+    :param headers: optional headers to send with every request
+    :param timeout: the default timeout of the session's requests, the configured timeout is used if not given
+    :param props: the Properties to configure the pools from, if they don't exist yet
+    :param cache: a ResponseCache to answer requests from, True for the shared cache, or False for none. The shared
+     cache is used if it is enabled in the configuration (response_cache) and no cache is given
+    :param tracer: a Tracer to record the requests in, or False for none. The shared tracer is used if tracing is
+     enabled in the configuration and no tracer is given
+    :return: a new session
+    """
+    adapter = get_adapter(props)
+    if cache is None or cache is True:
+        cache = get_cache(create=cache is True)
+    if tracer is None:
+        tracer = get_tracer() if _tracing else None
+    session = ClientSession(adapter, timeout=timeout if timeout is not None else _timeout, cache=cache or None,
+                            tracer=tracer or None)
+    if auth is not None:
+        session.auth = auth
+    if verify is not None:
+        session.verify = verify
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def probe_session(session):
+    """Get a session that makes its requests like another session, but never retries them
+    A probe or poll is retried by its own backoff, so every attempt should be a single request bounded by its timeout.
+    Retrying it in the transport as well would stretch a short probe timeout, and multiply the requests of a poll.
+    :param session: the session whose auth, headers, cookies and TLS verification are shared
+    :return: a new session on the shared pools of probes
+    """
+    get_adapter()
+    probe = ClientSession(_probe_adapter, timeout=getattr(session, 'timeout', None) or _timeout,
+                          tracer=getattr(session, 'tracer', None))
+    probe.auth = session.auth
+    probe.verify = session.verify
+    probe.headers = session.headers
+    probe.cookies = session.cookies
+    return probe
+
+
+def upload_timeout():
+    """Get the timeout of a firmware upload: the configured connect timeout, without a read timeout
+    The controllers only answer an upload once they have processed the firmware, which can take longer than the read
+    timeout, and giving up on the response wouldn't stop the upgrade.
+    """
+    get_adapter()
+    return _timeout[0], None
+
+
+def get_cache(create=False):
+    """Get the ResponseCache shared by every session
+    :param create: create the shared cache, even if it isn't enabled in the configuration
+    :return: the cache, or None if it isn't enabled
+    """
+    global _cache
+    get_adapter()
+    with _lock:
+        if _cache is None and create:
+            _cache = ResponseCache()
+        return _cache
+
+
+def pool_metrics():
+    """Describe how well connections have been re-used
+    :return: the connections opened and requests made per host and in total, with the number of TLS handshakes
+     (connections made to https hosts) and the fraction of requests that re-used an open connection
+    """
+    hosts = get_adapter().metrics()
+    for key, counts in _probe_adapter.metrics().items():
+        totals = hosts.setdefault(key, {'connections': 0, 'requests': 0})
+        totals['connections'] += counts['connections']
+        totals['requests'] += counts['requests']
+    connections = sum(counts['connections'] for counts in hosts.values())
+    requests_made = sum(counts['requests'] for counts in hosts.values())
+    handshakes = sum(counts['connections'] for key, counts in hosts.items() if key.startswith('https://'))
+    return {'hosts': hosts,
+            'connections': connections,
+            'requests': requests_made,
+            'handshakes': handshakes,
+            'reuse_ratio': 1 - float(connections) / requests_made if requests_made else 0.0}
+
+
+def close_pools():
+    """Close every pooled connection"""
+    global _adapter, _probe_adapter, _cache
+    with _lock:
+        if _adapter is not None:
+            _adapter.poolmanager.clear()
+            _probe_adapter.poolmanager.clear()
+            _adapter = _probe_adapter = None
+            _cache = None
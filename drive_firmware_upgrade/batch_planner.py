@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+Plan a drive firmware upgrade of one storage-system as a series of batches, and run the batches one after another.
+
+Usage:
+  batch_planner <firmware_file> <address> [--system-id=<id>] [--by=<grouping>] [--batch-size=<n>] [--per-group=<n>]
+      [--username=<name>] [--password=<password>] [--dry-run] [--trace=<file>]
+  batch_planner -h
+Arguments:
+  firmware_file  Path to the drive firmware (.dlp) file
+  address        The address of the Web Services instance, e.g. https://proxy.example.com:8443
+Options:
+  -h --help              Show this screen.
+  --system-id=<id>       The id of the storage-system [default: 1]
+  --by=<grouping>        Group the drives by 'tray' or by 'volume-group' [default: tray]
+  --batch-size=<n>       The maximum number of drives in a batch [default: 24]
+  --per-group=<n>        The maximum number of drives of the same group in a batch, each batch holds the drives of a
+                         single group if it isn't given
+  --username=<name>      The username, configuration.json is used by default
+  --password=<password>  The password, configuration.json is used by default
+  --dry-run              Only upload the file and print the plan, without upgrading any drive
+  --trace=<file>         Write the latency of every API endpoint and the timing of every phase to this file, in the
+                         Prometheus text format if its name ends in .prom and as JSON otherwise
+
+Description:
+    drive_firmware_upgrade() sends every compatible drive in a single initiate-upgrade call. On a large array the
+     download then runs for hours, with no partial progress, and the whole array is busy with it.
+
+    The planner selects the drives to upgrade with fw_compatible_drives() (so only optimal, compatible drives are
+     upgraded) and splits them into batches of at most --batch-size drives. The drives are grouped either by the tray
+     that holds them, or by their volume group. By default each batch holds the drives of one tray. With
+     '--by=volume-group --per-group=1' each batch holds at most one drive of every volume group, so no volume group
+     has more than one drive downloading firmware at a time.
+
+    The batches are pipelined: the next batch is initiated as soon as the previous one leaves downloadInProgress.
+     If a batch doesn't complete, the remaining batches are not started.
+
+    The duration of every batch is reported, along with the drives upgraded per minute, so that the batch size can be
+     tuned for throughput.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+
+import docopt
+
+from base import Properties, get_system_session
+from drive_firmware_upgrade.drive_firmware_upgrade import API, fw_compatible_drives, initiate_drive_upgrade, \
+    upload_drive_firmware, wait_for_drive_upgrade
+from firmware_cache import FirmwareCache
+from firmware_verify import require_valid_images
+from json_stream import iter_json
+from tracing import get_tracer, phase
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 24
+
+
+def tray_of(drive):
+    """The tray that holds a drive"""
+    return (drive.get('physicalLocation') or {}).get('trayRef') or 'unknown'
+
+
+def volume_group_of(drive):
+    """The volume group (or disk pool) a drive belongs to"""
+    return drive.get('currentVolumeGroupRef') or 'unassigned'
+
+
+GROUPINGS = {'tray': tray_of, 'volume-group': volume_group_of}
+
+
+def group_drives(drives, drive_refs, by='tray'):
+    """Group the drives to upgrade
+    :param drives: the drive objects of the array
+    :param drive_refs: the driveRefs of the drives to upgrade
+    :param by: the name of a grouping, see GROUPINGS
+    :return: an OrderedDict of group to the driveRefs of its drives, in drive order
+    """
+    if by not in GROUPINGS:
+        raise ValueError("Unknown grouping '{}', choose from {}.".format(by, ', '.join(sorted(GROUPINGS))))
+    key = GROUPINGS[by]
+    wanted = set(drive_refs)
+    groups = OrderedDict()
+    for drive in drives:
+        if drive['driveRef'] in wanted:
+            groups.setdefault(key(drive), []).append(drive['driveRef'])
+            wanted.discard(drive['driveRef'])
+    if wanted:
+        # The array didn't describe these drives, upgrade them last rather than not at all
+        groups.setdefault('unknown', []).extend(ref for ref in drive_refs if ref in wanted)
+    return groups
+
+
+def plan_batches(drives, drive_refs, by='tray', batch_size=DEFAULT_BATCH_SIZE, per_group=None):
+    """Split the drives to upgrade into batches
+    :param drives: the drive objects of the array
+    :param drive_refs: the driveRefs of the drives to upgrade
+    :param by: the name of a grouping, see GROUPINGS
+    :param batch_size: the maximum number of drives in a batch
+    :param per_group: the maximum number of drives of the same group in a batch. If it isn't given, each batch holds
+     the drives of a single group
+    :return: a list of batches, each a dict of its number, groups and driveRefs
+    """
+    if batch_size < 1 or (per_group is not None and per_group < 1):
+        raise ValueError("The batch size and drives per group must be positive.")
+    groups = group_drives(drives, drive_refs, by=by)
+    batches = []
+
+    def add(members):
+        batches.append({'batch': len(batches) + 1,
+                        'groups': list(OrderedDict((group, None) for group, _ in members)),
+                        'drives': [ref for _, ref in members]})
+
+    if per_group is None:
+        for group, refs in groups.items():
+            for offset in range(0, len(refs), batch_size):
+                add([(group, ref) for ref in refs[offset:offset + batch_size]])
+        return batches
+
+    # Take a few drives of every group in turn, so that no group has more than per_group drives in a batch. Each batch
+    # carries on from the group after the last one served, so that the groups at the end aren't left to the last batches
+    remaining = OrderedDict((group, list(refs)) for group, refs in groups.items())
+    rotation = deque(remaining)
+    while rotation:
+        members = []
+        for _ in range(len(rotation)):
+            group = rotation.popleft()
+            take = min(per_group, batch_size - len(members))
+            members.extend((group, ref) for ref in remaining[group][:take])
+            del remaining[group][:take]
+            if remaining[group]:
+                rotation.append(group)
+            if len(members) == batch_size:
+                break
+        add(members)
+    return batches
+
+
+def plan_drive_upgrade(session, api, filename, by='tray', batch_size=DEFAULT_BATCH_SIZE, per_group=None,
+                       system_id='1'):
+    """Plan the batches of a drive firmware upgrade, the firmware file must already be uploaded
+
+    :param session: client for which we use to get the drives
+    :param api: urls
+    :param filename: the filename of the firmware
+    :param by: the name of a grouping, see GROUPINGS
+    :param batch_size: the maximum number of drives in a batch
+    :param per_group: the maximum number of drives of the same group in a batch
+    :param system_id: the id of the storage-system
+    :return: a list of batches, see plan_batches()
+    """
+    # The drives are fetched once, both to check their compatibility and to group them
+    ret = session.get(api.get('drives').format(systemId=system_id), stream=True)
+    ret.raise_for_status()
+    drives = list(iter_json(ret))
+    drive_refs = fw_compatible_drives(session, api, filename, drives, system_id=system_id)
+    batches = plan_batches(drives, drive_refs, by=by, batch_size=batch_size, per_group=per_group)
+    LOG.info("Planned %s drives in %s batches by %s.", len(drive_refs), len(batches), by)
+    return batches
+
+
+def run_batches(session, api, filename, batches, system_id='1', scheduler=None):
+    """Upgrade the drives a batch at a time, initiating each batch as soon as the previous one has finished
+
+    :param session: client for which we use to initiate the upgrade
+    :param api: urls
+    :param filename: the filename of the uploaded firmware
+    :param batches: the batches from plan_drive_upgrade()
+    :param system_id: the id of the storage-system
+    :param scheduler: an optional PollScheduler to poll the state from, instead of the calling thread
+    :return: a list of batch reports, with the time each step of every batch took and its final status
+    """
+    reports = []
+    stopped = False
+    for batch in batches:
+        report = {'batch': batch['batch'], 'groups': batch['groups'], 'drives': len(batch['drives']),
+                  'status': 'not started', 'initiate': 0.0, 'wait': 0.0, 'seconds': 0.0}
+        reports.append(report)
+        if stopped:
+            continue
+
+        subject = '{} batch {}'.format(system_id, batch['batch'])
+        start = time.time()
+        with phase('initiate', subject=subject):
+            initiate_drive_upgrade(session, api, filename, batch['drives'], system_id=system_id)
+        report['initiate'] = time.time() - start
+        with phase('wait', subject=subject):
+            state = wait_for_drive_upgrade(session, api, system_id=system_id, scheduler=scheduler)
+        report['seconds'] = time.time() - start
+        report['wait'] = report['seconds'] - report['initiate']
+        report['status'] = state['overallStatus']
+        LOG.info("Batch %s/%s: %s drives %s in %.1fs.", batch['batch'], len(batches), report['drives'],
+                 report['status'], report['seconds'])
+        if report['status'] != 'complete':
+            stopped = True
+            LOG.error("Batch %s ended as '%s', the remaining batches will not be started.", batch['batch'],
+                      report['status'])
+    return reports
+
+
+def summarize_batches(reports):
+    """Describe the throughput of the batches
+    :param reports: the batch reports from run_batches()
+    :return: a summary dictionary
+    """
+    completed = [report for report in reports if report['status'] == 'complete']
+    seconds = sum(report['seconds'] for report in reports)
+    drives = sum(report['drives'] for report in completed)
+    durations = [report['seconds'] for report in completed]
+    return {'batches': len(reports),
+            'completed': len(completed),
+            'drives': drives,
+            'seconds': seconds,
+            'mean_batch_seconds': sum(durations) / len(durations) if durations else 0.0,
+            'max_batch_seconds': max(durations) if durations else 0.0,
+            'drives_per_minute': 60 * drives / seconds if seconds else 0.0}
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    props = Properties()
+    system_id = args.get('--system-id')
+    api = {key: args.get('<address>') + API[key] for key in API}
+    session = get_system_session({'username': args.get('--username') or props.username,
+                                  'password': args.get('--password') or props.password})
+    filename = args.get('<firmware_file>')
+    per_group = int(args.get('--per-group')) if args.get('--per-group') else None
+
+    cache = FirmwareCache()
+    try:
+        with phase('verify', subject=filename):
+            require_valid_images([filename], cache=cache)
+        # The compatibilities only list the files the Web Services instance holds
+        upload_drive_firmware(session, api, filename, cache=cache)
+        batches = plan_drive_upgrade(session, api, filename, by=args.get('--by'),
+                                     batch_size=int(args.get('--batch-size')), per_group=per_group,
+                                     system_id=system_id)
+        for batch in batches:
+            LOG.info("Batch %s: %s drives of %s", batch['batch'], len(batch['drives']), ', '.join(batch['groups']))
+        if args.get('--dry-run') or not batches:
+            return
+
+        reports = run_batches(session, api, filename, batches, system_id=system_id)
+    finally:
+        session.close()
+
+    print('{:>6} {:>7} {:>12} {:>10} {:>9}  {}'.format('batch', 'drives', 'status', 'initiate s', 'wait s', 'groups'))
+    for report in reports:
+        print('{:>6} {:>7} {:>12} {:>10.1f} {:>9.1f}  {}'.format(report['batch'], report['drives'], report['status'],
+                                                                  report['initiate'], report['wait'],
+                                                                  ', '.join(report['groups'])))
+    LOG.info("Batch summary: %s", json.dumps(summarize_batches(reports), indent=2, sort_keys=True))
+    if args.get('--trace'):
+        get_tracer().export(args.get('--trace'))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    main()
@@ -0,0 +1,115 @@
+"""
+A durable journal of the progress of drive firmware upgrades, so that an interrupted upgrade can be resumed.
+
+Each step of an upgrade is appended to the journal as a line of JSON, and written to disk before the upgrade moves
+on. The steps are: the firmware file was uploaded, the download to the drives was initiated, the state is being
+polled, and the upgrade is done. When the tool is restarted, the last step recorded for a storage-system tells it
+where to resume. A file that was uploaded is not uploaded again. A download that was initiated is not initiated
+again; instead we re-attach to it by polling the state endpoint.
+
+An upgrade is identified by the storage-system and the SHA-256 of the firmware file, so upgrading to a different file
+starts from the beginning.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+JOURNAL_FILE = os.path.join(os.path.expanduser('~'), '.santricity', 'drive_upgrades.journal')
+
+# The steps of an upgrade, in order
+STEPS = ('uploaded', 'initiated', 'polling', 'done')
+
+
+def system_key(api, system_id='1'):
+    """Identify a storage-system by the url of its drive firmware state"""
+    return api.get('firmware_drives_state').format(systemId=system_id)
+
+
+class CheckpointJournal(object):
+    """An append-only record of the last step reached by each upgrade"""
+
+    def __init__(self, journal_file=None):
+        """
+        :param journal_file: path to the journal, JOURNAL_FILE by default. An existing journal is loaded and compacted
+         to the last step of each upgrade.
+        """
+        self.journal_file = journal_file or JOURNAL_FILE
+        self._lock = threading.Lock()
+        self.checkpoints = {}
+        if os.path.exists(self.journal_file):
+            self._load()
+            self._compact()
+        directory = os.path.dirname(self.journal_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._fp = open(self.journal_file, 'a')
+
+    def _load(self):
+        with open(self.journal_file) as fp:
+            for number, line in enumerate(fp, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The process died while writing this line, the step it describes was not completed
+                    LOG.warn("Ignoring the incomplete line %s of %s.", number, self.journal_file)
+                    continue
+                self.checkpoints[(record['system'], record['operation'])] = record
+
+    def _compact(self):
+        """Rewrite the journal with only the last step of each upgrade, replacing the previous file atomically"""
+        tmp_file = self.journal_file + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            for key in sorted(self.checkpoints):
+                fp.write(json.dumps(self.checkpoints[key], sort_keys=True) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_file, self.journal_file)
+
+    def last(self, system, operation):
+        """Get the last step recorded for an upgrade
+        :param system: the storage-system, see system_key()
+        :param operation: the SHA-256 of the firmware file
+        :return: the checkpoint record, or None if the upgrade was never started
+        """
+        with self._lock:
+            return self.checkpoints.get((system, operation))
+
+    def record(self, system, operation, step, **details):
+        """Durably record that an upgrade reached a step, before the upgrade moves on
+        :param system: the storage-system, see system_key()
+        :param operation: the SHA-256 of the firmware file
+        :param step: one of STEPS
+        :param details: additional attributes to store with the step, those of the previous step are kept
+        :return: the checkpoint record
+        """
+        if step not in STEPS:
+            raise ValueError("Unknown step [{}].".format(step))
+        with self._lock:
+            record = dict(self.checkpoints.get((system, operation)) or {})
+            record.update(details)
+            record.update({'system': system, 'operation': operation, 'step': step, 'time': time.time()})
+            self._fp.write(json.dumps(record, sort_keys=True) + '\n')
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self.checkpoints[(system, operation)] = record
+        LOG.debug("Checkpoint %s: %s", step, system)
+        return record
+
+    def pending(self):
+        """Get the upgrades that were started but never recorded as done"""
+        with self._lock:
+            return [record for record in self.checkpoints.values() if record['step'] != 'done']
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,14 +3,25 @@
 """
 Demonstrate a drive firmware upgrade using the Embedded Web Services API or Web Services Proxy
 """
+from __future__ import absolute_import
 
 import logging
+import os
 import time
 from pprint import pformat
 
-import requests
 import urllib3
 
+from authentication.session_manager import session_auth
+from client import new_session, probe_session, upload_timeout
+from drive_firmware_upgrade.checkpoint import CheckpointJournal, system_key
+from firmware_cache import FirmwareCache, file_digest
+from firmware_verify import require_valid_images
+from json_stream import iter_json
+from poller import Backoff, poll
+from streaming_upload import log_progress, upload_file
+from tracing import get_tracer, phase
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 LOG = logging.getLogger(__name__)
 
@@ -27,14 +38,16 @@ controller_addresses = ["https://example-b.ict.englab.netapp.com:8443",
 auth = ('admin', 'admin')
 
 
+# Log in once and re-use the session (JSESSIONID) instead of sending Basic-Auth with every request
+USE_SESSION_LOGIN = True
+
 # End Configurable Parameters
 
 def get_session():
     """Define a re-usable Session object"""
-    session = requests.Session()
-    session.auth = auth
-    session.verify = False
-    return session
+    if USE_SESSION_LOGIN:
+        return new_session(auth=session_auth(auth[0], auth[1], verify=False), verify=False)
+    return new_session(auth=auth, verify=False)
 
 
 API = {
@@ -46,123 +59,361 @@ API = {
     'firmware_drives_state': '/devmgr/v2/storage-systems/{systemId}/firmware/drives/state'
 }
 
+# Drive firmware downloads take minutes, so back off from polling every 2s to every 30s
+DRIVE_STATE_BACKOFF = Backoff(initial=2, factor=1.5, maximum=30)
+
 
-def optimal_drives(rest_client, api, drives=None):
+def optimal_drives(rest_client, api, drives=None, system_id='1'):
     """Returns a list of all optimal drives from the array.
 
     :param rest_client: the rest client for which we pull the drives
     :param api: urls
     :param drives: an optional list of drive objects we want to check optimal status with.
+    :param system_id: the id of the storage-system
     :returns: A list of optimal drive IDs from the array's rest client
     """
-    """
-    """
     drives_ref_list = []
 
     if not drives:
-        drives_ret = rest_client.get(api.get('drives').format(systemId='1'))
+        # Parse the drives one at a time, rather than holding the whole list in memory
+        drives_ret = rest_client.get(api.get('drives').format(systemId=system_id), stream=True)
         drives_ret.raise_for_status()
-        drives = drives_ret.json()
-
-    if isinstance(drives, dict):
-        if drives['status'] == 'optimal':
-            drives_ref_list.append(drives['driveRef'])
-            LOG.debug("Drive id:{} is optimal.".format(drives['id']))
+        drives = iter_json(drives_ret)
+    elif isinstance(drives, dict):
+        drives = [drives]
+
+    for drive in drives:
+        if drive['status'] == 'optimal':
+            drives_ref_list.append(drive['driveRef'])
+            LOG.debug("Drive id:%s is optimal.", drive['id'])
         else:
-            LOG.debug("Drive id:{} is not optimal.".format(drives['id']))
-
-    if isinstance(drives, list):
-        for drive in drives:
-            if drive['status'] == 'optimal':
-                drives_ref_list.append(drive['driveRef'])
-                LOG.debug("Drive id:{} is optimal.".format(drive['id']))
-            else:
-                LOG.debug("Drive id:{} is not optimal.".format(drive['id']))
+            LOG.debug("Drive id:%s is not optimal.", drive['id'])
 
     return drives_ref_list
 
 
-def drive_firmware_upgrade(session, api, filename, drives=None):
-    """Function to upgrade drive firmware
+def drive_file_info(session, api, name):
+    """Get the details of a drive firmware file already held by the Web Services instance
+
+    :param session: client for which we use to check the file
+    :param api: urls
+    :param name: the name of the firmware file
+    :return: the file details, or None if there is no such file
+    """
+    ret = session.get(api.get('drive_files').format(filename=name))
+    if ret.status_code == 404:
+        return None
+    ret.raise_for_status()
+    return ret.json()
+
+
+def upload_drive_firmware(session, api, filename, cache=None):
+    """Upload a drive firmware file to the Web Services instance
+
+    :param session: client for which we use to upload the file
+    :param api: urls
+    :param filename: path to the firmware file
+    :param cache: an optional FirmwareCache used to skip uploading a file the target already holds
+    :return: rest response, or None if the upload was skipped
+    """
+    target = api.get('drive_file_upload')
+    name = os.path.basename(filename)
+    size = os.path.getsize(filename)
+    digest = None
+
+    if cache is not None:
+        digest = cache.digest(filename)
+        if cache.holds(target, name, digest):
+            info = drive_file_info(session, api, name)
+            if info is not None and info.get('fileSize', size) == size:
+                LOG.info("Firmware file {} is already present on {}, skipping the upload.".format(name, target))
+                cache.record_skip(size)
+                return None
+
+    # stream the file rather than building the multipart body in memory
+    start = time.time()
+    ret = upload_file(session, target, 'file', filename, progress=log_progress, timeout=upload_timeout())
+    ret.raise_for_status()
+
+    if cache is not None:
+        cache.record_upload(target, name, digest, size, time.time() - start)
+    return ret
+
+
+def initiate_drive_upgrade(session, api, filename, drive_refs, system_id='1'):
+    """Start the firmware download to a list of drives
 
     :param session: client for which we use to initiate the upgrade
     :param api: urls
-    :param filename: firmware filename
-    :param drives: optional list of drives we want to specifically upgrade
+    :param filename: the filename of the uploaded firmware
+    :param drive_refs: the driveRefs of the drives to upgrade
+    :param system_id: the id of the storage-system
     :return: rest response
     """
-    with open(filename, 'rb') as firmware_file:
+    LOG.debug("Updating compatible drives...")
+    response = session.post(api.get('firmware_drives_initiate_upgrade').format(systemId=system_id),
+                            json={'filename': os.path.basename(filename),
+                                  'driveRefList': drive_refs})
+    response.raise_for_status()
+    return response
 
-        # upload the fw file to the controller
-        file_multipart = {
-            'file': firmware_file
-        }
-        ret = session.post(api.get('drive_file_upload'), files=file_multipart)
-        ret.raise_for_status()
+
+def drive_upgrade_state(session, api, system_id='1'):
+    """Get the state of the drive firmware download
+
+    :param session: client for which we use to check the upgrade state
+    :param api: urls
+    :param system_id: the id of the storage-system
+    :return: the upgrade state
+    """
+    ret = session.get(api.get('firmware_drives_state').format(systemId=system_id))
+    ret.raise_for_status()
+    return ret.json()
+
+
+def wait_for_drive_upgrade(session, api, system_id='1', scheduler=None):
+    """Wait until all drives are finished downloading
+
+    :param session: client for which we use to check the upgrade state
+    :param api: urls
+    :param system_id: the id of the storage-system
+    :param scheduler: an optional PollScheduler to poll the state from, instead of the calling thread
+    :return: the final upgrade state
+    """
+    state_url = api.get('firmware_drives_state').format(systemId=system_id)
+    # The poll retries on its own schedule, so each probe is a single request
+    poll_session = probe_session(session)
+
+    def probe():
+        return drive_upgrade_state(poll_session, api, system_id=system_id)
+
+    def is_done(state):
+        return state['overallStatus'] != 'downloadInProgress'
+
+    name = 'drive firmware download on {}'.format(state_url)
+    if scheduler is not None:
+        return scheduler.submit(name, probe, is_done, backoff=DRIVE_STATE_BACKOFF).result()
+    return poll(probe, is_done, backoff=DRIVE_STATE_BACKOFF, name=name)
+
+
+def resume_step(session, api, journal, operation, system_id='1'):
+    """Find the step an interrupted upgrade had reached
+
+    :param session: client for which we use to check the upgrade state
+    :param api: urls
+    :param journal: the CheckpointJournal of the upgrades
+    :param operation: the SHA-256 of the firmware file
+    :param system_id: the id of the storage-system
+    :return: the last step that was completed (see checkpoint.STEPS), or None to start from the beginning
+    """
+    checkpoint = journal.last(system_key(api, system_id), operation)
+    if checkpoint is None:
+        return None
+    step = checkpoint['step']
+    if step == 'done' and checkpoint.get('status') not in ('complete', 'skipped'):
+        # The upgrade finished but failed, so try again
+        return None
+    if step == 'uploaded' and drive_upgrade_state(session, api, system_id)['overallStatus'] == 'downloadInProgress':
+        # The process died after initiating the download, but before it could record it
+        step = 'initiated'
+    if step != 'done':
+        LOG.info("Resuming the drive firmware upgrade of %s after the '%s' step.", checkpoint['system'], step)
+    return step
+
+
+def run_upgrade_steps(session, api, filename, upload, drives=None, system_id='1', journal=None, operation=None,
+                      timed=None, scheduler=None):
+    """Run the steps of a drive firmware upgrade that haven't been completed yet
+
+    :param session: client for which we use to initiate the upgrade
+    :param api: urls
+    :param filename: firmware filename
+    :param upload: a callable that uploads the firmware file, its return value is kept in the outcome
+    :param drives: optional list of drives we want to specifically upgrade
+    :param system_id: the id of the storage-system
+    :param journal: an optional CheckpointJournal, each step is recorded in it and an interrupted upgrade resumes
+     from the last step it recorded
+    :param operation: the SHA-256 of the firmware file, which identifies the upgrade in the journal
+    :param timed: an optional callable of the name of a step, returning the context manager the step runs in. Each
+     step is traced as a phase of the storage-system by default
+    :param scheduler: an optional PollScheduler to poll the state from, instead of the calling thread
+    :return: the outcome, a dict of the step it 'resumed_after', the 'uploaded' return value of the upload, the
+     'drives' being upgraded, the initiate-upgrade 'response' and the final 'status'. The status is 'skipped' if the
+     upgrade was already done or no drive is compatible, and the overallStatus of the download otherwise
+    """
+    timed = timed or (lambda step: phase(step, subject=system_id))
+    outcome = {'resumed_after': None, 'uploaded': None, 'drives': [], 'response': None, 'status': 'skipped'}
+    if journal is not None:
+        outcome['resumed_after'] = resume_step(session, api, journal, operation, system_id=system_id)
+    step = outcome['resumed_after']
+
+    def checkpoint(reached, **details):
+        if journal is not None:
+            journal.record(system_key(api, system_id), operation, reached, file=os.path.basename(filename),
+                           **details)
+
+    if step == 'done':
+        LOG.info("The drive firmware upgrade of %s to %s is already done.", system_key(api, system_id),
+                 os.path.basename(filename))
+        return outcome
+
+    if step not in ('initiated', 'polling'):
+        if step != 'uploaded':
+            # upload the fw file to the controller
+            with timed('upload'):
+                outcome['uploaded'] = upload()
+            checkpoint('uploaded')
 
         # Upgrade all compatible drives
-        if drives is None:
-            compatible_drives = fw_compatible_drives(session, api, filename)
-        else:
-            compatible_drives = fw_compatible_drives(session, api, filename, drives)
+        with timed('compatibility'):
+            outcome['drives'] = fw_compatible_drives(session, api, filename, drives, system_id=system_id)
 
         # Update all drives
-        if len(compatible_drives) is not 0:
-            LOG.debug("Updating compatible drives...")
-            response = session.post(api.get('firmware_drives_initiate_upgrade').format(systemId='1'),
-                                    json={'filename': filename,
-                                          'driveRefList': compatible_drives})
-
-            # Wait until all drives are finished downloading
-            while session.get(api.get('firmware_drives_state').format(systemId='1')).json()['overallStatus'] \
-                    == 'downloadInProgress':
-                time.sleep(2)
-            LOG.debug('Drive firmware was updated successfully!')
-        else:
+        if not outcome['drives']:
             LOG.debug("Chosen firmware was not compatible with any drives in this array.")
-            return None
-        return response
+            checkpoint('done', status='skipped')
+            return outcome
+
+        with timed('initiate'):
+            outcome['response'] = initiate_drive_upgrade(session, api, filename, outcome['drives'],
+                                                         system_id=system_id)
+        checkpoint('initiated', drives=outcome['drives'])
+    else:
+        LOG.info("Re-attaching to the drive firmware download initiated earlier on %s.", system_key(api, system_id))
+        outcome['drives'] = journal.last(system_key(api, system_id), operation).get('drives', [])
 
+    checkpoint('polling')
+    with timed('wait'):
+        state = wait_for_drive_upgrade(session, api, system_id=system_id, scheduler=scheduler)
+    checkpoint('done', status=state['overallStatus'])
+    outcome['status'] = state['overallStatus']
+    return outcome
 
-def fw_compatible_drives(rest_client, api, filename, drives=None):
-    """Runs a check of drives in the array for compatibility with firmware.
+
+def drive_firmware_upgrade(session, api, filename, drives=None, system_id='1', cache=None, journal=None):
+    """Function to upgrade drive firmware
+
+    :param session: client for which we use to initiate the upgrade
+    :param api: urls
+    :param filename: firmware filename
+    :param drives: optional list of drives we want to specifically upgrade
+    :param system_id: the id of the storage-system
+    :param cache: an optional FirmwareCache used to avoid re-uploading the firmware file
+    :param journal: an optional CheckpointJournal, each step is recorded in it and an interrupted upgrade resumes
+     from the last step it recorded
+    :return: rest response, or None if nothing was initiated
+    """
+    operation = None
+    if journal is not None:
+        operation = cache.digest(filename) if cache is not None else file_digest(filename)
+
+    def upload():
+        return upload_drive_firmware(session, api, filename, cache=cache)
+
+    outcome = run_upgrade_steps(session, api, filename, upload, drives=drives, system_id=system_id, journal=journal,
+                                operation=operation)
+    if outcome['status'] == 'complete':
+        LOG.debug('Drive firmware was updated successfully!')
+    return outcome['response']
+
+
+def get_compatibilities(rest_client, api, system_id='1'):
+    """Get the drive firmware compatibilities of the array.
+
+    :param rest_client: rest_client for which we use to get the compatibilities.
+    :param api: urls
+    :param system_id: the id of the storage-system
+    :return: a list of firmware compatibility entries.
+    """
+    ret = rest_client.get(api.get('compatibilities').format(systemId=system_id))
+    ret.raise_for_status()
+    return ret.json()['compatibilities']
+
+
+def compatibility_index(compatibilities):
+    """Index firmware compatibilities by firmware filename.
+
+    :param compatibilities: the compatibilities as returned by the array
+    :return: a dict of firmware filename to the set of compatible driveRefs.
+    """
+    index = {}
+    for firmware in compatibilities:
+        drive_refs = index.setdefault(firmware['filename'], set())
+        drive_refs.update(compatible_drive['driveRef'] for compatible_drive in firmware['compatibleDrives'])
+    return index
+
+
+def resolve_compatible_drives(index, drive_refs, filenames):
+    """Resolve several firmware files against a list of drives in one pass.
+
+    :param index: a compatibility index from compatibility_index()
+    :param drive_refs: the driveRefs that are candidates for the upgrade
+    :param filenames: the firmware filenames to resolve
+    :return: a dict of filename to the list of compatible driveRefs, in drive order and without duplicates.
+    """
+    # The array only knows the firmware by the name it was uploaded with
+    targets = [(filename, index.get(os.path.basename(filename), frozenset())) for filename in filenames]
+    resolved = dict((filename, []) for filename in filenames)
+
+    seen = set()
+    for drive in drive_refs:
+        if drive in seen:
+            continue
+        seen.add(drive)
+        for filename, compatible in targets:
+            if drive in compatible:
+                resolved[filename].append(drive)
+            else:
+                LOG.debug("Drive ref %s was not compatible with %s.", drive, filename)
+    return resolved
+
+
+def fw_compatible_drives_batch(rest_client, api, filenames, drives=None, system_id='1'):
+    """Runs a check of drives in the array for compatibility with several firmware files.
+
+    The drives and compatibilities are only fetched once, however many files are checked.
 
     :param rest_client: rest_client for which we use to get the drives.
     :param api: urls
+    :param filenames: the filenames of the firmware to check compatibility.
     :param drives: drives for which we want to check the compatibility with.
-    :param filename: the filename of the firmware to check compatibility.
-    :return: a list of compatible drives to upgrade.
+    :param system_id: the id of the storage-system
+    :return: a dict of filename to the list of compatible drives to upgrade.
     """
     LOG.debug('Checking drive compatibility...')
     # we do not want to upgrade non-optimal drives
-    if drives is None:
-        drives = optimal_drives(rest_client, api)
-    else:
-        drives = optimal_drives(rest_client, api, drives)
+    drives = optimal_drives(rest_client, api, drives, system_id=system_id)
+    index = compatibility_index(get_compatibilities(rest_client, api, system_id=system_id))
+    return resolve_compatible_drives(index, drives, filenames)
 
-    comp_drives = []
-    compatibilities = rest_client.get(api.get('compatibilities').format(systemId='1')).json()['compatibilities']
-    for firmware in compatibilities:
-        compatible = firmware['compatibleDrives']
-        if filename == firmware['filename']:
-            for drive in drives:
-                for compatible_drive in compatible:
-                    if drive in compatible_drive['driveRef']:
-                        comp_drives.append(drive)
-                if drive not in comp_drives:
-                    LOG.debug("Drive ref {} was not compatible with chosen firmware.".format(drive))
-    return comp_drives
+
+def fw_compatible_drives(rest_client, api, filename, drives=None, system_id='1'):
+    """Runs a check of drives in the array for compatibility with firmware.
+
+    :param rest_client: rest_client for which we use to get the drives.
+    :param api: urls
+    :param drives: drives for which we want to check the compatibility with.
+    :param filename: the filename of the firmware to check compatibility.
+    :param system_id: the id of the storage-system
+    :return: a list of compatible drives to upgrade.
+    """
+    return fw_compatible_drives_batch(rest_client, api, [filename], drives, system_id=system_id)[filename]
 
 
 def main():
     api_a = {key: controller_addresses[0] + API[key] for key in API}
-    api_b = {key: controller_addresses[1] + API[key] for key in API}
 
     # We'll re-use this session
     session = get_session()
 
-    response = drive_firmware_upgrade(session, api_a, path_to_firmware_file)
+    cache = FirmwareCache()
+    with phase('verify', subject=path_to_firmware_file):
+        require_valid_images([path_to_firmware_file], cache=cache)
+    with CheckpointJournal() as journal:
+        response = drive_firmware_upgrade(session, api_a, path_to_firmware_file, cache=cache, journal=journal)
     LOG.info("Returned: {}".format(pformat(response)))
+    LOG.info("Firmware uploads: {}".format(pformat(cache.summary())))
+    LOG.info("Requests: {}".format(get_tracer().to_json()))
 
 
 if __name__ == "__main__":
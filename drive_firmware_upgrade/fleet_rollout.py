@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Roll a drive firmware file out to a fleet of storage-systems concurrently.
+
+Usage:
+  fleet_rollout <firmware_file> (<systems_file> | --group=<name>) [--workers=<n>] [--per-endpoint=<n>]
+      [--journal=<file>] [--trace=<file>]
+  fleet_rollout -h
+Arguments:
+  firmware_file  Path to the drive firmware (.dlp) file
+  systems_file   A JSON file listing the storage-systems to upgrade
+Options:
+  -h --help            Show this screen.
+  --group=<name>       Upgrade the storage-systems of a group of the fleet in configuration.json instead
+  --workers=<n>        Maximum number of systems being upgraded at once [default: 8]
+  --per-endpoint=<n>   Maximum number of systems being upgraded at once through the same API endpoint [default: 4]
+  --journal=<file>     Where to record the progress of every system, by default ~/.santricity/drive_upgrades.journal
+  --trace=<file>       Write the latency of every API endpoint and the timing of every phase to this file, in the
+                       Prometheus text format if its name ends in .prom and as JSON otherwise
+
+Description:
+    The systems file holds a list of the storage-systems to upgrade, for example:
+
+        [{"name": "array-01", "address": "https://proxy.example.com:8443", "systemId": "1",
+          "username": "admin", "password": "admin"}]
+
+    The 'systemId' defaults to '1' (Embedded Web Services) and the 'name' to the address and systemId. The systems can
+     also be defined once, with their groups, in configuration.json (see base.py) and selected with --group.
+
+    The firmware file is verified (see firmware_verify.py) before any system is upgraded. Each system goes through
+     the same steps as drive_firmware_upgrade(): upload, compatibility check, initiate-upgrade and state polling,
+     but systems are processed concurrently by a bounded pool of workers.
+
+    A Web Services Proxy stores uploaded drive firmware once for every system that it manages, so the file is only
+     uploaded once per address. The per-endpoint limit keeps a single proxy from being flooded by the whole fleet.
+
+    Every step is recorded in a journal. If the rollout is interrupted, running it again resumes each system from
+     its last recorded step: systems that were upgraded are skipped, and downloads that were already initiated are
+     waited on rather than started again.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import docopt
+
+from base import Properties, get_system_session
+from client import get_cache, pool_metrics
+from drive_firmware_upgrade.checkpoint import CheckpointJournal
+from drive_firmware_upgrade.drive_firmware_upgrade import API, run_upgrade_steps, upload_drive_firmware
+from firmware_cache import FirmwareCache, file_digest
+from firmware_verify import require_valid_images
+from poller import PollScheduler
+from tracing import get_tracer, timed_phase
+
+LOG = logging.getLogger(__name__)
+
+
+def load_systems(systems_file):
+    """Load the list of systems to upgrade
+    :param systems_file: path to a JSON file holding a list of systems
+    :return: a list of system definitions
+    """
+    with open(systems_file) as fp:
+        systems = json.load(fp)
+
+    for system in systems:
+        system.setdefault('systemId', '1')
+        system.setdefault('name', '{}/{}'.format(system['address'], system['systemId']))
+    return systems
+
+
+class FleetRollout(object):
+    """Upgrade drive firmware on many systems at once"""
+
+    def __init__(self, filename, workers=8, per_endpoint=4, cache=None, journal=None):
+        """
+        :param filename: path to the drive firmware file
+        :param workers: the maximum number of systems upgraded at once
+        :param per_endpoint: the maximum number of systems upgraded at once through the same API endpoint
+        :param cache: an optional FirmwareCache used to skip uploads to endpoints that already hold the file
+        :param journal: an optional CheckpointJournal, the steps of every system are recorded in it and systems
+         resume from the last step it recorded
+        """
+        self.filename = filename
+        self.cache = cache
+        self.journal = journal
+        self.operation = None
+        if journal is not None:
+            self.operation = cache.digest(filename) if cache is not None else file_digest(filename)
+        self.workers = workers
+        self.per_endpoint = per_endpoint
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.scheduler = None
+
+    def _endpoint(self, address):
+        with self._lock:
+            if address not in self._endpoints:
+                self._endpoints[address] = {'slots': threading.BoundedSemaphore(self.per_endpoint),
+                                            'upload_lock': threading.Lock(),
+                                            'uploaded': False}
+            return self._endpoints[address]
+
+    def _upload_once(self, session, api, endpoint):
+        """Upload the firmware file unless another system has already uploaded it to this endpoint"""
+        with endpoint['upload_lock']:
+            if not endpoint['uploaded']:
+                response = upload_drive_firmware(session, api, self.filename, cache=self.cache)
+                endpoint['uploaded'] = True
+                if response is not None:
+                    return os.path.getsize(self.filename)
+        return 0
+
+    def upgrade_system(self, system):
+        """Run the complete drive firmware upgrade for one system
+        :param system: the system definition
+        :return: a result dictionary describing what happened
+        """
+        result = {'name': system['name'], 'status': 'failed', 'drives': 0, 'bytes_uploaded': 0, 'phases': {},
+                  'error': None}
+        api = {key: system['address'] + API[key] for key in API}
+        system_id = system['systemId']
+        session = get_system_session(system)
+        endpoint = self._endpoint(system['address'])
+
+        start = time.time()
+        with endpoint['slots']:
+            try:
+                self._upgrade_steps(session, api, system_id, endpoint, result)
+            except Exception as e:
+                LOG.exception("%s: the upgrade failed.", result['name'])
+                result['error'] = str(e)
+            finally:
+                session.close()
+
+        result['elapsed'] = time.time() - start
+        return result
+
+    def _upgrade_steps(self, session, api, system_id, endpoint, result):
+        """Run the steps of the upgrade that haven't been completed yet"""
+        outcome = run_upgrade_steps(session, api, self.filename, lambda: self._upload_once(session, api, endpoint),
+                                    system_id=system_id, journal=self.journal, operation=self.operation,
+                                    timed=lambda step: timed_phase(result, step), scheduler=self.scheduler)
+        if self.journal is not None:
+            result['resumed_after'] = outcome['resumed_after']
+        result['bytes_uploaded'] = outcome['uploaded'] or 0
+        result['drives'] = len(outcome['drives'])
+        result['status'] = 'upgraded' if outcome['status'] == 'complete' else outcome['status']
+
+    def run(self, systems):
+        """Upgrade every system in the list
+        :param systems: a list of system definitions
+        :return: a tuple of the per-system results and a fleet-wide summary
+        """
+        results = []
+        start = time.time()
+        # The state of every in-flight upgrade is polled from one shared scheduler
+        self.scheduler = PollScheduler(workers=max(1, min(self.workers, len(systems))))
+        pool = ThreadPool(max(1, min(self.workers, len(systems))))
+        try:
+            for result in pool.imap_unordered(self.upgrade_system, systems):
+                results.append(result)
+                LOG.info("[%s/%s] %s: %s in %.1fs %s", len(results), len(systems), result['name'], result['status'],
+                         result['elapsed'], ', '.join('{}={:.1f}s'.format(phase, elapsed)
+                                                      for phase, elapsed in sorted(result['phases'].items())))
+        finally:
+            pool.close()
+            pool.join()
+            self.scheduler.shutdown()
+
+        summary = summarize(results, time.time() - start)
+        summary['polling'] = self.scheduler.stats.summary()
+        summary['connections'] = pool_metrics()
+        if get_cache() is not None:
+            summary['response_cache'] = get_cache().summary()
+        return results, summary
+
+
+def summarize(results, wall_time):
+    """Build a fleet-wide summary of a rollout
+    :param results: the per-system results
+    :param wall_time: the total elapsed time of the rollout in seconds
+    :return: a summary dictionary
+    """
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+
+    serial_time = sum(result['elapsed'] for result in results)
+    drives = sum(result['drives'] for result in results)
+    hours = wall_time / 3600.0
+    return {'systems': len(results),
+            'statuses': statuses,
+            'drives': drives,
+            'bytes_uploaded': sum(result['bytes_uploaded'] for result in results),
+            'wall_time': wall_time,
+            'serial_time': serial_time,
+            'speedup': serial_time / wall_time if wall_time else 0.0,
+            'systems_per_hour': len(results) / hours if hours else 0.0,
+            'drives_per_hour': drives / hours if hours else 0.0}
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    if args.get('--group'):
+        systems = Properties().fleet.select(group=args.get('--group'))
+    else:
+        systems = load_systems(args.get('<systems_file>'))
+    cache = FirmwareCache()
+    with get_tracer().phase('verify', subject=args.get('<firmware_file>')):
+        require_valid_images([args.get('<firmware_file>')], cache=cache)
+    with CheckpointJournal(args.get('--journal')) as journal:
+        rollout = FleetRollout(args.get('<firmware_file>'), workers=int(args.get('--workers')),
+                               per_endpoint=int(args.get('--per-endpoint')), cache=cache, journal=journal)
+        results, summary = rollout.run(systems)
+    for result in results:
+        if result['error']:
+            LOG.error("%s: %s", result['name'], result['error'])
+    LOG.info("Rollout summary: %s", json.dumps(summary, indent=2, sort_keys=True))
+    LOG.info("Firmware uploads: %s", json.dumps(cache.summary(), indent=2, sort_keys=True))
+    if args.get('--trace'):
+        get_tracer().export(args.get('--trace'))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(message)s')
+    main()
@@ -0,0 +1,168 @@
+"""
+A local record of the firmware files that have already been uploaded, keyed by the SHA-256 of their content.
+
+Firmware images are large and management links are often slow. Before uploading, the upgrade samples ask the cache
+whether the target already holds an identical file, and skip the upload when it does. Every upload and skip is
+recorded so that the bandwidth (and time) saved can be reported.
+
+The cache also keeps the result of verifying each local file (see firmware_verify.py), so that a file that hasn't
+changed is neither verified nor hashed again.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+LOG = logging.getLogger(__name__)
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.santricity', 'firmware_cache.json')
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    """Compute the SHA-256 of a file's content
+    :param path: path to the file
+    :return: the hex digest
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FirmwareCache(object):
+    """Tracks which firmware files (by content hash) each upload target already holds"""
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file or CACHE_FILE
+        self._lock = threading.RLock()
+        self.data = {'digests': {}, 'images': {}, 'uploads': {},
+                     'stats': {'uploads': 0, 'bytes_uploaded': 0, 'upload_seconds': 0.0,
+                               'skipped': 0, 'bytes_saved': 0}}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as fp:
+                self.data.update(json.load(fp))
+
+    def save(self):
+        """Persist the cache, replacing the previous file atomically"""
+        with self._lock:
+            directory = os.path.dirname(self.cache_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp_file = self.cache_file + '.tmp'
+            with open(tmp_file, 'w') as fp:
+                json.dump(self.data, fp, indent=2, sort_keys=True)
+            os.rename(tmp_file, self.cache_file)
+
+    def _known(self, section, path):
+        """Get the record of a file in a section of the cache, if the file hasn't changed since it was recorded"""
+        stat = os.stat(path)
+        with self._lock:
+            known = self.data[section].get(path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+            return known
+        return None
+
+    def cached_digest(self, path):
+        """Get the SHA-256 of a file if it is known and the file hasn't changed since, without hashing it
+        :param path: path to the file
+        :return: the hex digest, or None
+        """
+        known = self._known('digests', os.path.abspath(path))
+        return known['sha256'] if known else None
+
+    def digest(self, path):
+        """Get the SHA-256 of a file, only re-hashing it when its size or modification time has changed
+        :param path: path to the file
+        :return: the hex digest
+        """
+        path = os.path.abspath(path)
+        known = self._known('digests', path)
+        if known:
+            return known['sha256']
+
+        stat = os.stat(path)
+        digest = file_digest(path)
+        with self._lock:
+            self.data['digests'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest}
+        return digest
+
+    def verification(self, path):
+        """Get the result of verifying a file, if the file hasn't changed since it was verified
+        :param path: path to the file
+        :return: a copy of the result (see firmware_verify.inspect_image()), or None
+        """
+        known = self._known('images', os.path.abspath(path))
+        return dict(known) if known else None
+
+    def record_verifications(self, results):
+        """Remember the results of verifying files, along with the digests they computed
+        :param results: the results of firmware_verify.inspect_image()
+        """
+        with self._lock:
+            for result in results:
+                self.data['images'][result['path']] = dict(result)
+                if result['sha256'] is not None:
+                    self.data['digests'][result['path']] = {'size': result['size'], 'mtime': result['mtime'],
+                                                            'sha256': result['sha256']}
+            self.save()
+
+    def lookup(self, target, name):
+        """Get what we know about a file previously uploaded to a target
+        :param target: the url the file was uploaded to
+        :param name: the name of the file on the target
+        :return: the upload record, or None
+        """
+        with self._lock:
+            return self.data['uploads'].get(target, {}).get(name)
+
+    def holds(self, target, name, digest):
+        """Check whether the last upload of this name to the target had the same content"""
+        record = self.lookup(target, name)
+        return record is not None and record['sha256'] == digest
+
+    def record_upload(self, target, name, digest, size, elapsed, **extra):
+        """Remember a completed upload
+        :param target: the url the file was uploaded to
+        :param name: the name of the file on the target
+        :param digest: the SHA-256 of the file
+        :param size: the size of the file in bytes
+        :param elapsed: how long the upload took in seconds
+        :param extra: additional attributes to store with the record
+        """
+        with self._lock:
+            record = {'sha256': digest, 'size': size, 'upload_seconds': elapsed}
+            record.update(extra)
+            self.data['uploads'].setdefault(target, {})[name] = record
+            stats = self.data['stats']
+            stats['uploads'] += 1
+            stats['bytes_uploaded'] += size
+            stats['upload_seconds'] += elapsed
+            self.save()
+
+    def update(self, target, name, **extra):
+        """Add attributes to an existing upload record"""
+        with self._lock:
+            record = self.data['uploads'].get(target, {}).get(name)
+            if record is not None:
+                record.update(extra)
+                self.save()
+
+    def record_skip(self, size):
+        """Remember an upload that was avoided"""
+        with self._lock:
+            self.data['stats']['skipped'] += 1
+            self.data['stats']['bytes_saved'] += size
+            self.save()
+
+    def summary(self):
+        """Describe the uploads performed and avoided so far"""
+        with self._lock:
+            stats = dict(self.data['stats'])
+        rate = stats['bytes_uploaded'] / stats['upload_seconds'] if stats['upload_seconds'] else 0.0
+        stats['bytes_per_second'] = rate
+        stats['seconds_saved'] = stats['bytes_saved'] / rate if rate else 0.0
+        return stats
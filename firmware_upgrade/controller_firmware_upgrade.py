@@ -4,6 +4,7 @@ Demonstrate a controller firmware upgrade using the Embedded Web Services API.
 """
 import json
 import logging
+import os
 import sys
 import time
 from pprint import pformat
@@ -11,6 +12,14 @@ from pprint import pformat
 import requests
 import urllib3
 
+from authentication.session_manager import session_auth
+from client import new_session, probe_session, upload_timeout
+from firmware_cache import FirmwareCache
+from firmware_verify import require_valid_images
+from poller import Backoff, PollScheduler, poll
+from streaming_upload import MultipartFileStream, log_progress
+from tracing import get_tracer, phase
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Configurable Parameters
@@ -29,141 +38,335 @@ IGNORE_HEALTH_CHECK = False
 auth = ('admin@local', '****')
 
 
+# Log in once and re-use the session (JSESSIONID) instead of sending Basic-Auth with every request
+USE_SESSION_LOGIN = True
+
 # End Configurable Parameters
 
-def get_session():
-    """Define a re-usable Session object"""
-    session = requests.Session()
-    session.auth = auth
-    session.verify = False
-    return session
+def get_session(credentials=None):
+    """Define a re-usable Session object
+    :param credentials an optional (username, password), the configured auth by default
+    """
+    credentials = credentials or auth
+    if USE_SESSION_LOGIN:
+        return new_session(auth=session_auth(credentials[0], credentials[1], verify=False), verify=False)
+    return new_session(auth=credentials, verify=False)
 
 
 API = {
     'embedded_firmware': '/devmgr/v2/firmware/embedded-firmware',
+    'activate_firmware': '/devmgr/v2/firmware/embedded-firmware/activate',
     'system': '/devmgr/v2/storage-systems/1',
     'health_check': '/devmgr/v2/health-check',
 }
 
 
-def health_check(session, health_url):
-    """Validates that we *should* run a firmware upgrade operation on this storage-system.
+def controller_api(address):
+    """Get the url of every API used, for a controller at the given address"""
+    return dict((key, address + API[key]) for key in API)
+
+HEALTH_CHECK_BACKOFF = Backoff(initial=1, factor=1.5, maximum=10)
+# The number of storage-systems submitted to a single health check
+HEALTH_CHECK_BATCH_SIZE = 50
+
+# A controller reboot takes minutes; poll often at first, then less frequently
+AVAILABILITY_BACKOFF = Backoff(initial=1, factor=1.5, maximum=15)
+AVAILABILITY_TIMEOUT = 1000
+
+# A probe of a rebooting controller should fail fast rather than hang on the connection
+PROBE_CONNECT_TIMEOUT = 2
+PROBE_READ_TIMEOUT = 5
+
+
+def health_gate(session, health_url, system_ids, batch_size=HEALTH_CHECK_BATCH_SIZE):
+    """Run the health check on many storage-systems, a batch of them at a time.
+
+    The health check API runs one check at a time for any number of devices, so rather than checking each system
+     in turn (and waiting out a poll for each), the systems are submitted in batches and each batch is polled once.
     :param session a persistent session for making HTTP requests
     :param health_url the url of the API to call
-    :return True if we are okay to proceed, false if a problem was found
+    :param system_ids the ids of the storage-systems to check
+    :param batch_size the maximum number of storage-systems submitted in one check
+    :return a dict of whether each storage-system passed, a system that the check didn't report on has not passed
     """
     LOG = logging.getLogger(__name__)
-    result = session.post(health_url, headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
-                          data=json.dumps({"storageDeviceIds": ["1"]}))
-
-    result.raise_for_status()
-    finished = False
-    while not finished:
-        time.sleep(1)
-        result = session.get(health_url, headers={'Accept': 'application/json'})
+    system_ids = [str(sys_id) for sys_id in system_ids]
+    passed = dict((sys_id, False) for sys_id in system_ids)
+    # The poll retries on its own schedule, so each probe is a single request
+    poll_session = probe_session(session)
+
+    for offset in range(0, len(system_ids), batch_size):
+        batch = system_ids[offset:offset + batch_size]
+        result = session.post(health_url, headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
+                              data=json.dumps({"storageDeviceIds": batch}))
         result.raise_for_status()
-        result = result.json()
-        if result['healthCheckRunning']:
-            continue
-
-        if not result['results'][0]['successful']:
-            LOG.error("The healthCheck has failed: %s", pformat(result))
-            if not IGNORE_HEALTH_CHECK:
-                return False
+
+        def probe():
+            response = poll_session.get(health_url, headers={'Accept': 'application/json'})
+            response.raise_for_status()
+            return response.json()
+
+        result = poll(probe, lambda state: not state['healthCheckRunning'], backoff=HEALTH_CHECK_BACKOFF,
+                      initial_delay=1, name='health check of {} systems'.format(len(batch)))
+
+        reported = set()
+        for entry in result.get('results') or []:
+            sys_id = str(entry.get('storageDeviceId'))
+            if sys_id not in passed:
+                continue
+            reported.add(sys_id)
+            passed[sys_id] = bool(entry.get('successful'))
+            if passed[sys_id]:
+                LOG.debug("The healthCheck of [%s] has passed: %s", sys_id, pformat(entry))
             else:
-                return True
-        else:
-            LOG.debug("The healthCheck has passed: %s", pformat(result))
-            LOG.info("The healthCheck was successful.")
-            finished = True
+                LOG.error("The healthCheck of [%s] has failed: %s", sys_id, pformat(entry))
 
-    return True
+        for sys_id in set(batch) - reported:
+            LOG.error("The healthCheck did not report on [%s].", sys_id)
+
+    LOG.info("The healthCheck passed on %s of %s systems.", sum(passed.values()), len(passed))
+    return passed
+
+
+def health_check(session, health_url, system_id='1', ignore=None):
+    """Validates that we *should* run a firmware upgrade operation on this storage-system.
+    :param session a persistent session for making HTTP requests
+    :param health_url the url of the API to call
+    :param system_id the id of the storage-system
+    :param ignore whether to proceed even if the check fails, IGNORE_HEALTH_CHECK by default
+    :return True if we are okay to proceed, false if a problem was found
+    """
+    LOG = logging.getLogger(__name__)
+    if health_gate(session, health_url, [system_id])[str(system_id)]:
+        LOG.info("The healthCheck was successful.")
+        return True
+    return IGNORE_HEALTH_CHECK if ignore is None else ignore
 
 
-def upload_firmware_file(session, firmware_url):
+def current_firmware_version(session, system_url):
+    """Get the firmware version the controller is currently running
+        :param session a persistent session for making HTTP requests
+        :param system_url the url of the storage-system
+        :return the fwVersion, or None if it could not be determined
+    """
+    try:
+        # A single request, so that an unreachable controller is detected within the probe timeouts
+        response = probe_session(session).get(system_url, verify=False,
+                                              timeout=(PROBE_CONNECT_TIMEOUT, PROBE_READ_TIMEOUT),
+                                              headers={'Accept': 'application/json'})
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        return None
+    if response.status_code >= 300:
+        return None
+    return response.json().get('fwVersion')
+
+
+def upload_firmware_file(session, firmware_url, cache=None, system_url=None, firmware_file=None, staged=False):
     """Upload and activate the firmware file (it will activate on both controllers)
         :param session a persistent session for making HTTP requests
         :param firmware_url the url of the API to call
+        :param cache an optional FirmwareCache used to skip re-uploading a file that is already active
+        :param system_url the url of the storage-system, used to check the running version when a cache is given
+        :param firmware_file the path to the firmware file, path_to_firmware_file by default
+        :param staged if True the file is only staged on the controllers, see activate_firmware()
+        :return True if the file was uploaded, False if the upload was skipped
         :raise HTTPError if the request returned a failure status
     """
     LOG = logging.getLogger(__name__)
-    LOG.info('Uploading file %s', path_to_firmware_file)
-    with open(path_to_firmware_file, 'rb') as firmware_file:
-        file_multipart = {
-            'dlpfile': firmware_file
-        }
-        response = session.post(firmware_url, files=file_multipart, verify=False)
-        LOG.info("Received %s from the upgrade process.", response.status_code)
-
-        LOG.debug(response.headers)
-        if response.status_code < 300:
-            if response.headers.get('Content-Type') == 'application/json':
-                LOG.debug(response.json())
-        else:
-            LOG.warn(response.text)
-        response.raise_for_status()
+    firmware_file = firmware_file or path_to_firmware_file
+    name = os.path.basename(firmware_file)
+    size = os.path.getsize(firmware_file)
+    digest = None
+
+    if cache is not None:
+        # The embedded firmware API doesn't list the files it holds, but we know which version this exact file
+        #  brought up the last time we activated it.
+        digest = cache.digest(firmware_file)
+        record = cache.lookup(firmware_url, name)
+        if cache.holds(firmware_url, name, digest) and record.get('fwVersion') is not None \
+                and record.get('fwVersion') == current_firmware_version(session, system_url):
+            LOG.info('Firmware file %s is already active (%s), skipping the upload.', name, record['fwVersion'])
+            cache.record_skip(size)
+            return False
+
+    LOG.info('%s file %s', 'Staging' if staged else 'Uploading', firmware_file)
+    start = time.time()
+    # The file is streamed in chunks rather than building the whole multipart body in memory
+    with MultipartFileStream('dlpfile', firmware_file, progress=log_progress) as body:
+        response = session.post(firmware_url, data=body, headers={'Content-Type': body.content_type}, verify=False,
+                                params={'staged': 'true'} if staged else None, timeout=upload_timeout())
+    LOG.info("Received %s from the upgrade process.", response.status_code)
+
+    LOG.debug(response.headers)
+    if response.status_code < 300:
+        if response.headers.get('Content-Type') == 'application/json':
+            LOG.debug(response.json())
+    else:
+        LOG.warn(response.text)
+    response.raise_for_status()
+
+    if cache is not None:
+        cache.record_upload(firmware_url, name, digest, size, time.time() - start)
+    return True
 
 
-def wait_for_availability(session, system_urls):
-    """Wait for the controllers to reboot before returning.
+def activate_firmware(session, activate_url):
+    """Activate the firmware staged by upload_firmware_file(staged=True), the controllers will reboot
         :param session a persistent session for making HTTP requests
-        :param system_urls a list of urls we can call to ensure that the controller[s] are up
+        :param activate_url the url of the API to call
         :raise HTTPError if the request returned a failure status
     """
     LOG = logging.getLogger(__name__)
-    # At this point, the API will temporarily become unavailable. Let's ping the API on both controllers
+    response = session.post(activate_url, headers={'Accept': 'application/json'}, verify=False)
+    LOG.info("Received %s from the activation.", response.status_code)
+    if response.status_code >= 300:
+        LOG.warn(response.text)
+    response.raise_for_status()
+
+
+class ControllerProbe(object):
+    """Probes a controller while it reboots, recording when it went offline and when it came back"""
+
+    def __init__(self, session, system_url, previous_version=None):
+        # Every probe is a single request, so the probe timeouts bound it and the downtime is measured accurately
+        self.session = probe_session(session)
+        self.system_url = system_url
+        self.previous_version = previous_version
+        self.offline_since = None
+        self.online_since = None
+        self.response = None
+
+    def __call__(self):
+        """Fetch the fwVersion the controller reports, or None if it is not serving requests yet"""
+        try:
+            response = self.session.get(self.system_url, verify=False,
+                                        timeout=(PROBE_CONNECT_TIMEOUT, PROBE_READ_TIMEOUT),
+                                        headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self._offline()
+            raise
+
+        self.response = response
+        if response.status_code >= 300:
+            self._offline()
+            return None
+
+        if self.offline_since is not None and self.online_since is None:
+            self.online_since = time.time()
+        return response.json().get('fwVersion')
+
+    def _offline(self):
+        if self.offline_since is None:
+            self.offline_since = time.time()
+        self.online_since = None
+
+    def is_done(self, version):
+        """With a known previous version we wait for a new one, or for the controller to come back after going offline
+        (e.g. when the same version is flashed again), otherwise for any successful response
+        """
+        if version is None:
+            return False
+        return self.previous_version is None or version != self.previous_version or self.online_since is not None
+
+    @property
+    def downtime(self):
+        if self.offline_since is None or self.online_since is None:
+            return None
+        return self.online_since - self.offline_since
+
+
+def wait_for_availability(session, system_urls, previous_versions=None, scheduler=None):
+    """Wait for the controllers to reboot before returning.
+        :param session a persistent session for making HTTP requests
+        :param system_urls a list of urls we can call to ensure that the controller[s] are up, every url is probed
+         concurrently so this can cover every controller of a fleet
+        :param previous_versions an optional dict of the fwVersion of each url before the upgrade, if given we wait
+         until a different version is reported, or until the controller is back after going offline, instead of for
+         the first successful response
+        :param scheduler an optional PollScheduler to poll from, otherwise one is created for the call
+        :return a dict of the fwVersion, downtime (in seconds, if observed) and wait time of each system url
+    """
+    LOG = logging.getLogger(__name__)
+    if not system_urls:
+        return {}
+    previous_versions = previous_versions or {}
+    # At this point, the API will temporarily become unavailable. Let's ping the API on every controller
     #  until we get a response.
+    owned_scheduler = scheduler is None
+    if owned_scheduler:
+        scheduler = PollScheduler(workers=len(system_urls))
 
+    probes = {}
+    operations = []
     for system_url in system_urls:
-        retry_max = 1000
-        retries = 0
-        offline = True
-        # It'll take a few moments for the upgrade to start and the device to go offline.
-        # Let's make sure we don't check for availability too soon.
-        LOG.info("Sleeping for 10s...")
-        time.sleep(10)
-        while offline and retries < retry_max:
-            time.sleep(1)
-            if retries % 60 == 0:
-                LOG.info("Been waiting for %s minutes.", retries / 60)
-            try:
-                response = session.get(system_url, verify=False,
-                                       headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
-                LOG.info("Received a successful response, the device is now online again.")
-                offline = False
-                if response.status_code < 300:
-                    LOG.info("New firmware version: %s", response.json()['fwVersion'])
-                elif response.headers.get('Content-Type') == 'application/json':
-                    LOG.warn("Received an error fetching the device: status_code=%s, response=%s",
-                             response.status_code,
-                             response.json())
-
-            except requests.exceptions.ConnectionError:
-                LOG.debug("Received a connection error. Retry on count %s...", retries)
-                # This is expected
-                pass
-            retries += 1
+        probe = ControllerProbe(session, system_url, previous_versions.get(system_url))
+        # Without a version to compare against, it'll take a few moments for the upgrade to start and the device
+        #  to go offline. Let's make sure we don't check for availability too soon.
+        initial_delay = 0 if probe.previous_version is not None else 10
+        probes[system_url] = probe
+        operations.append(scheduler.submit('availability of {}'.format(system_url), probe, probe.is_done,
+                                           backoff=AVAILABILITY_BACKOFF, deadline=AVAILABILITY_TIMEOUT,
+                                           retry_on=(requests.exceptions.ConnectionError,
+                                                     requests.exceptions.Timeout),
+                                           initial_delay=initial_delay))
+
+    try:
+        scheduler.wait_all(operations)
+    finally:
+        if owned_scheduler:
+            scheduler.shutdown()
+
+    results = {}
+    for system_url, operation in zip(system_urls, operations):
+        probe = probes[system_url]
+        results[system_url] = {'fwVersion': operation.value, 'downtime': probe.downtime,
+                               'elapsed': operation.elapsed, 'online': operation.error is None}
+        if operation.error is not None:
+            LOG.error("The device at %s did not come back online: %s", system_url, operation.error)
+            if probe.response is not None and probe.response.headers.get('Content-Type') == 'application/json':
+                LOG.warn("Received an error fetching the device: status_code=%s, response=%s",
+                         probe.response.status_code,
+                         probe.response.json())
+        else:
+            LOG.info("The device at %s is online again running %s (offline for %s).", system_url, operation.value,
+                     '{:.1f}s'.format(probe.downtime) if probe.downtime is not None else 'an unknown time')
+
+    return results
 
 
 def main():
     LOG = logging.getLogger(__name__)
-    api_a = {key: controller_addresses[0] + API[key] for key in API}
-    api_b = {key: controller_addresses[1] + API[key] for key in API}
+    api_a = controller_api(controller_addresses[0])
+    api_b = controller_api(controller_addresses[1])
+
+    # Catch a corrupt image before the health check and upload, rather than after
+    cache = FirmwareCache()
+    with phase('verify', subject=path_to_firmware_file):
+        require_valid_images([path_to_firmware_file], cache=cache)
 
     # We'll re-use this session
     session = get_session()
 
     health_url = api_a.get('health_check')
-    healthy = health_check(session, health_url)
+    with phase('health', subject=controller_addresses[0]):
+        healthy = health_check(session, health_url)
     if not healthy:
         sys.exit(1)
 
     firmware_url = api_a.get('embedded_firmware')
 
-    upload_firmware_file(session, firmware_url)
-
     system_urls = [api_a.get('system'), api_b.get('system')]
-    wait_for_availability(session, system_urls)
+    previous_versions = dict((system_url, current_firmware_version(session, system_url)) for system_url in system_urls)
+
+    with phase('upload', subject=controller_addresses[0]):
+        uploaded = upload_firmware_file(session, firmware_url, cache=cache, system_url=api_a.get('system'))
+    if uploaded:
+        with phase('wait', subject=controller_addresses[0]):
+            availability = wait_for_availability(session, system_urls, previous_versions)
+        cache.update(firmware_url, os.path.basename(path_to_firmware_file),
+                     fwVersion=availability[system_urls[0]]['fwVersion'])
+    LOG.info("Firmware uploads: %s", pformat(cache.summary()))
+    LOG.info("Requests: %s", get_tracer().to_json())
     LOG.info("Upgrade operation is complete.")
 
 
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+Roll controller firmware out to a fleet of storage-systems in waves.
+
+Usage:
+  orchestrator run <firmware> <systems_file> [--wave=<n>] [--in-flight=<n>] [--budget=<n>] [--serial]
+      [--report=<f>] [--trace=<f>]
+  orchestrator simulate <systems> [--wave=<n>] [--in-flight=<n>] [--durations=<report>]
+  orchestrator -h | --help
+Arguments:
+  firmware      Path to the controller firmware (.dlp) file
+  systems_file  A JSON file listing the storage-systems to upgrade
+  systems       The number of storage-systems in the simulated rollout
+Options:
+  -h --help             Show this screen.
+  --wave=<n>            The number of storage-systems in each wave [default: 10]
+  --in-flight=<n>       The maximum number of storage-systems being prepared, or being upgraded, at once [default: 5]
+  --budget=<n>          The number of storage-systems that may fail before the rollout is halted [default: 0]
+  --serial              Only prepare a wave once the previous wave has been upgraded
+  --report=<f>          Write the results of every storage-system and the summary of the rollout to this file
+  --trace=<f>           Write the latency of every API endpoint and the timing of every phase to this file, in the
+                        Prometheus text format if its name ends in .prom and as JSON otherwise
+  --durations=<report>  Simulate with the mean step durations in the report of an earlier rollout
+
+Description:
+    The systems file holds a list of the storage-systems to upgrade, each with the addresses of its controllers:
+
+        [{"name": "array-01", "controllers": ["https://array-01-a.example.com:8443",
+                                              "https://array-01-b.example.com:8443"],
+          "username": "admin", "password": "admin"}]
+
+    The firmware file is verified (see firmware_verify.py) before the first wave is started.
+
+    Each storage-system is first prepared: it must pass a health check, then the firmware file is staged on its
+     controllers without being activated. It is then upgraded: the staged firmware is activated and we wait for both
+     controllers to come back running the new version. A storage-system already running the firmware (according to
+     the firmware cache) is not upgraded again.
+
+    Storage-systems are upgraded a wave at a time, and a wave is only activated once the previous one is back online.
+     Uploading the firmware is independent of the reboots, so the next wave is prepared while the current wave is
+     rebooting. Once more storage-systems than the failure budget have failed (or failed their health check) no
+     further wave is activated; the firmware that was already staged is left staged.
+
+    'simulate' estimates how long a rollout of the given number of storage-systems would take, with and without
+     pipelining, from the step durations measured by an earlier rollout or from typical durations.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+import docopt
+
+from client import get_cache, pool_metrics
+from firmware_cache import FirmwareCache
+from firmware_upgrade.controller_firmware_upgrade import activate_firmware, controller_api, \
+    current_firmware_version, get_session, health_check, upload_firmware_file, wait_for_availability
+from firmware_verify import require_valid_images
+from poller import PollScheduler
+from tracing import get_tracer, timed_phase
+
+LOG = logging.getLogger(__name__)
+
+# Typical step durations in seconds, used by the simulator when none were measured
+DEFAULT_DURATIONS = {'health': 30.0, 'stage': 120.0, 'activate': 5.0, 'wait': 600.0}
+
+# The statuses of storage-systems that count against the failure budget
+FAILED = ('failed', 'unhealthy')
+
+
+def load_systems(systems_file):
+    """Load the list of systems to upgrade
+    :param systems_file: path to a JSON file holding a list of systems
+    :return: a list of system definitions
+    """
+    with open(systems_file) as fp:
+        systems = json.load(fp)
+
+    for system in systems:
+        system.setdefault('name', system['controllers'][0])
+    return systems
+
+
+class WaveOrchestrator(object):
+    """Upgrade controller firmware on a fleet of storage-systems, a wave at a time"""
+
+    def __init__(self, firmware_file, wave_size=10, max_in_flight=5, failure_budget=0, pipeline=True, cache=None):
+        """
+        :param firmware_file: path to the controller firmware file
+        :param wave_size: the number of storage-systems in each wave
+        :param max_in_flight: the maximum number of storage-systems being prepared, or being upgraded, at once
+        :param failure_budget: the number of storage-systems that may fail before the rollout is halted
+        :param pipeline: whether to prepare the next wave while the current one is upgraded
+        :param cache: an optional FirmwareCache used to skip storage-systems that already run the firmware
+        """
+        self.firmware_file = firmware_file
+        self.wave_size = wave_size
+        self.max_in_flight = max_in_flight
+        self.failure_budget = failure_budget
+        self.pipeline = pipeline
+        self.cache = cache
+        self.scheduler = None
+        self._state = {}
+
+    def waves(self, systems):
+        return [systems[start:start + self.wave_size] for start in range(0, len(systems), self.wave_size)]
+
+    def prepare(self, system):
+        """Check the health of a storage-system and stage the firmware on it
+        :param system: the system definition
+        :return: a result dictionary, with the status 'staged' if the system is ready to be upgraded
+        """
+        result = {'name': system['name'], 'status': 'failed', 'phases': {}, 'fwVersion': None, 'error': None}
+        api = controller_api(system['controllers'][0])
+        system_urls = [controller_api(address)['system'] for address in system['controllers']]
+        self._state[system['name']] = {'session': None, 'api': api, 'system_urls': system_urls}
+
+        start = time.time()
+        try:
+            session = get_session((system.get('username'), system.get('password')))
+            self._state[system['name']]['session'] = session
+            with timed_phase(result, 'health'):
+                healthy = health_check(session, api['health_check'], ignore=False)
+            if not healthy:
+                result['status'] = 'unhealthy'
+            else:
+                with timed_phase(result, 'stage'):
+                    self._state[system['name']]['previous_versions'] = dict(
+                        (system_url, current_firmware_version(session, system_url)) for system_url in system_urls)
+                    staged = upload_firmware_file(session, api['embedded_firmware'], cache=self.cache,
+                                                  system_url=api['system'], firmware_file=self.firmware_file,
+                                                  staged=True)
+                result['status'] = 'staged' if staged else 'current'
+        except Exception as e:
+            LOG.exception("%s: the preparation failed.", result['name'])
+            result['error'] = str(e)
+
+        result['elapsed'] = time.time() - start
+        return result
+
+    def upgrade(self, result):
+        """Activate the firmware staged on a storage-system and wait for its controllers to come back
+        :param result: the result of prepare(), it is updated
+        :return: the result
+        """
+        state = self._state[result['name']]
+        start = time.time()
+        try:
+            with timed_phase(result, 'activate'):
+                activate_firmware(state['session'], state['api']['activate_firmware'])
+            with timed_phase(result, 'wait'):
+                availability = wait_for_availability(state['session'], state['system_urls'],
+                                                     state['previous_versions'], scheduler=self.scheduler)
+            result['fwVersion'] = availability[state['system_urls'][0]]['fwVersion']
+            if all(controller['online'] for controller in availability.values()):
+                result['status'] = 'upgraded'
+                if self.cache is not None:
+                    self.cache.update(state['api']['embedded_firmware'], os.path.basename(self.firmware_file),
+                                      fwVersion=result['fwVersion'])
+            else:
+                result['status'] = 'failed'
+                result['error'] = 'A controller did not come back online.'
+        except Exception as e:
+            LOG.exception("%s: the upgrade failed.", result['name'])
+            result['status'] = 'failed'
+            result['error'] = str(e)
+
+        result['elapsed'] += time.time() - start
+        return result
+
+    def _close(self, results):
+        for result in results:
+            session = self._state.pop(result['name'])['session']
+            if session is not None:
+                session.close()
+
+    def run(self, systems):
+        """Upgrade every system in the list, unless the rollout is halted
+        :param systems: a list of system definitions
+        :return: a tuple of the per-system results and a fleet-wide summary
+        """
+        results = []
+        failures = 0
+        halted = False
+        start = time.time()
+        waves = self.waves(systems)
+        # The availability of every rebooting controller is polled from one shared scheduler
+        self.scheduler = PollScheduler(workers=max(1, 2 * self.max_in_flight))
+        preparers = ThreadPool(max(1, self.max_in_flight))
+        upgraders = ThreadPool(max(1, self.max_in_flight))
+        try:
+            prepared = preparers.map_async(self.prepare, waves[0]) if waves else None
+            for index, wave in enumerate(waves):
+                wave_results = prepared.get()
+                for result in wave_results:
+                    result['wave'] = index
+                failures += sum(1 for result in wave_results if result['status'] in FAILED)
+                halted = failures > self.failure_budget
+                if halted:
+                    LOG.error("Wave %s: %s systems have failed, the rollout is halted.", index, failures)
+                    self._halt(wave_results)
+                    results.extend(wave_results)
+                    break
+
+                # Stage the firmware on the next wave while this one reboots
+                upcoming = waves[index + 1] if index + 1 < len(waves) else None
+                prepared = None
+                if upcoming and self.pipeline:
+                    prepared = preparers.map_async(self.prepare, upcoming)
+
+                staged = [result for result in wave_results if result['status'] == 'staged']
+                LOG.info("Wave %s: upgrading %s of %s systems.", index, len(staged), len(wave_results))
+                upgraders.map(self.upgrade, staged)
+                self._close(wave_results)
+                results.extend(wave_results)
+
+                failures += sum(1 for result in staged if result['status'] in FAILED)
+                LOG.info("Wave %s: %s", index, ', '.join('{}={}'.format(result['name'], result['status'])
+                                                         for result in wave_results))
+                if failures > self.failure_budget:
+                    halted = True
+                    LOG.error("Wave %s: %s systems have failed, the rollout is halted.", index, failures)
+                    if prepared is not None:
+                        upcoming_results = prepared.get()
+                        for result in upcoming_results:
+                            result['wave'] = index + 1
+                        self._halt(upcoming_results)
+                        results.extend(upcoming_results)
+                    break
+
+                if upcoming and not self.pipeline:
+                    prepared = preparers.map_async(self.prepare, upcoming)
+        finally:
+            preparers.close()
+            upgraders.close()
+            preparers.join()
+            upgraders.join()
+            self.scheduler.shutdown()
+
+        started = set(result['name'] for result in results)
+        for system in systems:
+            if system['name'] not in started:
+                results.append({'name': system['name'], 'status': 'halted', 'phases': {}, 'fwVersion': None,
+                                'error': None, 'elapsed': 0.0})
+
+        summary = summarize(results, time.time() - start)
+        summary.update({'waves': len(waves), 'halted': halted, 'failure_budget': self.failure_budget,
+                        'pipeline': self.pipeline, 'max_in_flight': self.max_in_flight})
+        summary['polling'] = self.scheduler.stats.summary()
+        summary['connections'] = pool_metrics()
+        if get_cache() is not None:
+            summary['response_cache'] = get_cache().summary()
+        return results, summary
+
+    def _halt(self, results):
+        """Leave the firmware staged on systems that won't be upgraded"""
+        for result in results:
+            if result['status'] == 'staged':
+                result['status'] = 'halted'
+        self._close(results)
+
+
+def summarize(results, wall_time):
+    """Build a fleet-wide summary of a rollout
+    :param results: the per-system results
+    :param wall_time: the total elapsed time of the rollout in seconds
+    :return: a summary dictionary
+    """
+    statuses = {}
+    phases = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        for phase, elapsed in result['phases'].items():
+            phases.setdefault(phase, []).append(elapsed)
+
+    serial_time = sum(result['elapsed'] for result in results)
+    return {'systems': len(results),
+            'statuses': statuses,
+            'wall_time': wall_time,
+            'serial_time': serial_time,
+            'speedup': serial_time / wall_time if wall_time else 0.0,
+            'phases': dict((phase, {'mean': sum(values) / len(values), 'max': max(values)})
+                           for phase, values in phases.items())}
+
+
+def measured_durations(report):
+    """Get the mean duration of each step from the report of an earlier rollout
+    :param report: path to a report written by 'run --report'
+    :return: a dict of step -> seconds, the typical duration of a step that was never measured
+    """
+    with open(report) as fp:
+        phases = json.load(fp)['summary']['phases']
+    durations = dict(DEFAULT_DURATIONS)
+    for phase in durations:
+        if phase in phases:
+            durations[phase] = phases[phase]['mean']
+    return durations
+
+
+def simulate(system_count, durations=None, wave_size=10, max_in_flight=5, pipeline=True):
+    """Estimate how long a rollout would take, if every storage-system took the given time for each step
+    :param system_count: the number of storage-systems
+    :param durations: a dict of step -> seconds, DEFAULT_DURATIONS by default
+    :param wave_size: the number of storage-systems in each wave
+    :param max_in_flight: the maximum number of storage-systems being prepared, or being upgraded, at once
+    :param pipeline: whether the next wave is prepared while the current one is upgraded
+    :return: the estimated total time, and the times at which each wave was prepared, started and finished upgrading
+    """
+    durations = durations or DEFAULT_DURATIONS
+    prepare = durations['health'] + durations['stage']
+    upgrade = durations['activate'] + durations['wait']
+
+    def rounds(size):
+        return (size + max_in_flight - 1) // max_in_flight
+
+    waves = []
+    finished = 0.0
+    prepare_start = 0.0
+    for start in range(0, system_count, wave_size):
+        size = min(wave_size, system_count - start)
+        prepared = prepare_start + rounds(size) * prepare
+        upgrade_start = max(finished, prepared)
+        finished = upgrade_start + rounds(size) * upgrade
+        waves.append({'systems': size, 'prepared': prepared, 'upgrade_start': upgrade_start, 'finished': finished})
+        # A wave is prepared once the previous one starts upgrading, or once it has finished without pipelining
+        prepare_start = upgrade_start if pipeline else finished
+    return {'total': finished, 'waves': waves, 'durations': durations}
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    wave_size = int(args.get('--wave'))
+    max_in_flight = int(args.get('--in-flight'))
+
+    if args.get('simulate'):
+        durations = measured_durations(args.get('--durations')) if args.get('--durations') else None
+        estimates = [(pipeline, simulate(int(args.get('<systems>')), durations, wave_size, max_in_flight, pipeline))
+                     for pipeline in (True, False)]
+        LOG.info("Step durations: %s", json.dumps(estimates[0][1]['durations'], sort_keys=True))
+        print('{:>10} {:>6} {:>12} {:>12}'.format('pipeline', 'waves', 'total (m)', 'per wave (m)'))
+        for pipeline, estimate in estimates:
+            waves = len(estimate['waves'])
+            print('{:>10} {:>6} {:>12.2f} {:>12.2f}'.format(str(pipeline), waves, estimate['total'] / 60.0,
+                                                            estimate['total'] / 60.0 / waves if waves else 0.0))
+        return
+
+    systems = load_systems(args.get('<systems_file>'))
+    cache = FirmwareCache()
+    # Don't start a wave with an image that would only be rejected after it has been uploaded
+    with get_tracer().phase('verify', subject=args.get('<firmware>')):
+        require_valid_images([args.get('<firmware>')], cache=cache)
+    orchestrator = WaveOrchestrator(args.get('<firmware>'), wave_size=wave_size, max_in_flight=max_in_flight,
+                                    failure_budget=int(args.get('--budget')),
+                                    pipeline=not args.get('--serial'), cache=cache)
+
+    results, summary = orchestrator.run(systems)
+    for result in results:
+        if result['error']:
+            LOG.error("%s: %s", result['name'], result['error'])
+    LOG.info("Rollout summary: %s", json.dumps(summary, indent=2, sort_keys=True))
+    LOG.info("Firmware uploads: %s", json.dumps(cache.summary(), indent=2, sort_keys=True))
+    if args.get('--report'):
+        with open(args.get('--report'), 'w') as fp:
+            json.dump({'results': results, 'summary': summary}, fp, indent=2, sort_keys=True)
+    if args.get('--trace'):
+        get_tracer().export(args.get('--trace'))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(message)s')
+    main()
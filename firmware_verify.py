@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Verify firmware images before they are uploaded.
+
+Usage:
+  firmware_verify <image>... [--workers=<n>] [--sha256=<manifest>]
+  firmware_verify -h
+Arguments:
+  image                Path to a controller (RCB_*.dlp) or drive (D_*.dlp) firmware file
+Options:
+  -h --help            Show this screen.
+  --workers=<n>        The number of processes verifying images at once, one per CPU core by default
+  --sha256=<manifest>  A file of expected checksums in the format of sha256sum, e.g. as published with the firmware
+
+Description:
+    A corrupt or truncated image is otherwise only discovered after it has been uploaded to the controllers, which
+     takes minutes over a slow management link. Every image is checked to:
+
+        exist, have the .dlp extension and be at least MIN_IMAGE_SIZE bytes long
+        not begin with a blank header (zero or 0xFF bytes, as left by an interrupted download or copy)
+        match its SHA-256 in the manifest, if one is given
+
+    The images are verified in parallel by a pool of processes, one per CPU core. Each process reads its image through
+     a memory map, so the SHA-256 is computed over the page cache in place rather than through read() buffers.
+
+    The kind of firmware, and the version of controller firmware, are parsed from the name of the image.
+
+    The results are kept in the FirmwareCache (see firmware_cache.py) by path, size and modification time, along with
+     the SHA-256 of the image. Verifying an image that hasn't changed again only costs a stat(), and the upload that
+     follows the verification doesn't hash the image again.
+"""
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import docopt
+
+from firmware_cache import FirmwareCache
+
+LOG = logging.getLogger(__name__)
+
+MIN_IMAGE_SIZE = 1024
+# The number of leading bytes that are checked for a blank header
+HEADER_SIZE = 512
+
+# The kinds of firmware, recognised by the names NetApp publishes them under
+CONTROLLER_IMAGE = re.compile(r'^RCB_(?P<version>\d+(?:\.\d+)+)')
+DRIVE_IMAGE = re.compile(r'^D_')
+
+
+class InvalidImageError(ValueError):
+    """One or more firmware images failed their verification"""
+
+
+def image_kind(name):
+    """Parse the kind of firmware, and its version, from the name of an image
+    :param name: the file name of the image
+    :return: a tuple of 'controller', 'drive' or None and the firmware version, if the name gives one
+    """
+    match = CONTROLLER_IMAGE.match(name)
+    if match:
+        return 'controller', match.group('version')
+    if DRIVE_IMAGE.match(name):
+        return 'drive', None
+    return None, None
+
+
+def inspect_image(job):
+    """Check and hash one image, this runs in a worker process
+    :param job: a tuple of the absolute path to the image, its size and modification time, and its SHA-256 if that is
+     already known
+    :return: a result dictionary, with the problems found in 'errors'
+    """
+    path, size, mtime, digest = job
+    kind, version = image_kind(os.path.basename(path))
+    result = {'path': path, 'size': size, 'mtime': mtime, 'sha256': digest, 'kind': kind, 'version': version,
+              'errors': []}
+    errors = result['errors']
+    if not path.lower().endswith('.dlp'):
+        errors.append('not a .dlp file')
+    if size < MIN_IMAGE_SIZE:
+        errors.append('only {} bytes long'.format(size))
+    if size == 0:
+        # An empty file can't be mapped
+        result['sha256'] = hashlib.sha256().hexdigest()
+        return result
+
+    try:
+        with open(path, 'rb') as fp:
+            image = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                header = image[:HEADER_SIZE]
+                if header.count(header[:1]) == len(header) and header[:1] in (b'\x00', b'\xff'):
+                    errors.append('the header is blank')
+                if digest is None:
+                    result['sha256'] = hashlib.sha256(image).hexdigest()
+            finally:
+                image.close()
+    except (IOError, OSError, ValueError) as e:
+        errors.append('could not be read: {}'.format(e))
+    return result
+
+
+def _inspect_all(jobs, workers=None):
+    """Inspect the images in a pool of processes, or in this process if there is only one"""
+    processes = min(workers or multiprocessing.cpu_count(), len(jobs))
+    if processes <= 1:
+        return [inspect_image(job) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        # One image at a time, so that a large image doesn't hold up the smaller ones queued behind it
+        return pool.map(inspect_image, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_manifest(manifest):
+    """Load the expected checksums of images
+    :param manifest: path to a file in the format of sha256sum ('<sha256>  <file name>' per line)
+    :return: a dict of file name to SHA-256
+    """
+    expected = {}
+    with open(manifest) as fp:
+        for line in fp:
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                expected[os.path.basename(fields[1].strip().lstrip('*'))] = fields[0].lower()
+    return expected
+
+
+def verify_images(paths, cache=None, workers=None, expected=None):
+    """Verify firmware images in parallel
+
+    :param paths: the paths to the images
+    :param cache: an optional FirmwareCache, images it has verified since they last changed are not verified again
+    :param workers: the number of processes verifying images at once, one per CPU core by default
+    :param expected: an optional dict of file name to the SHA-256 the image must have, see load_manifest()
+    :return: a list of results in the order of the paths, each with 'valid', 'errors' and whether it was 'cached'
+    """
+    results = [None] * len(paths)
+    jobs = []
+    indexes = []
+    for index, path in enumerate(paths):
+        path = os.path.abspath(path)
+        if not os.path.isfile(path):
+            results[index] = {'path': path, 'size': None, 'mtime': None, 'sha256': None, 'kind': None,
+                              'version': None, 'errors': ['does not exist'], 'cached': False}
+            continue
+        known = cache.verification(path) if cache is not None else None
+        if known is not None:
+            known['cached'] = True
+            results[index] = known
+            continue
+        stat = os.stat(path)
+        jobs.append((path, stat.st_size, stat.st_mtime, cache.cached_digest(path) if cache is not None else None))
+        indexes.append(index)
+
+    if jobs:
+        start = time.time()
+        inspected = _inspect_all(jobs, workers=workers)
+        LOG.debug("Verified %s images in %.2fs.", len(jobs), time.time() - start)
+        if cache is not None:
+            cache.record_verifications(inspected)
+        for index, result in zip(indexes, inspected):
+            results[index] = dict(result, cached=False)
+
+    for result in results:
+        # The expected checksums aren't cached, so that a new manifest is always checked
+        result['errors'] = list(result['errors'])
+        name = os.path.basename(result['path'])
+        if expected and name in expected and result['sha256'] is not None and result['sha256'] != expected[name]:
+            result['errors'].append('its SHA-256 does not match the manifest')
+        result['valid'] = not result['errors']
+    return results
+
+
+def require_valid_images(paths, cache=None, workers=None, expected=None):
+    """Verify firmware images, and refuse to go on if any of them is invalid
+    :return: the results of verify_images()
+    :raise InvalidImageError: if an image failed its verification
+    """
+    results = verify_images(paths, cache=cache, workers=workers, expected=expected)
+    invalid = [result for result in results if not result['valid']]
+    for result in results:
+        LOG.info("%s: %s%s", os.path.basename(result['path']), 'valid' if result['valid'] else 'INVALID',
+                 ' (verified earlier)' if result['cached'] else '')
+    if invalid:
+        raise InvalidImageError('; '.join('{}: {}'.format(result['path'], ', '.join(result['errors']))
+                                          for result in invalid))
+    return results
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    expected = load_manifest(args.get('--sha256')) if args.get('--sha256') else None
+    cache = FirmwareCache()
+
+    start = time.time()
+    results = verify_images(args.get('<image>'), cache=cache,
+                            workers=int(args.get('--workers')) if args.get('--workers') else None, expected=expected)
+    elapsed = time.time() - start
+
+    print('{:>7} {:>10} {:>14} {:>12} {:>16}  {}'.format('status', 'kind', 'version', 'bytes', 'sha256', 'image'))
+    for result in results:
+        print('{:>7} {:>10} {:>14} {:>12} {:>16}  {}{}'.format(
+            'valid' if result['valid'] else 'INVALID', result['kind'] or '-', result['version'] or '-',
+            result['size'] if result['size'] is not None else '-', (result['sha256'] or '-')[:16], result['path'],
+            '  ' + ', '.join(result['errors']) if result['errors'] else ''))
+    LOG.info("Verified %s images in %.2fs, %s of them earlier.", len(results), elapsed,
+             sum(1 for result in results if result['cached']))
+    if not all(result['valid'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    main()
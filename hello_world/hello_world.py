@@ -1,13 +1,16 @@
-import requests
 from pprint import pprint
 
+from client import new_session
+from json_stream import iter_json
+
 
 def main():
     """Issue a simple request to list the monitored systems"""
-    result = requests.get('http://mpstack.wic.openenglab.netapp.com:8081/devmgr/v2/storage-systems',
-                          headers={'Accept': 'application/json'},
-                          auth=('rw', 'rw'))
-    pprint(result.json())
+    session = new_session(auth=('rw', 'rw'), headers={'Accept': 'application/json'})
+    result = session.get('http://mpstack.wic.openenglab.netapp.com:8081/devmgr/v2/storage-systems', stream=True)
+    result.raise_for_status()
+    for system in iter_json(result):
+        pprint(system)
 
 
 if __name__ == '__main__':
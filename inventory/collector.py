@@ -0,0 +1,116 @@
+"""
+Inventory Collector.
+
+Usage:
+  collector <snapshot> [--workers=<n>]
+  collector -h | --help
+Arguments:
+  snapshot  The snapshot file to write
+Options:
+  -h --help      Show this screen.
+  --workers=<n>  The maximum number of storage-systems crawled at once [default: 16]
+
+Description:
+  Crawls the storage-pools, volumes and drives of every storage-system known to the Web Services instance in
+  configuration.json, and writes them to a columnar snapshot that can be queried offline (see inventory.snapshot).
+"""
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+from pprint import pprint
+
+import docopt
+
+from base import Properties, get_session
+from inventory.snapshot import SCHEMA, encode_table, write_snapshot
+
+LOG = logging.getLogger(__name__)
+
+# The resources collected for each storage-system, by table
+RESOURCES = {'pools': 'storage-pools',
+             'volumes': 'volumes',
+             'drives': 'drives'}
+
+# The inventory has to be current, so responses are never taken from the response cache
+FRESH = {'Cache-Control': 'no-cache'}
+
+
+def get_systems(con, server):
+    result = con.get('http://{server}/devmgr/v2/storage-systems'.format(server=server), headers=FRESH)
+    result.raise_for_status()
+    return result.json()
+
+
+def crawl_system(con, server, sys_id):
+    """Fetch the inventory of one storage-system
+    :return: a dict of table name -> list of objects
+    """
+    inventory = {}
+    for table, resource in RESOURCES.items():
+        result = con.get('http://{server}/devmgr/v2/storage-systems/{id}/{resource}'.format(
+            server=server, id=sys_id, resource=resource), headers=FRESH)
+        result.raise_for_status()
+        inventory[table] = result.json()
+    return inventory
+
+
+def collect(snapshot, server=None, workers=16, con=None):
+    """Crawl every storage-system and write a snapshot of the inventory
+    :param snapshot: the snapshot file to write
+    :param server: the host:port of the Web Services instance, the configured server by default
+    :param workers: the maximum number of storage-systems crawled at once
+    :param con: the session to use, a new one is created by default
+    :return: statistics describing the crawl
+    """
+    server = server or Properties().server
+    con = con or get_session()
+    start = time.time()
+    systems = get_systems(con, server)
+
+    def crawl(system):
+        try:
+            return system['id'], crawl_system(con, server, system['id']), None
+        except Exception as e:
+            LOG.warn("Unable to collect the inventory of [%s]: %s", system['id'], e)
+            return system['id'], None, str(e)
+
+    tables = {'systems': encode_table('systems', None, systems)}
+    for table in RESOURCES:
+        tables[table] = dict((name, []) for name, _, _ in SCHEMA[table])
+
+    errors = {}
+    pool = ThreadPool(max(1, min(workers, len(systems))))
+    try:
+        # Encode each system as soon as it has been crawled, rather than holding the whole fleet's JSON. The systems
+        # are encoded in a stable order, so that successive snapshots of an unchanged fleet hold identical columns.
+        for sys_id, inventory, error in pool.imap(crawl, systems):
+            if error is not None:
+                errors[sys_id] = error
+                continue
+            for table, objects in inventory.items():
+                encode_table(table, sys_id, objects, tables[table])
+    finally:
+        pool.close()
+        pool.join()
+    crawled = time.time() - start
+
+    size = write_snapshot(snapshot, tables, metadata={'server': server, 'errors': errors})
+    stats = {'systems': len(systems),
+             'failed': len(errors),
+             'errors': errors,
+             'crawl_time': crawled,
+             'elapsed': time.time() - start,
+             'size': size}
+    for table in RESOURCES:
+        stats[table] = len(tables[table]['id'])
+    return stats
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(relativeCreated)dms %(levelname)s %(module)s.%(funcName)s:%(lineno)d\n %(message)s')
+    args = docopt.docopt(__doc__)
+    stats = collect(args.get('<snapshot>'), workers=int(args.get('--workers')))
+    LOG.info("Collected %s systems (%s failed) with %s drives in %.1fs, the snapshot is %s bytes.", stats['systems'],
+             stats['failed'], stats['drives'], stats['elapsed'], stats['size'])
+    pprint(stats)
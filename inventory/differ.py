@@ -0,0 +1,232 @@
+"""
+Inventory Differ.
+
+Usage:
+  differ diff <old> <new>
+  differ watch <directory> [--interval=<s>] [--cycles=<n>] [--workers=<n>]
+  differ -h | --help
+Arguments:
+  old        The earlier snapshot
+  new        The later snapshot
+  directory  Where to keep the snapshots collected while watching
+Options:
+  -h --help       Show this screen.
+  --interval=<s>  The number of seconds between the start of two collections [default: 300]
+  --cycles=<n>    Stop after this many collections, rather than watching indefinitely
+  --workers=<n>   The maximum number of storage-systems crawled at once [default: 16]
+
+Description:
+  Compares two inventory snapshots (see inventory.snapshot) and emits only what changed, one JSON event per line:
+  storage-systems, pools, volumes and drives that were added or removed, and changes to the status and firmware
+  version of systems and drives and to the status of volumes.
+
+  Successive snapshots of a fleet are mostly identical, so the comparison works on the stored columns rather than
+  on JSON documents. A column whose bytes are identical in both snapshots is skipped without looking at any row; if
+  the rows of a table are unchanged, rows are compared by position, and only otherwise matched by id. Values are only
+  decoded for the rows that changed.
+
+  Storage-systems that could not be collected for either snapshot are not reported as having lost or gained objects.
+
+  'watch' collects a new snapshot every interval, and reports the changes since the previous one along with how long
+  collecting and comparing took.
+"""
+import itertools
+import json
+import logging
+import operator
+import os
+import sys
+import time
+
+import docopt
+
+from inventory.collector import collect
+from inventory.snapshot import Snapshot
+
+LOG = logging.getLogger(__name__)
+
+# The tables to compare, in order, with the columns whose changes are reported
+WATCHED = [('systems', ['status', 'fwVersion']),
+           ('pools', []),
+           ('volumes', ['status']),
+           ('drives', ['status', 'firmwareVersion'])]
+
+
+def _event(table, change, key, field=None, old=None, new=None):
+    return {'table': table, 'change': change, 'system': key[0], 'id': key[1], 'field': field, 'old': old, 'new': new}
+
+
+def _key(table, index):
+    """The (system, id) of a row, a storage-system is its own system"""
+    sys_id = table.value('id', index)
+    return (table.value('system', index) if 'system' in table.columns else sys_id), sys_id
+
+
+def _keys(table):
+    """The (system, id) of every row"""
+    ids = table.dictionary('id').values()
+    keys = [ids[code] for code in table.codes('id')]
+    if 'system' not in table.columns:
+        return list(zip(keys, keys))
+    systems = table.dictionary('system').values()
+    return list(zip([systems[code] for code in table.codes('system')], keys))
+
+
+def _translation(old, new, column):
+    """Map the codes of a string column in the old snapshot to the codes of the same values in the new snapshot"""
+    if old.columns[column]['type'] != 'str':
+        return None
+    dictionary = new.dictionary(column)
+    return [dictionary.code(value) for value in old.dictionary(column).values()]
+
+
+def _changed(old_codes, new_codes, translation, pairs=None):
+    """Find the rows whose value changed
+    :param pairs: the (old index, new index) of the rows to compare, or None to compare the rows by position
+    :return: the (old index, new index) of the changed rows
+    """
+    if pairs is None:
+        # Compare whole columns without a Python-level loop over the rows
+        if translation is not None:
+            old_codes = map(translation.__getitem__, old_codes)
+        indexes = itertools.compress(itertools.count(), map(operator.ne, old_codes, new_codes))
+        return [(index, index) for index in indexes]
+    if translation is None:
+        return [(old_index, new_index) for old_index, new_index in pairs if old_codes[old_index] != new_codes[new_index]]
+    return [(old_index, new_index) for old_index, new_index in pairs
+            if translation[old_codes[old_index]] != new_codes[new_index]]
+
+
+def diff_table(name, old, new, columns, stats=None, unknown=()):
+    """Compare a table of two snapshots
+    :param name: the name of the table
+    :param old: the Table of the earlier snapshot
+    :param new: the Table of the later snapshot
+    :param columns: the columns whose changes are reported
+    :param stats: an optional dict to count the aligned tables in
+    :param unknown: the systems that could not be collected for either snapshot, their objects are not reported as
+     added or removed
+    :return: a generator of change events
+    """
+    aligned = old.raw('id') == new.raw('id') and ('system' not in old.columns or old.raw('system') == new.raw('system'))
+    if aligned:
+        # The same rows in the same order, nothing was added or removed
+        pairs = None
+        if stats is not None:
+            stats['aligned'].append(name)
+    else:
+        old_keys, new_keys = _keys(old), _keys(new)
+        old_index = dict((key, index) for index, key in enumerate(old_keys))
+        new_index = dict((key, index) for index, key in enumerate(new_keys))
+        for key in new_keys:
+            if key not in old_index and key[0] not in unknown:
+                yield _event(name, 'added', key)
+        for key in old_keys:
+            if key not in new_index and key[0] not in unknown:
+                yield _event(name, 'removed', key)
+        pairs = [(old_index[key], index) for index, key in enumerate(new_keys) if key in old_index]
+
+    for column in columns:
+        if column not in old.columns or column not in new.columns:
+            continue
+        if aligned and old.raw(column) == new.raw(column):
+            continue
+        if aligned and old.raw(column)[1:] == new.raw(column)[1:]:
+            # The same dictionary, so the codes can be compared directly
+            translation = None
+        else:
+            translation = _translation(old, new, column)
+        changed = _changed(old.codes(column), new.codes(column), translation, pairs)
+        for old_position, new_position in changed:
+            yield _event(name, 'changed', _key(new, new_position), column, old.value(column, old_position),
+                         new.value(column, new_position))
+
+
+def diff(old, new, stats=None):
+    """Compare two snapshots
+    :param old: the earlier Snapshot
+    :param new: the later Snapshot
+    :param stats: an optional dict that is given the time taken, the number of events and rows, and the tables whose
+     rows were unchanged, once every event has been generated
+    :return: a generator of change events: dicts with the table, change ('added', 'removed' or 'changed'), system,
+     id and, for changes, the field with its old and new value
+    """
+    start = time.time()
+    counts = {'events': 0, 'rows': 0, 'aligned': []}
+    unknown = set(old.metadata.get('errors', {})) | set(new.metadata.get('errors', {}))
+    for name, columns in WATCHED:
+        if name not in old.tables or name not in new.tables:
+            continue
+        counts['rows'] += new.table(name).rows
+        for event in diff_table(name, old.table(name), new.table(name), columns, counts, unknown):
+            counts['events'] += 1
+            yield event
+    if stats is not None:
+        stats.update(counts)
+        stats['diff_time'] = time.time() - start
+
+
+class InventoryWatcher(object):
+    """Collects the inventory periodically and reports what changed between collections"""
+
+    def __init__(self, directory, interval=300, workers=16, server=None):
+        """
+        :param directory: where to keep the snapshots, the last two are kept
+        :param interval: the number of seconds between the start of two collections
+        :param workers: the maximum number of storage-systems crawled at once
+        :param server: the host:port of the Web Services instance, the configured server by default
+        """
+        self.directory = directory
+        self.interval = interval
+        self.workers = workers
+        self.server = server
+        self.cycles = []
+
+    def run(self, cycles=None):
+        """Collect and compare, yielding the change events of every cycle
+        :param cycles: the number of collections to make, or None to continue indefinitely
+        """
+        previous = None
+        cycle = 0
+        try:
+            while cycles is None or cycle < cycles:
+                start = time.time()
+                path = os.path.join(self.directory, 'inventory-{}.snap'.format(cycle % 2))
+                collected = collect(path, server=self.server, workers=self.workers)
+                current = Snapshot(path)
+                stats = {'cycle': cycle, 'collect_time': collected['elapsed'], 'systems': collected['systems'],
+                         'failed': collected['failed'], 'events': 0, 'diff_time': 0.0}
+                if previous is not None:
+                    for event in diff(previous, current, stats):
+                        yield event
+                    previous.close()
+                previous = current
+                stats['elapsed'] = time.time() - start
+                self.cycles.append(stats)
+                LOG.info("Cycle %s: %s events, collected in %.1fs and compared in %.1fms.", cycle, stats['events'],
+                         stats['collect_time'], 1000 * stats['diff_time'])
+
+                cycle += 1
+                if cycles is None or cycle < cycles:
+                    time.sleep(max(0.0, self.interval - (time.time() - start)))
+        finally:
+            if previous is not None:
+                previous.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(relativeCreated)dms %(levelname)s %(module)s.%(funcName)s:%(lineno)d\n %(message)s')
+    args = docopt.docopt(__doc__)
+    if args.get('diff'):
+        stats = {}
+        with Snapshot(args.get('<old>')) as old, Snapshot(args.get('<new>')) as new:
+            for event in diff(old, new, stats):
+                sys.stdout.write(json.dumps(event, sort_keys=True) + '\n')
+        LOG.info("%s events across %s rows in %.1fms.", stats['events'], stats['rows'], 1000 * stats['diff_time'])
+    else:
+        watcher = InventoryWatcher(args.get('<directory>'), interval=float(args.get('--interval')),
+                                   workers=int(args.get('--workers')))
+        for event in watcher.run(int(args.get('--cycles')) if args.get('--cycles') else None):
+            sys.stdout.write(json.dumps(event, sort_keys=True) + '\n')
+            sys.stdout.flush()
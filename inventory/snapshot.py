@@ -0,0 +1,405 @@
+"""
+Inventory Snapshot.
+
+Usage:
+  snapshot summary <snapshot>
+  snapshot drives <snapshot> [--status=<s>]
+  snapshot pools <snapshot> [--above=<fraction>]
+  snapshot -h | --help
+Arguments:
+  snapshot  A snapshot file written by the inventory collector
+Options:
+  -h --help           Show this screen.
+  --status=<s>        List the drives with this status, rather than every drive that is not optimal
+  --above=<fraction>  List the pools that are fuller than this fraction [default: 0.8]
+
+Description:
+  A snapshot stores the systems, storage-pools, volumes and drives of a fleet column by column rather than as JSON.
+  Numbers are stored as packed arrays, and strings are dictionary-encoded: each distinct value is stored once and the
+  column holds the index of each row's value. The file is memory-mapped, so a query only reads the columns it needs,
+  and compares integer codes rather than strings:
+
+      snapshot = Snapshot('fleet.snap')
+      drives = non_optimal_drives(snapshot)
+      pools = pools_above(snapshot, 0.8)
+
+  The file starts with a magic number and the length of a small JSON header describing the tables and columns. The
+  sections follow, each aligned to 8 bytes: the data of every column and, for string columns, the dictionary as the
+  concatenated UTF-8 values and an array of their offsets. Dictionary values are only decoded when a row needs them.
+"""
+import functools
+import itertools
+import json
+import logging
+import mmap
+import operator
+import os
+import struct
+import sys
+import time
+from array import array
+from pprint import pprint
+
+import docopt
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'SANSNAP1'
+HEADER = struct.Struct('<8sI')
+
+STRING_TYPES = (str, type(u''))
+
+# The array typecode used for each column type
+TYPECODES = {'str': 'I',
+             'float': 'd',
+             'int': 'i',
+             'bool': 'b'}
+
+# table -> [(column, type, key of the value in the API object, dotted for nested objects)]
+SCHEMA = {
+    'systems': [('id', 'str', 'id'),
+                ('name', 'str', 'name'),
+                ('status', 'str', 'status'),
+                ('fwVersion', 'str', 'fwVersion'),
+                ('model', 'str', 'model')],
+    'pools': [('system', 'str', None),
+              ('id', 'str', 'id'),
+              ('name', 'str', 'name'),
+              ('raidLevel', 'str', 'raidLevel'),
+              ('totalRaidedSpace', 'float', 'totalRaidedSpace'),
+              ('usedSpace', 'float', 'usedSpace'),
+              ('freeSpace', 'float', 'freeSpace')],
+    'volumes': [('system', 'str', None),
+                ('id', 'str', 'id'),
+                ('name', 'str', 'name'),
+                ('volumeGroupRef', 'str', 'volumeGroupRef'),
+                ('capacity', 'float', 'capacity'),
+                ('status', 'str', 'status')],
+    'drives': [('system', 'str', None),
+               ('id', 'str', 'driveRef'),
+               ('status', 'str', 'status'),
+               ('firmwareVersion', 'str', 'firmwareVersion'),
+               ('productID', 'str', 'productID'),
+               ('serialNumber', 'str', 'serialNumber'),
+               ('rawCapacity', 'float', 'rawCapacity'),
+               ('tray', 'str', 'physicalLocation.trayRef'),
+               ('slot', 'int', 'physicalLocation.slot'),
+               ('currentVolumeGroupRef', 'str', 'currentVolumeGroupRef'),
+               ('hotSpare', 'bool', 'hotSpare')],
+}
+
+
+def _lookup(obj, key):
+    for part in key.split('.'):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(part)
+    return obj
+
+
+def _to_bytes(column):
+    return column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+
+
+def encode_table(table, system_id, objects, columns=None):
+    """Convert API objects into the columns of a table
+    :param table: the name of the table, see SCHEMA
+    :param system_id: the id of the storage-system the objects belong to
+    :param objects: the objects, as returned by the API
+    :param columns: the columns to append to, new columns are returned if not given
+    :return: a dict of column name -> list of values
+    """
+    columns = columns if columns is not None else dict((name, []) for name, _, _ in SCHEMA[table])
+    for name, kind, key in SCHEMA[table]:
+        values = columns[name]
+        if key is None:
+            values.extend([system_id] * len(objects))
+            continue
+        for obj in objects:
+            value = _lookup(obj, key)
+            if kind == 'str':
+                values.append(value if value is None or isinstance(value, STRING_TYPES) else str(value))
+            elif kind == 'float':
+                values.append(float(value or 0))
+            elif kind == 'int':
+                values.append(int(value or 0))
+            else:
+                values.append(bool(value))
+    return columns
+
+
+def write_snapshot(path, tables, metadata=None):
+    """Write tables to a snapshot file
+    :param path: the file to write, it is replaced atomically
+    :param tables: a dict of table name -> dict of column name -> list of values, see encode_table()
+    :param metadata: optional information to store in the header, such as when the inventory was collected
+    :return: the size of the file
+    """
+    header = {'byteorder': sys.byteorder, 'created': time.time(), 'metadata': metadata or {}, 'tables': {}}
+    chunks = []
+    offset = [0]
+
+    def section(data):
+        padding = -len(data) % 8
+        chunks.append(data + b'\0' * padding)
+        location = {'offset': offset[0], 'length': len(data)}
+        offset[0] += len(data) + padding
+        return location
+
+    for table, columns in tables.items():
+        types = dict((name, kind) for name, kind, _ in SCHEMA[table])
+        rows = len(next(iter(columns.values()))) if columns else 0
+        described = {}
+        for name, values in columns.items():
+            kind = types[name]
+            description = {'type': kind, 'typecode': TYPECODES[kind]}
+            if kind == 'str':
+                # None is stored as code 0, the dictionary holds the values of codes 1 and up
+                codes, strings, offsets = {None: 0}, [], array('I', [0])
+                encoded = array('I')
+                for value in values:
+                    code = codes.get(value)
+                    if code is None:
+                        code = codes[value] = len(codes)
+                        strings.append(value.encode('utf-8'))
+                        offsets.append(offsets[-1] + len(strings[-1]))
+                    encoded.append(code)
+                description['dictionary'] = {'size': len(strings),
+                                             'strings': section(b''.join(strings)),
+                                             'offsets': dict(section(_to_bytes(offsets)), typecode='I')}
+            else:
+                encoded = array(TYPECODES[kind], values)
+            description.update(section(_to_bytes(encoded)))
+            described[name] = description
+        header['tables'][table] = {'rows': rows, 'columns': described}
+
+    encoded_header = json.dumps(header).encode('utf-8')
+    start = HEADER.size + len(encoded_header)
+    start += -start % 8
+    header_padding = start - HEADER.size - len(encoded_header)
+
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, len(encoded_header)))
+        fp.write(encoded_header + b' ' * header_padding)
+        for chunk in chunks:
+            fp.write(chunk)
+    os.rename(path + '.tmp', path)
+    return start + offset[0]
+
+
+class Dictionary(object):
+    """The distinct values of a string column, decoded on demand"""
+
+    def __init__(self, snapshot, description):
+        self.snapshot = snapshot
+        self.size = description['size']
+        self.description = description
+        self._strings = snapshot._start + description['strings']['offset']
+        self._offsets = snapshot._read(description['offsets'])
+        self._codes = None
+
+    def __len__(self):
+        return self.size + 1
+
+    def __getitem__(self, code):
+        if code == 0:
+            return None
+        start = self._strings + self._offsets[code - 1]
+        return self.snapshot._map[start:self._strings + self._offsets[code]].decode('utf-8')
+
+    def values(self):
+        """Decode every value, indexed by code"""
+        strings = self.snapshot._bytes(self.description['strings']).decode('utf-8') if self.size else u''
+        if len(strings) == self.description['strings']['length']:
+            # Only ASCII, so the byte offsets are also character offsets
+            offsets = self._offsets
+            return [None] + [strings[offsets[code]:offsets[code + 1]] for code in range(self.size)]
+        return [self[code] for code in range(len(self))]
+
+    def code(self, value):
+        """Get the code of a value, or None if no row holds the value. The first call decodes every value."""
+        if self._codes is None:
+            self._codes = dict((value, code) for code, value in enumerate(self.values()))
+        return self._codes.get(value)
+
+
+class Table(object):
+    """A table of a snapshot, its columns are read from the file when first used"""
+
+    def __init__(self, snapshot, name, description):
+        self.snapshot = snapshot
+        self.name = name
+        self.rows = description['rows']
+        self.columns = description['columns']
+        self._arrays = {}
+        self._dictionaries = {}
+
+    def codes(self, column):
+        """Get the raw column: the dictionary codes of a string column, or the values of any other column"""
+        if column not in self._arrays:
+            self._arrays[column] = self.snapshot._read(self.columns[column])
+        return self._arrays[column]
+
+    def dictionary(self, column):
+        if column not in self._dictionaries:
+            self._dictionaries[column] = Dictionary(self.snapshot, self.columns[column]['dictionary'])
+        return self._dictionaries[column]
+
+    def code(self, column, value):
+        """Get the code of a value in a string column, or None if no row holds the value"""
+        return self.dictionary(column).code(value)
+
+    def raw(self, column):
+        """Get the stored bytes of a column, including its dictionary; equal bytes mean equal values in every row"""
+        description = self.columns[column]
+        if description['type'] != 'str':
+            return self.snapshot._bytes(description),
+        dictionary = description['dictionary']
+        return (self.snapshot._bytes(description), self.snapshot._bytes(dictionary['strings']),
+                self.snapshot._bytes(dictionary['offsets']))
+
+    def value(self, column, index):
+        raw = self.codes(column)[index]
+        if self.columns[column]['type'] == 'str':
+            return self.dictionary(column)[raw]
+        if self.columns[column]['type'] == 'bool':
+            return bool(raw)
+        return raw
+
+    def row(self, index):
+        """Get a single row as a dict"""
+        return dict((column, self.value(column, index)) for column in self.columns)
+
+    def rows_at(self, indexes, columns=None):
+        """Get several rows as dicts
+        :param indexes: the indexes of the rows
+        :param columns: the columns to include, every column by default
+        """
+        columns = list(columns or self.columns)
+        decoders = []
+        for column in columns:
+            kind = self.columns[column]['type']
+            decoders.append((self.codes(column), self.dictionary(column).__getitem__ if kind == 'str'
+                             else bool if kind == 'bool' else None))
+        return [dict(zip(columns, [decode(raw[index]) if decode else raw[index] for raw, decode in decoders]))
+                for index in indexes]
+
+    def where(self, column, predicate):
+        """Get the indexes of the rows whose raw value (the code, for a string column) matches a predicate"""
+        return list(itertools.compress(range(self.rows), map(predicate, self.codes(column))))
+
+
+class Snapshot(object):
+    """A memory-mapped snapshot file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'rb')
+        self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = HEADER.unpack(self._map[:HEADER.size])
+        if magic != MAGIC:
+            raise ValueError('{} is not an inventory snapshot.'.format(path))
+        self.header = json.loads(self._map[HEADER.size:HEADER.size + length].decode('utf-8'))
+        start = HEADER.size + length
+        self._start = start + -start % 8
+        self.metadata = self.header['metadata']
+        self.created = self.header['created']
+        self.tables = dict((name, Table(self, name, description))
+                           for name, description in self.header['tables'].items())
+
+    def _bytes(self, location):
+        start = self._start + location['offset']
+        return self._map[start:start + location['length']]
+
+    def _read(self, description):
+        start = self._start + description['offset']
+        end = start + description['length']
+        swap = self.header['byteorder'] != sys.byteorder
+        if sys.version_info[0] >= 3 and not swap:
+            # A view of the mapped file, nothing is copied
+            return memoryview(self._map)[start:end].cast(description['typecode'])
+        column = array(description['typecode'])
+        if hasattr(column, 'frombytes'):
+            column.frombytes(self._map[start:end])
+        else:
+            column.fromstring(self._map[start:end])
+        if swap:
+            column.byteswap()
+        return column
+
+    def table(self, name):
+        return self.tables[name]
+
+    def close(self):
+        # Views of the map have to be released before it can be closed
+        for table in self.tables.values():
+            table._arrays.clear()
+            table._dictionaries.clear()
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def drives_with_status(snapshot, status):
+    """Get the drives that have a given status"""
+    drives = snapshot.table('drives')
+    code = drives.code('status', status)
+    if code is None:
+        return []
+    return drives.rows_at(drives.where('status', functools.partial(operator.eq, code)))
+
+
+def non_optimal_drives(snapshot):
+    """Get every drive whose status is not 'optimal'"""
+    drives = snapshot.table('drives')
+    optimal = drives.code('status', 'optimal')
+    if optimal is None:
+        return drives.rows_at(range(drives.rows))
+    return drives.rows_at(drives.where('status', functools.partial(operator.ne, optimal)))
+
+
+def pools_above(snapshot, fraction=0.8):
+    """Get the storage-pools that are more than a fraction full"""
+    pools = snapshot.table('pools')
+    used, total = pools.codes('usedSpace'), pools.codes('totalRaidedSpace')
+    indexes = [index for index in range(pools.rows) if total[index] and used[index] > fraction * total[index]]
+    matches = pools.rows_at(indexes)
+    for index, pool in zip(indexes, matches):
+        pool['fill'] = used[index] / total[index]
+    return matches
+
+
+def summarize(snapshot):
+    """Count the rows of every table"""
+    summary = dict((name, table.rows) for name, table in snapshot.tables.items())
+    summary['created'] = snapshot.created
+    summary['metadata'] = snapshot.metadata
+    summary['size'] = os.path.getsize(snapshot.path)
+    return summary
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(relativeCreated)dms %(levelname)s %(module)s.%(funcName)s:%(lineno)d\n %(message)s')
+    args = docopt.docopt(__doc__)
+    with Snapshot(args.get('<snapshot>')) as snapshot:
+        start = time.time()
+        if args.get('drives'):
+            result = (drives_with_status(snapshot, args.get('--status')) if args.get('--status')
+                      else non_optimal_drives(snapshot))
+        elif args.get('pools'):
+            result = pools_above(snapshot, float(args.get('--above')))
+        else:
+            result = summarize(snapshot)
+        elapsed = time.time() - start
+        pprint(result)
+        if isinstance(result, list):
+            LOG.info("%s matches in %.1fms.", len(result), 1000 * elapsed)
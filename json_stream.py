@@ -0,0 +1,131 @@
+"""
+Incremental parsing of the JSON arrays returned by collection endpoints.
+
+Endpoints such as storage-systems, storage-pools, volumes and drives return a single JSON array. Calling .json() on
+the response builds every object of the array in memory before the first one can be looked at; for a proxy that
+monitors many systems that can be tens of MB of text and several times as much in Python objects. iter_json() instead
+parses the array element by element as the body arrives, so only one element is held at a time, and the rest of the
+body is not read at all if the caller stops early:
+
+    response = session.get(pools_url, stream=True)
+    response.raise_for_status()
+    with contextlib.closing(iter_json(response)) as pools:
+        pool = next((pool for pool in pools if pool['name'] == name), None)
+
+A response that is not an array (a single object) is yielded as one item. Stopping early closes the response, and its
+connection is discarded rather than returned to the pool since the rest of the body was never read.
+"""
+import codecs
+import json
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+NUMBER = '0123456789+-.eE'
+
+_decoder = json.JSONDecoder()
+
+
+def iter_items(chunks, decoder=None):
+    """Parse a JSON document from an iterable of text chunks
+    :param chunks: an iterable of strings that make up the document
+    :param decoder: the JSONDecoder to use
+    :return: a generator of the elements of the top-level array, or of the single top-level value if it isn't an array
+    :raise ValueError if the document is not valid JSON
+    """
+    decoder = decoder or _decoder
+    chunks = iter(chunks)
+    state = {'buffer': u'', 'position': 0, 'exhausted': False}
+
+    def more(minimum=1):
+        """Append at least minimum characters to the buffer, return False if the document has ended"""
+        buffer = state['buffer'][state['position']:]
+        state['position'] = 0
+        added = 0
+        pieces = [buffer]
+        while added < minimum:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                state['exhausted'] = True
+                break
+            pieces.append(chunk)
+            added += len(chunk)
+        state['buffer'] = u''.join(pieces)
+        return added > 0
+
+    def skip_whitespace():
+        while True:
+            buffer, position = state['buffer'], state['position']
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            state['position'] = position
+            if position < len(buffer) or not more():
+                return position < len(buffer)
+
+    def decode():
+        """Decode the value at the current position, reading more of the document as needed"""
+        while True:
+            buffer, position = state['buffer'], state['position']
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if state['exhausted']:
+                    raise
+                # Read at least as much again as is pending, so a large value isn't re-parsed for every chunk
+                more(max(len(buffer) - position, 1))
+                continue
+            # A number or literal that ends with the buffer may continue in the next chunk, as may a number that is
+            # only followed by the start of a fraction or exponent ('1.' of '1.5')
+            if buffer[end - 1] not in '}]"' and not buffer[end:].strip(NUMBER) and not state['exhausted']:
+                more()
+                continue
+            state['position'] = end
+            return value
+
+    if not skip_whitespace():
+        raise ValueError('Expecting value: the document is empty')
+    if state['buffer'][state['position']] != '[':
+        yield decode()
+        return
+
+    state['position'] += 1
+    first = True
+    while True:
+        if not skip_whitespace():
+            raise ValueError('Unterminated array')
+        character = state['buffer'][state['position']]
+        if character == ']':
+            return
+        if not first:
+            if character != ',':
+                raise ValueError("Expecting ',' delimiter at character {}".format(state['position']))
+            state['position'] += 1
+            if not skip_whitespace():
+                raise ValueError('Unterminated array')
+        first = False
+        yield decode()
+
+
+def iter_text(response, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Decode the body of a response into text, chunk by chunk"""
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    for chunk in response.iter_content(chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def iter_json(response, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Parse the body of a response incrementally, it should be requested with stream=True
+    :param response: the requests Response
+    :param chunk_size: the number of bytes read at a time
+    :return: a generator of the elements of a JSON array, or of the single value of any other document
+    """
+    try:
+        for item in iter_items(iter_text(response, chunk_size)):
+            yield item
+    finally:
+        response.close()
@@ -0,0 +1,536 @@
+"""
+An in-process mock of the SANtricity Web Services API, for exercising the samples without an array.
+
+The mock serves the /devmgr/v2 endpoints the samples use for a simulated fleet of storage-systems:
+
+    storage-systems, storage-pools, volumes, drives, firmware/drives (compatibilities, initiate-upgrade, state),
+    files/drive, health-check, firmware/embedded-firmware (with staging and activation), auto-support (jobs, bundle
+    files and configuration) and /devmgr/utils/login
+
+It acts as a Web Services Proxy managing every system of the fleet, and also as the Embedded Web Services of each
+system: the controllers of system n are served under /embedded/<n>/a and /embedded/<n>/b, so a controller address
+is 'http://host:port/embedded/<n>/a', and a 'server' (host:port) is 'host:port/embedded/<n>/a'.
+
+    with MockServer(systems=100, latency=0.005) as mock:
+        collect('inventory.snap', server=mock.address)
+
+Long-running operations take a configurable time: drive firmware downloads, health checks, AutoSupport jobs, and
+controller reboots, during which the controllers of a system answer every request with 503. A fraction of requests can
+be failed at random, and a fraction of systems made to fail their health check. Every request is counted and timed,
+see MockServer.stats().
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+LOG = logging.getLogger(__name__)
+
+GIB = 1024 ** 3
+TIB = 1024 ** 4
+
+FIRMWARE_VERSION = '08.40.00.00'
+UPGRADED_FIRMWARE_VERSION = '08.50.00.00'
+DRIVE_FIRMWARE_VERSION = 'MS02'
+UPGRADED_DRIVE_FIRMWARE_VERSION = 'MS03'
+
+EMBEDDED = re.compile(r'^/embedded/(\d+)/(\w+)(/.*)$')
+
+
+def percentile(values, fraction):
+    """Get a percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class MockFleet(object):
+    """The state of the simulated storage-systems"""
+
+    def __init__(self, systems=1, drives=24, pools=4, volumes=8, seed=1):
+        """
+        :param systems: the number of storage-systems
+        :param drives: the number of drives of each storage-system
+        :param pools: the number of storage-pools of each storage-system
+        :param volumes: the number of volumes defined on each storage-system
+        :param seed: the seed of the generated inventory
+        """
+        rand = random.Random(seed)
+        self.lock = threading.RLock()
+        self.systems = []
+        self.by_id = {}
+        for index in range(systems):
+            sys_id = 'system{:04}'.format(index)
+            system = {'id': sys_id, 'index': index, 'name': 'array-{:04}'.format(index), 'status': 'optimal',
+                      'fwVersion': FIRMWARE_VERSION, 'model': '5700', 'staged': None, 'reboot_until': None,
+                      'drive_download': None, 'pools': [], 'volumes': [], 'drives': []}
+            for pool in range(pools):
+                used = int(rand.uniform(0.1, 0.7) * 100 * TIB)
+                system['pools'].append({'id': '{}-pool{}'.format(sys_id, pool), 'name': 'pool{}'.format(pool),
+                                        'raidLevel': 'raid6', 'totalRaidedSpace': str(100 * TIB),
+                                        'usedSpace': str(used), 'freeSpace': str(100 * TIB - used)})
+            for volume in range(volumes):
+                self._add_volume(system, 'volume{}'.format(volume), system['pools'][volume % pools], 10 * GIB)
+            for drive in range(drives):
+                system['drives'].append({
+                    'id': '{}-drive{:03}'.format(sys_id, drive), 'driveRef': '{}-drive{:03}'.format(sys_id, drive),
+                    'status': 'optimal' if rand.random() > 0.02 else 'failed',
+                    'firmwareVersion': DRIVE_FIRMWARE_VERSION, 'productID': 'X446_1606030',
+                    'serialNumber': 'SN{:04}{:04}'.format(index, drive), 'rawCapacity': str(4 * TIB),
+                    'physicalLocation': {'trayRef': '{}-tray{}'.format(sys_id, drive // 24), 'slot': drive % 24},
+                    'currentVolumeGroupRef': system['pools'][drive % pools]['id'], 'hotSpare': False})
+            self.systems.append(system)
+            self.by_id[sys_id] = system
+
+        # State that belongs to a Web Services instance: the proxy (None) or an embedded system (its index)
+        self.files = {}
+        self.health_checks = {}
+        self.asup_configurations = {}
+        self.asup_jobs = {}
+
+    @staticmethod
+    def _add_volume(system, name, pool, size):
+        volume = {'id': '{}-{}'.format(system['id'], name), 'name': name, 'volumeGroupRef': pool['id'],
+                  'capacity': str(size), 'status': 'optimal'}
+        system['volumes'].append(volume)
+        pool['usedSpace'] = str(int(pool['usedSpace']) + size)
+        pool['freeSpace'] = str(int(pool['freeSpace']) - size)
+        return volume
+
+    def summary(self, system):
+        return dict((key, system[key]) for key in ('id', 'name', 'status', 'fwVersion', 'model'))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serves a request against the MockFleet of the server"""
+    protocol_version = 'HTTP/1.1'
+
+    # (method, path pattern, handler), the first match applies
+    ROUTES = [
+        ('POST', r'/devmgr/utils/login$', 'login'),
+        ('GET', r'/devmgr/v2/storage-systems$', 'get_systems'),
+        ('GET', r'/devmgr/v2/storage-systems/([^/]+)$', 'get_system'),
+        ('GET', r'/devmgr/v2/storage-systems/([^/]+)/storage-pools$', 'get_pools'),
+        ('GET', r'/devmgr/v2/storage-systems/([^/]+)/volumes$', 'get_volumes'),
+        ('POST', r'/devmgr/v2/storage-systems/([^/]+)/volumes$', 'post_volume'),
+        ('GET', r'/devmgr/v2/storage-systems/([^/]+)/drives$', 'get_drives'),
+        ('GET', r'/devmgr/v2/storage-systems/([^/]+)/firmware/drives$', 'get_compatibilities'),
+        ('POST', r'/devmgr/v2/storage-systems/([^/]+)/firmware/drives/initiate-upgrade$', 'initiate_drive_upgrade'),
+        ('GET', r'/devmgr/v2/storage-systems/([^/]+)/firmware/drives/state$', 'get_drive_state'),
+        ('POST', r'/devmgr/v2/files/drive/?$', 'upload_drive_file'),
+        ('GET', r'/devmgr/v2/files/drive/([^/]+)$', 'get_drive_file'),
+        ('POST', r'/devmgr/v2/health-check$', 'start_health_check'),
+        ('GET', r'/devmgr/v2/health-check$', 'get_health_check'),
+        ('POST', r'/devmgr/v2/firmware/embedded-firmware/activate$', 'activate_firmware'),
+        ('POST', r'/devmgr/v2/firmware/embedded-firmware$', 'upload_controller_firmware'),
+        ('POST', r'/devmgr/v2/auto-support$', 'trigger_asup'),
+        ('GET', r'/devmgr/v2/auto-support/jobs/([^/]+)$', 'get_asup_job'),
+        ('GET', r'/devmgr/v2/auto-support/jobs/([^/]+)/file$', 'get_asup_file'),
+        ('GET', r'/devmgr/v2/auto-support/configuration$', 'get_asup_configuration'),
+        ('POST', r'/devmgr/v2/auto-support/configuration$', 'post_asup_configuration'),
+    ]
+    ROUTES = [(method, re.compile(pattern), name) for method, pattern, name in ROUTES]
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    @property
+    def fleet(self):
+        return self.server.mock.fleet
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _read_body(self):
+        length = self.headers.get('Content-Length')
+        if length is not None:
+            return self.rfile.read(int(length))
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return b''
+
+    def _handle(self, method):
+        start = time.time()
+        self.body = self._read_body()
+        url = urlparse(self.path)
+        self.query = parse_qs(url.query)
+        path = url.path
+        # The embedded system this request was made to, None for the proxy
+        self.embedded = None
+        match = EMBEDDED.match(path)
+        if match:
+            self.embedded = int(match.group(1))
+            path = match.group(3)
+
+        route = 'unknown'
+        try:
+            for route_method, pattern, name in self.ROUTES:
+                match = pattern.match(path)
+                if route_method == method and match:
+                    route = name
+                    break
+            else:
+                return self._send(404, {'errorMessage': 'No such resource [{}].'.format(path)})
+            if self.mock.latency:
+                time.sleep(self.mock.latency * self.mock.random.uniform(0.5, 1.5))
+            if self.embedded is not None:
+                if self.embedded >= len(self.fleet.systems):
+                    return self._send(404, {'errorMessage': 'No such system.'})
+                reboot_until = self.fleet.systems[self.embedded]['reboot_until']
+                if reboot_until is not None and time.time() < reboot_until:
+                    return self._send(503, {'errorMessage': 'The controller is rebooting.'})
+            if route != 'login':
+                if not self._authorized():
+                    return self._send(401, {'errorMessage': 'Not authenticated.'})
+                if self.mock.failure_rate and self.mock.random.random() < self.mock.failure_rate:
+                    return self._send(500, {'errorMessage': 'An injected failure.'})
+            getattr(self, route)(*match.groups())
+        finally:
+            self.mock.record(route, time.time() - start)
+
+    def _authorized(self):
+        for cookie in (self.headers.get('Cookie') or '').split('; '):
+            if cookie.startswith('JSESSIONID='):
+                return cookie[len('JSESSIONID='):] in self.mock.tokens
+        return True
+
+    def _send(self, status, obj=None, body=None, headers=None):
+        if body is None:
+            body = json.dumps(obj).encode('utf-8')
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self):
+        return json.loads(self.body.decode('utf-8')) if self.body else {}
+
+    def _system(self, sys_id):
+        """Get the system a request refers to, an embedded system is always '1'"""
+        if self.embedded is not None:
+            return self.fleet.systems[self.embedded]
+        return self.fleet.by_id.get(sys_id)
+
+    def _missing(self, sys_id):
+        self._send(404, {'errorMessage': 'No such storage-system [{}].'.format(sys_id)})
+
+    def login(self):
+        token = uuid.uuid4().hex
+        with self.fleet.lock:
+            self.mock.tokens.add(token)
+            self.mock.logins += 1
+        self._send(204, body=b'', headers={'Set-Cookie': 'JSESSIONID={}; Path=/'.format(token)})
+
+    def get_systems(self):
+        if self.embedded is not None:
+            return self._send(200, [self.fleet.summary(self._system('1'))])
+        self._send(200, [self.fleet.summary(system) for system in self.fleet.systems])
+
+    def get_system(self, sys_id):
+        system = self._system(sys_id)
+        if system is None:
+            return self._missing(sys_id)
+        self._send(200, self.fleet.summary(system))
+
+    def get_pools(self, sys_id):
+        system = self._system(sys_id)
+        if system is None:
+            return self._missing(sys_id)
+        with self.fleet.lock:
+            self._send(200, system['pools'])
+
+    def get_volumes(self, sys_id):
+        system = self._system(sys_id)
+        if system is None:
+            return self._missing(sys_id)
+        with self.fleet.lock:
+            self._send(200, system['volumes'])
+
+    def post_volume(self, sys_id):
+        system = self._system(sys_id)
+        if system is None:
+            return self._missing(sys_id)
+        data = self._json()
+        with self.fleet.lock:
+            if any(volume['name'] == data['name'] for volume in system['volumes']):
+                return self._send(422, {'errorMessage': 'A volume named [{}] already exists.'.format(data['name'])})
+            pool = next((pool for pool in system['pools'] if pool['id'] == data.get('poolId')), None)
+            if pool is None:
+                return self._send(422, {'errorMessage': 'No such storage-pool.'})
+            volume = self.fleet._add_volume(system, data['name'], pool, int(float(data.get('size', 1)) * GIB))
+        self._send(200, volume)
+
+    def get_drives(self, sys_id):
+        system = self._system(sys_id)
+        if system is None:
+            return self._missing(sys_id)
+        self._send(200, system['drives'])
+
+    def get_compatibilities(self, sys_id):
+        system = self._system(sys_id)
+        if system is None:
+            return self._missing(sys_id)
+        # Every uploaded file is compatible with every drive
+        drives = [{'driveRef': drive['driveRef']} for drive in system['drives']]
+        self._send(200, {'compatibilities': [{'filename': name, 'compatibleDrives': drives}
+                                             for name in sorted(self.fleet.files)]})
+
+    def initiate_drive_upgrade(self, sys_id):
+        system = self._system(sys_id)
+        if system is None:
+            return self._missing(sys_id)
+        data = self._json()
+        with self.fleet.lock:
+            if data.get('filename') not in self.fleet.files:
+                return self._send(422, {'errorMessage': 'No such firmware file.'})
+            download = system['drive_download']
+            if download is not None and time.time() < download['until']:
+                return self._send(422, {'errorMessage': 'A download is already in progress.'})
+            system['drive_download'] = {'until': time.time() + self.mock.drive_download_time,
+                                        'drives': set(data.get('driveRefList') or [])}
+        self._send(200, {'filename': data['filename']})
+
+    def get_drive_state(self, sys_id):
+        system = self._system(sys_id)
+        if system is None:
+            return self._missing(sys_id)
+        with self.fleet.lock:
+            download = system['drive_download']
+            if download is None:
+                return self._send(200, {'overallStatus': 'none', 'driveStatus': []})
+            if time.time() < download['until']:
+                return self._send(200, {'overallStatus': 'downloadInProgress', 'driveStatus': []})
+            for drive in system['drives']:
+                if drive['driveRef'] in download['drives']:
+                    drive['firmwareVersion'] = UPGRADED_DRIVE_FIRMWARE_VERSION
+        self._send(200, {'overallStatus': 'complete', 'driveStatus': []})
+
+    def upload_drive_file(self):
+        match = re.search(br'filename="([^"]+)"', self.body[:4096])
+        if match is None:
+            return self._send(422, {'errorMessage': 'No file was given.'})
+        name = match.group(1).decode('utf-8')
+        with self.fleet.lock:
+            self.fleet.files[name] = {'fileName': name, 'fileSize': len(self.body)}
+        self._send(200, {'fileName': name})
+
+    def get_drive_file(self, name):
+        info = self.fleet.files.get(name)
+        if info is None:
+            return self._send(404, {'errorMessage': 'No such file.'})
+        self._send(200, info)
+
+    def start_health_check(self):
+        ids = [str(sys_id) for sys_id in self._json().get('storageDeviceIds', [])]
+        with self.fleet.lock:
+            self.fleet.health_checks[self.embedded] = {'until': time.time() + self.mock.health_check_time,
+                                                       'ids': ids}
+        self._send(200, {'healthCheckRunning': True})
+
+    def _healthy(self, sys_id):
+        """Spread the unhealthy systems evenly over the fleet"""
+        system = self._system(sys_id)
+        if system is None:
+            return False
+        rate = self.mock.unhealthy_rate
+        return int((system['index'] + 1) * rate) == int(system['index'] * rate)
+
+    def get_health_check(self):
+        check = self.fleet.health_checks.get(self.embedded)
+        if check is None:
+            return self._send(200, {'healthCheckRunning': False, 'results': []})
+        if time.time() < check['until']:
+            return self._send(200, {'healthCheckRunning': True, 'results': []})
+        self._send(200, {'healthCheckRunning': False,
+                         'results': [{'storageDeviceId': sys_id, 'successful': self._healthy(sys_id)}
+                                     for sys_id in check['ids']]})
+
+    def upload_controller_firmware(self):
+        if self.embedded is None:
+            return self._send(404, {'errorMessage': 'Controller firmware is upgraded through the embedded API.'})
+        system = self._system('1')
+        with self.fleet.lock:
+            system['staged'] = UPGRADED_FIRMWARE_VERSION
+        if self.query.get('staged') == ['true']:
+            return self._send(200, {'staged': True})
+        self._reboot(system)
+        self._send(200, {'staged': False})
+
+    def activate_firmware(self):
+        if self.embedded is None:
+            return self._send(404, {'errorMessage': 'Controller firmware is upgraded through the embedded API.'})
+        system = self._system('1')
+        if system['staged'] is None:
+            return self._send(422, {'errorMessage': 'No firmware is staged.'})
+        self._reboot(system)
+        self._send(200, {})
+
+    def _reboot(self, system):
+        """Go offline for the reboot time, and come back with the staged firmware"""
+        with self.fleet.lock:
+            system['reboot_until'] = time.time() + self.mock.reboot_time
+            system['fwVersion'] = system['staged']
+            system['staged'] = None
+
+    def trigger_asup(self):
+        job_id = uuid.uuid4().hex
+        with self.fleet.lock:
+            self.fleet.asup_jobs[job_id] = {'jobId': job_id, 'until': time.time() + self.mock.asup_job_time,
+                                            'fileName': 'asup-{}.7z'.format(job_id)}
+        self._send(200, {'jobId': job_id})
+
+    def get_asup_job(self, job_id):
+        job = self.fleet.asup_jobs.get(job_id)
+        if job is None:
+            return self._send(404, {'errorMessage': 'No such job.'})
+        status = 'inProgress' if time.time() < job['until'] else 'complete'
+        self._send(200, {'jobId': job_id, 'status': status, 'fileName': job['fileName']})
+
+    def get_asup_file(self, job_id):
+        job = self.fleet.asup_jobs.get(job_id)
+        if job is None or time.time() < job['until']:
+            return self._send(404, {'errorMessage': 'No such bundle.'})
+        self._send(200, body=self.mock.bundle, headers={'Content-Type': 'application/octet-stream'})
+
+    def get_asup_configuration(self):
+        with self.fleet.lock:
+            configuration = self.fleet.asup_configurations.setdefault(self.embedded, dict(self.mock.asup_defaults))
+            self._send(200, configuration)
+
+    def post_asup_configuration(self):
+        data = self._json()
+        with self.fleet.lock:
+            configuration = self.fleet.asup_configurations.setdefault(self.embedded, dict(self.mock.asup_defaults))
+            configuration.update(data)
+            self._send(200, configuration)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class MockServer(object):
+    """Serves a MockFleet over HTTP from a background thread"""
+
+    def __init__(self, systems=1, drives=24, latency=0.0, failure_rate=0.0, reboot_time=1.0, drive_download_time=1.0,
+                 health_check_time=0.5, asup_job_time=1.0, asup_size=1024 * 1024, unhealthy_rate=0.0, seed=1,
+                 host='127.0.0.1', port=0):
+        """
+        :param systems: the number of storage-systems in the fleet
+        :param drives: the number of drives of each storage-system
+        :param latency: the mean number of seconds taken to serve a request
+        :param failure_rate: the fraction of requests failed with a 500, logins excepted
+        :param reboot_time: the number of seconds a system is offline after its controller firmware is activated
+        :param drive_download_time: the number of seconds a drive firmware download takes
+        :param health_check_time: the number of seconds a health check runs for
+        :param asup_job_time: the number of seconds an AutoSupport job takes to collect its bundle
+        :param asup_size: the size of an AutoSupport bundle in bytes
+        :param unhealthy_rate: the fraction of storage-systems that fail their health check
+        :param seed: the seed of the generated inventory and of the injected latency and failures
+        """
+        self.fleet = MockFleet(systems=systems, drives=drives, seed=seed)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.reboot_time = reboot_time
+        self.drive_download_time = drive_download_time
+        self.health_check_time = health_check_time
+        self.asup_job_time = asup_job_time
+        self.unhealthy_rate = unhealthy_rate
+        self.asup_defaults = {'autoSupportEnabled': False, 'onDemandEnabled': False, 'remoteDiagsEnabled': False,
+                              'schedule': {'dailyMinTime': 0, 'dailyMaxTime': 1439}}
+        self.bundle = (b'ASUP' * (asup_size // 4 + 1))[:asup_size]
+        self.random = random.Random(seed)
+        self.tokens = set()
+        self.logins = 0
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._server = _Server((host, port), MockHandler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def address(self):
+        """The host:port of the mock"""
+        return '{}:{}'.format(*self._server.server_address[:2])
+
+    @property
+    def url(self):
+        return 'http://' + self.address
+
+    def controllers(self, index):
+        """The addresses of the controllers of an embedded storage-system"""
+        return ['{}/embedded/{}/a'.format(self.url, index), '{}/embedded/{}/b'.format(self.url, index)]
+
+    def embedded_server(self, index):
+        """The 'server' (host:port) of the Embedded Web Services of a storage-system"""
+        return '{}/embedded/{}/a'.format(self.address, index)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='MockServer')
+        self._thread.daemon = True
+        self._thread.start()
+        LOG.debug("Serving a fleet of %s systems on %s.", len(self.fleet.systems), self.url)
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def record(self, route, elapsed):
+        with self._lock:
+            self._timings.setdefault(route, []).append(elapsed)
+
+    def reset_stats(self):
+        with self._lock:
+            self._timings = {}
+
+    def stats(self):
+        """Describe the requests served so far: their number and latency, in total and for each route"""
+        with self._lock:
+            timings = dict((route, sorted(values)) for route, values in self._timings.items())
+        every = sorted(value for values in timings.values() for value in values)
+
+        def describe(values):
+            return {'requests': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+                    'p99': percentile(values, 0.99)}
+
+        stats = describe(every)
+        stats['routes'] = dict((route, describe(values)) for route, values in timings.items())
+        return stats
@@ -0,0 +1,398 @@
+"""
+Polling for the completion of long-running operations.
+
+Many API operations (drive firmware downloads, health checks, controller reboots, AutoSupport jobs) are started with
+one request and then have to be polled until they reach a terminal state. Rather than each sample sleeping for a
+fixed interval, they describe the operation with a probe (a callable that fetches the current state) and a predicate
+that recognizes a terminal state:
+
+    state = poll(lambda: session.get(state_url).json(),
+                 lambda state: state['overallStatus'] != 'downloadInProgress',
+                 backoff=Backoff(initial=2), deadline=3600)
+
+The interval between probes grows exponentially with jitter, so slow operations generate few requests and many
+operations started at the same moment don't poll in lockstep. A PollScheduler multiplexes any number of operations,
+across any number of systems, on a single scheduling thread with a bounded pool of probe workers.
+
+Every probe and every completion is recorded in a PollStats object: the number of requests made and the
+time-to-detect, the interval between the last probe that saw the operation running and the probe that saw it finish.
+The state changed at some point in that interval, so it bounds how late the change was noticed. Each probe is also
+counted as a poll iteration of the tracing phase the operation was started in (see tracing.py).
+"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from tracing import get_tracer
+
+LOG = logging.getLogger(__name__)
+
+# Guards the completion callbacks of every Operation
+_CALLBACK_LOCK = threading.Lock()
+
+
+class PollTimeout(Exception):
+    """The operation did not reach a terminal state before its deadline"""
+
+    def __init__(self, name, last_value=None):
+        super(PollTimeout, self).__init__("Operation [{}] did not finish before its deadline.".format(name))
+        self.last_value = last_value
+
+
+class SchedulerShutdown(RuntimeError):
+    """The PollScheduler was shut down, before the operation finished or before it could be scheduled"""
+
+    def __init__(self, name=None):
+        if name is None:
+            message = "The scheduler has been shut down."
+        else:
+            message = "Operation [{}] was abandoned, the scheduler has been shut down.".format(name)
+        super(SchedulerShutdown, self).__init__(message)
+
+
+class Backoff(object):
+    """Exponentially increasing delays with proportional jitter"""
+
+    def __init__(self, initial=1.0, factor=2.0, maximum=30.0, jitter=0.1):
+        """
+        :param initial: the delay before the second probe, in seconds
+        :param factor: the multiplier applied to the delay after every probe
+        :param maximum: the largest delay between two probes, in seconds
+        :param jitter: the fraction by which each delay is randomly lengthened or shortened
+        """
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """Get the delay to wait after the given (zero based) attempt"""
+        delay = min(self.maximum, self.initial * (self.factor ** attempt))
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return delay
+
+
+class PollStats(object):
+    """Thread-safe counters describing the polling that has been performed"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.operations = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.elapsed = []
+        self.detection = []
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_start(self):
+        with self._lock:
+            self.operations += 1
+
+    def record_finish(self, operation):
+        with self._lock:
+            if isinstance(operation.error, PollTimeout):
+                self.timed_out += 1
+            elif operation.error is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+                if operation.time_to_detect is not None:
+                    self.detection.append(operation.time_to_detect)
+            self.elapsed.append(operation.elapsed)
+
+    def summary(self):
+        """Describe the polling performed so far"""
+        with self._lock:
+            summary = {'operations': self.operations, 'requests': self.requests, 'completed': self.completed,
+                       'failed': self.failed, 'timed_out': self.timed_out,
+                       'requests_per_operation': float(self.requests) / self.operations if self.operations else 0.0}
+            for key, values in (('elapsed', self.elapsed), ('time_to_detect', self.detection)):
+                summary[key + '_mean'] = sum(values) / len(values) if values else 0.0
+                summary[key + '_max'] = max(values) if values else 0.0
+        return summary
+
+
+class Operation(object):
+    """A single long-running operation that is being polled"""
+
+    def __init__(self, name, probe, is_done, backoff=None, deadline=None, retry_on=(), stats=None):
+        """
+        :param name: a description of the operation, used for logging
+        :param probe: a callable returning the current state of the operation
+        :param is_done: a callable that is given the state and returns True once it is terminal
+        :param backoff: the Backoff used between probes
+        :param deadline: the number of seconds after which we give up, or None to wait indefinitely
+        :param retry_on: exception types raised by the probe that mean 'not finished yet' rather than a failure
+        :param stats: an optional PollStats to record the polling in
+        """
+        self.name = name
+        self.probe = probe
+        self.is_done = is_done
+        self.backoff = backoff or Backoff()
+        self.retry_on = tuple(retry_on)
+        self.stats = stats
+
+        self.started = time.time()
+        self.deadline = self.started + deadline if deadline is not None else None
+        self.finished = None
+        self.attempts = 0
+        self.value = None
+        self.error = None
+        self.last_poll = None
+        self.time_to_detect = None
+        self._done = threading.Event()
+        self._callbacks = []
+        # The probes are made on behalf of the phase that started the operation, whichever thread makes them
+        self.span = get_tracer().current()
+        if stats is not None:
+            stats.record_start()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the operation to finish, returning True if it has"""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """Call callback(operation) once the operation has finished"""
+        call_now = False
+        with _CALLBACK_LOCK:
+            if self._done.is_set():
+                call_now = True
+            else:
+                self._callbacks.append(callback)
+        if call_now:
+            callback(self)
+
+    def poll_once(self):
+        """Probe the operation once
+        :return: True if the operation has finished
+        """
+        now = time.time()
+        self.attempts += 1
+        if self.stats is not None:
+            self.stats.record_request()
+        tracer = get_tracer()
+        tracer.record_poll(self.span)
+
+        try:
+            with tracer.attach(self.span):
+                value = self.probe()
+        except self.retry_on as e:
+            LOG.debug("Operation [%s] is not available yet: %s", self.name, e)
+        except Exception as e:
+            self._finish(error=e)
+            return True
+        else:
+            self.value = value
+            if self.is_done(value):
+                if self.last_poll is not None:
+                    self.time_to_detect = now - self.last_poll
+                self._finish()
+                return True
+
+        self.last_poll = now
+        if self.deadline is not None and time.time() >= self.deadline:
+            self._finish(error=PollTimeout(self.name, self.value))
+            return True
+        return False
+
+    def next_delay(self):
+        """Get how long to wait before the next probe"""
+        delay = self.backoff.delay(self.attempts - 1)
+        if self.deadline is not None:
+            delay = max(0.0, min(delay, self.deadline - time.time()))
+        return delay
+
+    def _finish(self, error=None):
+        self.error = error
+        self.finished = time.time()
+        if self.stats is not None:
+            self.stats.record_finish(self)
+        if error is None:
+            LOG.debug("Operation [%s] finished after %s probes in %.1fs.", self.name, self.attempts, self.elapsed)
+        else:
+            LOG.debug("Operation [%s] failed after %s probes: %s", self.name, self.attempts, error)
+
+        with _CALLBACK_LOCK:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                LOG.exception("A completion callback for [%s] failed.", self.name)
+
+    def result(self, timeout=None):
+        """Wait for the operation to finish
+        :param timeout: the number of seconds to wait, or None to wait indefinitely
+        :return: the terminal state of the operation
+        :raise the error that ended the operation, or PollTimeout if it didn't finish in time
+        """
+        if not self._done.wait(timeout):
+            raise PollTimeout(self.name, self.value)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def poll(probe, is_done, backoff=None, deadline=None, retry_on=(), stats=None, initial_delay=0, name='operation'):
+    """Poll an operation from the calling thread until it reaches a terminal state
+    :param probe: a callable returning the current state of the operation
+    :param is_done: a callable that is given the state and returns True once it is terminal
+    :param backoff: the Backoff used between probes
+    :param deadline: the number of seconds after which we give up, or None to wait indefinitely
+    :param retry_on: exception types raised by the probe that mean 'not finished yet'
+    :param stats: an optional PollStats to record the polling in
+    :param initial_delay: the number of seconds to wait before the first probe
+    :param name: a description of the operation, used for logging
+    :return: the terminal state
+    :raise PollTimeout if the deadline passed, or the exception raised by the probe
+    """
+    operation = Operation(name, probe, is_done, backoff=backoff, deadline=deadline, retry_on=retry_on, stats=stats)
+    if initial_delay:
+        time.sleep(initial_delay)
+    while not operation.poll_once():
+        time.sleep(operation.next_delay())
+    return operation.result()
+
+
+class PollScheduler(object):
+    """Polls many operations from a single scheduling thread.
+
+    The scheduler keeps the operations in a heap ordered by when they are next due and hands due probes to a bounded
+    pool of worker threads, so a slow probe doesn't delay the others.
+    """
+
+    def __init__(self, workers=8, stats=None):
+        """
+        :param workers: the maximum number of probes in flight at once
+        :param stats: the PollStats shared by every submitted operation, one is created if not given
+        """
+        self.stats = stats or PollStats()
+        self.workers = workers
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._pool = None
+
+    def _start(self):
+        if self._thread is None:
+            self._pool = ThreadPool(self.workers)
+            self._thread = threading.Thread(target=self._run, name='PollScheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, name, probe, is_done, backoff=None, deadline=None, retry_on=(), initial_delay=0):
+        """Start polling an operation
+        :param name: a description of the operation, used for logging
+        :param probe: a callable returning the current state of the operation
+        :param is_done: a callable that is given the state and returns True once it is terminal
+        :param backoff: the Backoff used between probes
+        :param deadline: the number of seconds after which we give up, or None to wait indefinitely
+        :param retry_on: exception types raised by the probe that mean 'not finished yet'
+        :param initial_delay: the number of seconds to wait before the first probe
+        :return: the Operation, use its result() to wait for it
+        """
+        operation = Operation(name, probe, is_done, backoff=backoff, deadline=deadline, retry_on=retry_on,
+                              stats=self.stats)
+        self._schedule(operation, initial_delay)
+        return operation
+
+    def call_later(self, delay, callback, on_shutdown=None):
+        """Run callback() on a worker thread after delay seconds
+        :param on_shutdown: an optional callable, given the SchedulerShutdown error instead if the scheduler is shut
+         down before the callback is due
+        """
+        self._schedule((callback, on_shutdown), delay)
+
+    def _schedule(self, item, delay):
+        with self._condition:
+            if self._stopped:
+                raise SchedulerShutdown(item.name if isinstance(item, Operation) else None)
+            self._start()
+            heapq.heappush(self._heap, (time.time() + delay, next(self._sequence), item))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.time()):
+                    self._condition.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if self._stopped:
+                    return
+                _, _, item = heapq.heappop(self._heap)
+                # Still holding the lock, so that shutdown() can't close the pool before the item reaches it
+                self._pool.apply_async(self._dispatch, (item,))
+
+    def _dispatch(self, item):
+        if not isinstance(item, Operation):
+            callback, _ = item
+            try:
+                callback()
+            except Exception:
+                LOG.exception("A scheduled callback failed.")
+            return
+        if not item.poll_once():
+            try:
+                self._schedule(item, item.next_delay())
+            except SchedulerShutdown as e:
+                # The scheduler was shut down while the probe was in flight
+                self._abandon(item, e)
+
+    @staticmethod
+    def _abandon(item, error):
+        """Fail an operation, or cancel a callback, that will never run"""
+        if isinstance(item, Operation):
+            item._finish(error=error)
+            return
+        _, on_shutdown = item
+        if on_shutdown is not None:
+            try:
+                on_shutdown(error)
+            except Exception:
+                LOG.exception("A scheduled callback failed to cancel.")
+
+    def wait_all(self, operations, timeout=None):
+        """Wait for every operation to finish
+        :param operations: the operations to wait for
+        :param timeout: the total number of seconds to wait, or None to wait indefinitely
+        :return: the operations that are still running
+        """
+        end = time.time() + timeout if timeout is not None else None
+        for operation in operations:
+            operation.wait(None if end is None else max(0.0, end - time.time()))
+        return [operation for operation in operations if not operation.done()]
+
+    def shutdown(self):
+        """Stop polling. The pending operations fail with SchedulerShutdown, so that whoever waits on them raises it
+        rather than waiting forever
+        """
+        with self._condition:
+            self._stopped = True
+            pending, self._heap = [item for _, _, item in sorted(self._heap)], []
+            self._condition.notify()
+        if pending:
+            LOG.warning("The scheduler was shut down with %s operations pending.", len(pending))
+        for item in pending:
+            self._abandon(item, SchedulerShutdown(item.name if isinstance(item, Operation) else None))
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
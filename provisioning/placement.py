@@ -0,0 +1,230 @@
+"""
+Pool Placement.
+
+Usage:
+  placement simulate [--pools=<n>] [--volumes=<n>] [--seed=<n>] [--strategy=<s>...]
+  placement -h | --help
+Options:
+  -h --help       Show this screen.
+  --pools=<n>     The number of pools in the synthetic inventory [default: 12]
+  --volumes=<n>   The number of volumes to place [default: 200]
+  --seed=<n>      The seed of the synthetic inventory [default: 1]
+  --strategy=<s>  A strategy to compare, all of them by default
+
+Description:
+  Chooses the storage-pool a new volume is defined on, rather than always using the first pool. Pools are scored by
+  their free capacity, RAID level and current number of volumes. The inventory is fetched once and updated as volumes
+  are placed, so a run of placements doesn't re-read the pools for every volume.
+
+  The strategies are:
+    most-free    The pool with the best score, which spreads volumes evenly by fill
+    round-robin  Each pool in turn
+    bin-packing  The fullest pool that still fits the volume, which keeps whole pools free for large volumes
+    first        The first pool that fits (the behaviour before placement was introduced)
+
+  The simulator places random volumes on a synthetic inventory with every strategy and compares the resulting fill.
+"""
+import copy
+import logging
+import math
+import random
+import threading
+from pprint import pprint
+
+import docopt
+
+LOG = logging.getLogger(__name__)
+
+GIB = 1024 ** 3
+
+# The relative preference for each RAID level, the protected levels are favoured
+RAID_WEIGHTS = {'raidDiskPool': 1.0,
+                'raid6': 1.0,
+                'raid1': 0.95,
+                'raid5': 0.9,
+                'raid0': 0.5}
+DEFAULT_RAID_WEIGHT = 0.8
+
+# How much each volume already defined on a pool lowers its score
+VOLUME_PENALTY = 0.02
+
+
+class PoolState(object):
+    """The capacity and usage of a storage-pool, as far as placement is concerned"""
+
+    def __init__(self, pool, volumes=0):
+        """
+        :param pool: the storage-pool, as returned by the storage-pools endpoint
+        :param volumes: the number of volumes defined on it
+        """
+        self.pool = pool
+        self.id = pool['id']
+        self.name = pool['name']
+        self.raid_level = pool.get('raidLevel')
+        self.free = float(pool.get('freeSpace', 0))
+        self.capacity = float(pool.get('totalRaidedSpace', 0)) or self.free
+        self.volumes = volumes
+
+    @property
+    def fill(self):
+        """The fraction of the pool in use"""
+        return 1 - self.free / self.capacity if self.capacity else 1.0
+
+    def fits(self, size):
+        return self.free >= size
+
+    def score(self, size):
+        """Score the pool for a new volume, higher is better"""
+        if not self.capacity:
+            return 0.0
+        free = (self.free - size) / self.capacity
+        return RAID_WEIGHTS.get(self.raid_level, DEFAULT_RAID_WEIGHT) * free / (1 + VOLUME_PENALTY * self.volumes)
+
+    def place(self, size):
+        self.free -= size
+        self.volumes += 1
+
+
+class MostFree(object):
+    """Choose the pool with the best score"""
+
+    def choose(self, pools, size):
+        candidates = [pool for pool in pools if pool.fits(size)]
+        return max(candidates, key=lambda pool: pool.score(size)) if candidates else None
+
+
+class RoundRobin(object):
+    """Choose each pool in turn, skipping pools that are too full"""
+
+    def __init__(self):
+        self._next = 0
+
+    def choose(self, pools, size):
+        for offset in range(len(pools)):
+            index = (self._next + offset) % len(pools)
+            if pools[index].fits(size):
+                self._next = index + 1
+                return pools[index]
+        return None
+
+
+class BinPacking(object):
+    """Choose the fullest pool that still fits the volume (best-fit), breaking ties by score"""
+
+    def choose(self, pools, size):
+        candidates = [pool for pool in pools if pool.fits(size)]
+        return min(candidates, key=lambda pool: (pool.free - size, -pool.score(size))) if candidates else None
+
+
+class FirstPool(object):
+    """Choose the first pool that fits the volume"""
+
+    def choose(self, pools, size):
+        return next((pool for pool in pools if pool.fits(size)), None)
+
+
+STRATEGIES = {'most-free': MostFree,
+              'round-robin': RoundRobin,
+              'bin-packing': BinPacking,
+              'first': FirstPool}
+
+
+class Placement(object):
+    """Places volumes on the storage-pools of a single storage-system"""
+
+    def __init__(self, pools, volumes=(), strategy='most-free'):
+        """
+        :param pools: the storage-pools, as returned by the storage-pools endpoint
+        :param volumes: the volumes already defined, used to count the volumes of each pool
+        :param strategy: the name of the strategy, see STRATEGIES
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown placement strategy [{}], expected one of {}.'.format(
+                strategy, ', '.join(sorted(STRATEGIES))))
+        counts = {}
+        for volume in volumes:
+            counts[volume.get('volumeGroupRef')] = counts.get(volume.get('volumeGroupRef'), 0) + 1
+        self.pools = [PoolState(pool, counts.get(pool['id'], 0)) for pool in pools]
+        self.strategy = STRATEGIES[strategy]()
+        self._lock = threading.Lock()
+
+    def choose(self, size=GIB):
+        """Choose a pool for a new volume, and account for the volume being defined on it
+        :param size: the size of the volume in bytes
+        :return: the storage-pool, or None if no pool has room for the volume
+        """
+        with self._lock:
+            state = self.strategy.choose(self.pools, size)
+            if state is None:
+                return None
+            state.place(size)
+        LOG.debug("Placed a volume of %s bytes on pool [%s], %.0f%% full.", size, state.name, 100 * state.fill)
+        return state.pool
+
+    def release(self, pool, size=GIB):
+        """Return the capacity of a volume that was placed, but could not be defined"""
+        with self._lock:
+            for state in self.pools:
+                if state.id == pool['id']:
+                    state.free += size
+                    state.volumes -= 1
+
+    def distribution(self):
+        """Describe how evenly the pools are filled"""
+        fills = [state.fill for state in self.pools]
+        if not fills:
+            return {}
+        mean = sum(fills) / len(fills)
+        return {'fill_min': min(fills),
+                'fill_max': max(fills),
+                'fill_mean': mean,
+                'fill_stddev': math.sqrt(sum((fill - mean) ** 2 for fill in fills) / len(fills)),
+                'volumes_max': max(state.volumes for state in self.pools)}
+
+
+def synthetic_inventory(pool_count, rng):
+    """Generate storage-pools and volumes of random capacity, fill and RAID level"""
+    pools, volumes = [], []
+    for index in range(pool_count):
+        capacity = rng.choice([4, 8, 16, 32, 64]) * 1024 * GIB
+        used = capacity * rng.uniform(0, 0.6)
+        pool_id = '04000000600A098000{:06d}'.format(index)
+        pools.append({'id': pool_id,
+                      'name': 'pool{}'.format(index),
+                      'raidLevel': rng.choice(sorted(RAID_WEIGHTS)),
+                      'totalRaidedSpace': str(int(capacity)),
+                      'freeSpace': str(int(capacity - used))})
+        volumes.extend({'volumeGroupRef': pool_id} for _ in range(rng.randint(0, 40)))
+    return pools, volumes
+
+
+def simulate(pool_count=12, volume_count=200, seed=1, strategies=None):
+    """Place the same random volumes on the same synthetic inventory with each strategy
+    :return: the resulting fill distribution, and the number of volumes that could not be placed, per strategy
+    """
+    rng = random.Random(seed)
+    pools, volumes = synthetic_inventory(pool_count, rng)
+    sizes = [rng.choice([10, 50, 100, 250, 500, 1024]) * GIB for _ in range(volume_count)]
+
+    results = {}
+    for strategy in strategies or sorted(STRATEGIES):
+        placement = Placement(copy.deepcopy(pools), volumes, strategy=strategy)
+        before = placement.distribution()
+        rejected = sum(1 for size in sizes if placement.choose(size) is None)
+        result = placement.distribution()
+        result['rejected'] = rejected
+        result['fill_mean_before'] = before['fill_mean']
+        results[strategy] = result
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(relativeCreated)dms %(levelname)s %(module)s.%(funcName)s:%(lineno)d\n %(message)s')
+    args = docopt.docopt(__doc__)
+    results = simulate(int(args.get('--pools')), int(args.get('--volumes')), int(args.get('--seed')),
+                       args.get('--strategy') or None)
+    for strategy, result in sorted(results.items()):
+        LOG.info("%s: fill %.0f%%-%.0f%% (stddev %.3f), %s volumes rejected.", strategy, 100 * result['fill_min'],
+                 100 * result['fill_max'], result['fill_stddev'], result['rejected'])
+    pprint(results)
@@ -2,64 +2,128 @@
 Volume Creator.
 
 Usage:
-  volume create [<id>] <name> [<pool>]
+  volume create [<id>] <name> [<pool>] [--strategy=<s>]
+  volume bulk-create <manifest> [--workers=<n>] [--strategy=<s>]
   volume -h | --help
   volume --version
   volume delete
 Arguments:
-  id     The unique identifier of the storage-system. Default: '1'
-  name   The unique name of the volume to be defined
-  pool   The name of the storage-pool to define the volume on. Default: Pick a random pool
+  id        The unique identifier of the storage-system. Default: '1'
+  name      The unique name of the volume to be defined
+  pool      The name of the storage-pool to define the volume on. Default: Choose one, see --strategy
+  manifest  A CSV or JSON file listing the volumes to define
 Options:
-  -h --help     Show this screen.
-  --version     Show version.
+  -h --help       Show this screen.
+  --version       Show version.
+  --workers=<n>   The maximum number of volumes being defined at once [default: 8]
+  --strategy=<s>  How to choose a pool when none is given: most-free, round-robin, bin-packing or first
+                  (see provisioning.placement) [default: most-free]
+
+Bulk creation:
+  The manifest lists one volume per row (CSV, with a header) or per object (JSON list), with the keys:
+    system  The unique identifier of the storage-system. Default: '1'
+    name    The unique name of the volume to be defined
+    pool    The name or id of the storage-pool. Default: Choose one, see --strategy
+    size    The size of the volume in GiB. Default: '1'
+  The storage-pools of each system are only fetched once, and the volumes are defined concurrently.
 """
+import csv
 import requests
 import docopt
 import json
+import sys
+import time
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from pprint import pprint, pformat
 import logging
 from requests import HTTPError
 
 from base import Properties, get_session
+from json_stream import iter_json
+from provisioning.placement import GIB, Placement
 
 props = Properties()
 
 LOG = logging.getLogger(__name__)
 
 
+class PoolIndex(object):
+    """The storage-pools of a storage-system, indexed by name and by id"""
+
+    def __init__(self, pools):
+        self.pools = pools
+        self.by_name = dict((pool['name'], pool) for pool in pools)
+        self.by_id = dict((pool['id'], pool) for pool in pools)
+
+    @classmethod
+    def fetch(cls, con, sys_id, server=None):
+        result = con.get('http://{server}/devmgr/v2/storage-systems/{id}/storage-pools'.format(
+            server=server or props.server, id=sys_id))
+        result.raise_for_status()
+        return cls(result.json())
+
+    def get(self, name=None):
+        """Get a pool by its name (or id), or the first pool if no name is given"""
+        if name is None:
+            return self.pools[0] if self.pools else None
+        return self.by_name.get(name) or self.by_id.get(name)
+
+
 def get_pool_by_name(con, sys_id, name):
+    """Get a pool by its name (or id), or the first pool if no name is given
+
+    The storage-pools are parsed as they arrive, and the rest of the response is not read once the pool is found.
+    """
     result = con.get('http://{server}/devmgr/v2/storage-systems/{id}/storage-pools'.format(server=props.server,
-                                                                                           id=sys_id))
+                                                                                           id=sys_id), stream=True)
     result.raise_for_status()
-    pools = result.json()
-    if name is None:
-        return pools[0] if pools else None
-    else:
-        pool = [pool for pool in pools if pool['name'] == name]
-        return pool[0] if pool else None
+    with closing(iter_json(result)) as pools:
+        for pool in pools:
+            if name is None or name in (pool['name'], pool['id']):
+                return pool
+    return None
 
 
-def create_volume(sys_id, vol_name, pool_name=None):
-    """Issue a request to define a new volume
+def get_volumes(con, sys_id, server=None):
+    result = con.get('http://{server}/devmgr/v2/storage-systems/{id}/volumes'.format(server=server or props.server,
+                                                                                     id=sys_id))
+    result.raise_for_status()
+    return result.json()
+
+
+def get_placement(con, sys_id, strategy='most-free', pools=None, server=None):
+    """Fetch the inventory needed to choose pools for new volumes
+    :param con: the session to use
     :param sys_id: the unique identifier of the system
-    :param vol_name: the name of the new volume
-    :param pool_name: an optional pool name
+    :param strategy: the placement strategy, see provisioning.placement
+    :param pools: the storage-pools of the system, if they have already been fetched
+    :param server: the address of the Web Services instance, the configured server by default
+    :return: the Placement
     """
-    con = get_session()
-    pool = get_pool_by_name(con, sys_id, pool_name)
-    if pool is None:
-        LOG.error('Unable to locate a valid pool to use!')
-        raise NameError('No such pool!')
+    if pools is None:
+        pools = PoolIndex.fetch(con, sys_id, server=server).pools
+    return Placement(pools, get_volumes(con, sys_id, server=server), strategy=strategy)
 
+
+def post_volume(con, sys_id, vol_name, pool, size='1', server=None):
+    """Issue the request to define a new volume on a pool
+    :param con: the session to use
+    :param sys_id: the unique identifier of the system
+    :param vol_name: the name of the new volume
+    :param pool: the pool to define the volume on
+    :param size: the size of the new volume
+    :param server: the address of the Web Services instance, the configured server by default
+    :return: the response
+    """
     LOG.info("Defining a volume on [%s] with name [%s] in pool [%s]." % (sys_id, vol_name, pool['name']))
 
     data = {'name': vol_name,
-            'size': '1',
+            'size': size,
             'poolId': pool['id']}
 
     result = con.post('http://{server}/devmgr/v2/storage-systems/{id}/volumes'.format(
-        server=props.server, id=sys_id), data=json.dumps(data))
+        server=server or props.server, id=sys_id), data=json.dumps(data))
 
     if result.status_code == 422:
         resp = result.json()
@@ -69,15 +133,148 @@ def create_volume(sys_id, vol_name, pool_name=None):
         LOG.debug(pformat(result.json()))
     else:
         LOG.error(result.text)
+    return result
+
 
+def create_volume(sys_id, vol_name, pool_name=None, strategy='most-free'):
+    """Issue a request to define a new volume
+    :param sys_id: the unique identifier of the system
+    :param vol_name: the name of the new volume
+    :param pool_name: an optional pool name
+    :param strategy: how to choose a pool if no name is given, see provisioning.placement
+    """
+    con = get_session()
+    if pool_name is None:
+        pool = get_placement(con, sys_id, strategy=strategy).choose(GIB)
+    else:
+        pool = get_pool_by_name(con, sys_id, pool_name)
+    if pool is None:
+        LOG.error('Unable to locate a valid pool to use!')
+        raise NameError('No such pool!')
+
+    result = post_volume(con, sys_id, vol_name, pool)
     result.raise_for_status()
 
 
+def load_manifest(manifest):
+    """Read the volumes to define from a CSV or JSON manifest
+    :param manifest: path to the manifest
+    :return: a list of volume definitions
+    """
+    if manifest.lower().endswith('.json'):
+        with open(manifest) as fp:
+            volumes = json.load(fp)
+    else:
+        # The csv module wants binary files on Python 2 and text files on Python 3
+        with (open(manifest, 'rb') if sys.version_info[0] < 3 else open(manifest, newline='')) as fp:
+            volumes = [dict((key.strip(), value.strip()) for key, value in row.items() if value)
+                       for row in csv.DictReader(fp)]
+
+    for volume in volumes:
+        volume['system'] = str(volume.get('system') or '1')
+        volume.setdefault('pool', None)
+        volume['size'] = str(volume.get('size') or '1')
+    return volumes
+
+
+def bulk_create_volumes(volumes, workers=8, strategy='most-free', server=None, con=None):
+    """Define many volumes, fetching the pools of each system only once
+    :param volumes: a list of volume definitions, see load_manifest()
+    :param workers: the maximum number of volumes being defined at once
+    :param strategy: how to choose a pool for volumes that don't name one, see provisioning.placement
+    :param server: the address of the Web Services instance, the configured server by default
+    :param con: the session to use, a new session is created by default
+    :return: a report of the volumes that were created, that conflicted with an existing definition, and that failed
+    """
+    con = con or get_session()
+    start = time.time()
+    pool_workers = ThreadPool(workers)
+    try:
+        # A system that can't be reached only fails its own volumes, not the whole run
+        def fetch_pools(sys_id):
+            try:
+                return PoolIndex.fetch(con, sys_id, server=server)
+            except requests.RequestException as e:
+                LOG.error("Unable to fetch the storage-pools of [%s]: %s", sys_id, e)
+                return e
+
+        def fetch_placement(sys_id):
+            try:
+                return get_placement(con, sys_id, strategy=strategy, pools=indexes[sys_id].pools, server=server)
+            except requests.RequestException as e:
+                LOG.error("Unable to fetch the volumes of [%s]: %s", sys_id, e)
+                return e
+
+        systems = sorted(set(volume['system'] for volume in volumes))
+        indexes = dict(zip(systems, pool_workers.map(fetch_pools, systems)))
+        errors = dict((sys_id, str(index)) for sys_id, index in indexes.items() if isinstance(index, Exception))
+        # The volumes are only needed to place volumes that don't name a pool
+        unplaced = sorted(set(volume['system'] for volume in volumes
+                              if volume['pool'] is None and volume['system'] not in errors))
+        placements = dict(zip(unplaced, pool_workers.map(fetch_placement, unplaced)))
+
+        def create(volume):
+            # A malformed definition only fails itself, not the whole run
+            if not volume.get('name'):
+                return volume, 'failed', 'The volume has no name'
+            try:
+                size = float(volume['size']) * GIB
+            except (KeyError, TypeError, ValueError):
+                return volume, 'failed', 'Invalid size: {}'.format(volume.get('size'))
+            if volume['system'] in errors:
+                return volume, 'failed', errors[volume['system']]
+            if volume['pool'] is None and isinstance(placements[volume['system']], Exception):
+                return volume, 'failed', str(placements[volume['system']])
+            if volume['pool'] is None:
+                placement = placements[volume['system']]
+                pool = placement.choose(size)
+            else:
+                placement = None
+                pool = indexes[volume['system']].get(volume['pool'])
+            if pool is None:
+                return volume, 'failed', 'No such pool: {}'.format(volume['pool'] or 'none with enough free space')
+            try:
+                result = post_volume(con, volume['system'], volume['name'], pool, volume['size'], server=server)
+            except requests.RequestException as e:
+                status, message = 'failed', str(e)
+            else:
+                if result.status_code == 200:
+                    return volume, 'created', None
+                elif result.status_code == 422:
+                    status, message = 'conflict', result.json().get('errorMessage')
+                else:
+                    status, message = 'failed', '{}: {}'.format(result.status_code, result.text)
+            # The volume wasn't defined, so its capacity is available to the next placement
+            if placement is not None:
+                placement.release(pool, size)
+            return volume, status, message
+
+        outcomes = pool_workers.map(create, volumes)
+    finally:
+        pool_workers.close()
+        pool_workers.join()
+
+    elapsed = time.time() - start
+    report = {'created': [], 'conflict': [], 'failed': []}
+    for volume, status, message in outcomes:
+        report[status].append({'system': volume['system'], 'name': volume.get('name'), 'message': message})
+    report['elapsed'] = elapsed
+    report['creates_per_second'] = len(report['created']) / elapsed if elapsed else 0.0
+    return report
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG,
                         format='%(relativeCreated)dms %(levelname)s %(module)s.%(funcName)s:%(lineno)d\n %(message)s')
     args = docopt.docopt(__doc__)
-    vol_name = args.get('<name>')
-    sys_id = args.get('<id>', '1')
-    pool_name = args.get('<pool>')
-    create_volume(sys_id, vol_name, pool_name)
+    if args.get('bulk-create'):
+        report = bulk_create_volumes(load_manifest(args.get('<manifest>')), workers=int(args.get('--workers')),
+                                     strategy=args.get('--strategy'))
+        LOG.info("Created %s volumes (%.1f/s), %s conflicts, %s failures.", len(report['created']),
+                 report['creates_per_second'], len(report['conflict']), len(report['failed']))
+        pprint(report)
+    else:
+        vol_name = args.get('<name>')
+        sys_id = args.get('<id>', '1')
+        pool_name = args.get('<pool>')
+        create_volume(sys_id, vol_name, pool_name, strategy=args.get('--strategy'))
@@ -0,0 +1,162 @@
+"""
+A memory-bounded multipart/form-data body for uploading large firmware files.
+
+Passing a file object through requests' files= parameter builds the whole multipart body in memory before anything
+is sent. MultipartFileStream produces the same body lazily: the part headers, the file content read in chunks of at
+most buffer_size bytes (optionally through a read-only memory map), and the closing boundary. It knows its own length,
+so requests sends it with a Content-Length header rather than chunked encoding.
+
+    with MultipartFileStream('file', path, progress=log_progress) as body:
+        session.post(url, data=body, headers={'Content-Type': body.content_type})
+"""
+import binascii
+import logging
+import mmap
+import os
+import time
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+
+def log_progress(sent, total, rate, eta):
+    """A progress callback that logs the state of an upload"""
+    LOG.info("Uploaded %.1f of %.1f MiB (%.0f%%) at %.1f MiB/s, ETA %.0fs", sent / 1048576.0, total / 1048576.0,
+             100.0 * sent / total if total else 100.0, rate / 1048576.0, eta)
+
+
+class MultipartFileStream(object):
+    """A file-like multipart/form-data body holding a single file field"""
+
+    def __init__(self, field, path, buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False, progress=None,
+                 progress_interval=1.0, content_type='application/octet-stream'):
+        """
+        :param field: the name of the form field, ex: 'file'
+        :param path: path to the file to upload
+        :param buffer_size: the largest chunk that is read from the file and handed to the connection at once
+        :param use_mmap: read the file through a read-only memory map instead of buffered reads
+        :param progress: an optional callable(sent, total, bytes_per_second, eta_seconds)
+        :param progress_interval: the minimum number of seconds between progress callbacks
+        :param content_type: the content type of the file part
+        """
+        self.buffer_size = buffer_size
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+
+        self._preamble = ('--{boundary}\r\n'
+                          'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                          'Content-Type: {content_type}\r\n'
+                          '\r\n').format(boundary=self.boundary, field=field, filename=os.path.basename(path),
+                                         content_type=content_type).encode('utf-8')
+        self._epilogue = '\r\n--{}--\r\n'.format(self.boundary).encode('ascii')
+
+        self._fp = open(path, 'rb')
+        self._file_size = os.fstat(self._fp.fileno()).st_size
+        self._map = None
+        if use_mmap and self._file_size:
+            self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self._map, 'madvise'):
+                self._map.madvise(mmap.MADV_SEQUENTIAL)
+
+        self._length = len(self._preamble) + self._file_size + len(self._epilogue)
+        self._position = 0
+        self._started = None
+        self._last_report = 0.0
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._fp.close()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._length
+        self._position = max(0, min(offset, self._length))
+        return self._position
+
+    def _read_chunk(self, size):
+        """Read up to size bytes from the current position, never crossing a section boundary"""
+        position = self._position
+        file_start = len(self._preamble)
+        file_end = file_start + self._file_size
+        if position < file_start:
+            return self._preamble[position:position + size]
+        if position < file_end:
+            offset = position - file_start
+            size = min(size, file_end - position)
+            if self._map is not None:
+                return self._map[offset:offset + size]
+            if self._fp.tell() != offset:
+                self._fp.seek(offset)
+            return self._fp.read(size)
+        return self._epilogue[position - file_end:position - file_end + size]
+
+    def read(self, size=-1):
+        """Read the next chunk of the body. At most buffer_size bytes are returned unless the rest of the body is
+        explicitly requested with a negative size.
+        """
+        if size is None or size < 0:
+            chunks = []
+            chunk = self.read(self.buffer_size)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self.read(self.buffer_size)
+            return b''.join(chunks)
+
+        if self._started is None:
+            self._started = time.time()
+
+        chunk = self._read_chunk(min(size, self.buffer_size))
+        self._position += len(chunk)
+        self._report()
+        return chunk
+
+    def _report(self):
+        if self.progress is None:
+            return
+        now = time.time()
+        finished = self._position >= self._length
+        if not finished and now - self._last_report < self.progress_interval:
+            return
+        self._last_report = now
+        elapsed = now - self._started
+        rate = self._position / elapsed if elapsed > 0 else 0.0
+        eta = (self._length - self._position) / rate if rate else 0.0
+        self.progress(self._position, self._length, rate, eta)
+
+
+def upload_file(session, url, field, path, timeout=None, **kwargs):
+    """POST a file as a streamed multipart/form-data body
+    :param session: the session used to make the request
+    :param url: the url to upload the file to
+    :param field: the name of the form field
+    :param path: path to the file to upload
+    :param timeout: the timeout of the request, the session's default timeout is used if not given
+    :param kwargs: passed on to MultipartFileStream
+    :return: the response
+    """
+    with MultipartFileStream(field, path, **kwargs) as body:
+        if timeout is None:
+            return session.post(url, data=body, headers={'Content-Type': body.content_type})
+        return session.post(url, data=body, headers={'Content-Type': body.content_type}, timeout=timeout)
@@ -0,0 +1,77 @@
+import unittest
+
+from drive_firmware_upgrade.batch_planner import group_drives, plan_batches
+
+
+def drive(ref, tray=None, volume_group=None):
+    return {'driveRef': ref, 'physicalLocation': {'trayRef': tray} if tray else {},
+            'currentVolumeGroupRef': volume_group}
+
+
+def fleet_of(groups, drives_per_group):
+    """Drives of the volume groups 'vg0', 'vg1'... in trays 't0', 't1'..., in group order"""
+    return [drive('{}-{}'.format(group, index), tray='t{}'.format(index), volume_group='vg{}'.format(group))
+            for group in range(groups) for index in range(drives_per_group)]
+
+
+class GroupDrivesTest(unittest.TestCase):
+    def test_by_tray(self):
+        drives = [drive('a', tray='t1'), drive('b', tray='t2'), drive('c', tray='t1')]
+        groups = group_drives(drives, ['a', 'b', 'c'], by='tray')
+        self.assertEqual(list(groups.items()), [('t1', ['a', 'c']), ('t2', ['b'])])
+
+    def test_by_volume_group(self):
+        drives = [drive('a', volume_group='vg1'), drive('b'), drive('c', volume_group='vg1')]
+        groups = group_drives(drives, ['a', 'b', 'c'], by='volume-group')
+        self.assertEqual(list(groups.items()), [('vg1', ['a', 'c']), ('unassigned', ['b'])])
+
+    def test_only_the_drives_to_upgrade(self):
+        drives = [drive('a', tray='t1'), drive('b', tray='t2')]
+        self.assertEqual(list(group_drives(drives, ['b']).items()), [('t2', ['b'])])
+
+    def test_undescribed_drives_come_last(self):
+        drives = [drive('a', tray='t1')]
+        groups = group_drives(drives, ['x', 'a', 'y'])
+        self.assertEqual(list(groups.items()), [('t1', ['a']), ('unknown', ['x', 'y'])])
+
+    def test_unknown_grouping(self):
+        self.assertRaises(ValueError, group_drives, [], [], by='controller')
+
+
+class PlanBatchesTest(unittest.TestCase):
+    def test_a_group_per_batch(self):
+        drives = fleet_of(2, 3)
+        batches = plan_batches(drives, [d['driveRef'] for d in drives], by='volume-group', batch_size=2)
+        self.assertEqual([batch['drives'] for batch in batches],
+                         [['0-0', '0-1'], ['0-2'], ['1-0', '1-1'], ['1-2']])
+        self.assertEqual([batch['groups'] for batch in batches], [['vg0'], ['vg0'], ['vg1'], ['vg1']])
+        self.assertEqual([batch['batch'] for batch in batches], [1, 2, 3, 4])
+
+    def test_per_group_rotates_through_the_groups(self):
+        drives = fleet_of(3, 3)
+        batches = plan_batches(drives, [d['driveRef'] for d in drives], by='volume-group', batch_size=2,
+                               per_group=1)
+        self.assertEqual([batch['groups'] for batch in batches],
+                         [['vg0', 'vg1'], ['vg2', 'vg0'], ['vg1', 'vg2'], ['vg0', 'vg1'], ['vg2']])
+
+    def test_per_group_limit(self):
+        drives = fleet_of(3, 4)
+        refs = [d['driveRef'] for d in drives]
+        batches = plan_batches(drives, refs, by='volume-group', batch_size=5, per_group=2)
+        for batch in batches:
+            self.assertTrue(len(batch['drives']) <= 5)
+            for group in batch['groups']:
+                self.assertTrue(sum(1 for ref in batch['drives'] if 'vg' + ref.split('-')[0] == group) <= 2)
+        self.assertEqual(sorted(ref for batch in batches for ref in batch['drives']), sorted(refs))
+        self.assertEqual(len(batches), 3)
+
+    def test_no_drives(self):
+        self.assertEqual(plan_batches(fleet_of(2, 2), []), [])
+
+    def test_invalid_sizes(self):
+        self.assertRaises(ValueError, plan_batches, [], [], batch_size=0)
+        self.assertRaises(ValueError, plan_batches, [], [], per_group=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import threading
+import time
+import unittest
+
+from poller import Backoff, PollScheduler, SchedulerShutdown
+
+
+class PollSchedulerShutdownTest(unittest.TestCase):
+    def test_pending_operations_fail(self):
+        scheduler = PollScheduler(workers=2)
+        operations = [scheduler.submit('op{}'.format(index), lambda: 'running', lambda state: False,
+                                       backoff=Backoff(initial=60, jitter=0)) for index in range(3)]
+        scheduler.wait_all(operations, timeout=0.2)
+        scheduler.shutdown()
+        for operation in operations:
+            self.assertRaises(SchedulerShutdown, operation.result, 1)
+        self.assertEqual(scheduler.stats.summary()['failed'], 3)
+
+    def test_operation_probed_during_shutdown_fails(self):
+        scheduler = PollScheduler(workers=1)
+        probing = threading.Event()
+
+        def probe():
+            probing.set()
+            time.sleep(0.2)
+            return 'running'
+
+        operation = scheduler.submit('slow', probe, lambda state: False)
+        probing.wait(1)
+        scheduler.shutdown()
+        self.assertRaises(SchedulerShutdown, operation.result, 1)
+
+    def test_cancelled_callback(self):
+        scheduler = PollScheduler(workers=1)
+        errors = []
+        scheduler.call_later(60, lambda: None, on_shutdown=errors.append)
+        scheduler.shutdown()
+        self.assertEqual([type(error) for error in errors], [SchedulerShutdown])
+
+    def test_submit_after_shutdown(self):
+        scheduler = PollScheduler(workers=1)
+        scheduler.shutdown()
+        self.assertRaises(SchedulerShutdown, scheduler.submit, 'late', lambda: None, lambda state: True)
+
+
+if __name__ == '__main__':
+    unittest.main()
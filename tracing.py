@@ -0,0 +1,404 @@
+"""
+Tracing of the requests made through the shared sessions, and of the phases of the workflows that make them.
+
+Every session created by client.new_session() records its requests in the shared Tracer: the latency, the bytes sent
+and received, and the retries (urllib3 retries of idempotent requests, and re-sends after a re-login) of each request,
+keyed by method and endpoint. Endpoints are the path of the url with the identifiers replaced by placeholders, so
+'/devmgr/v2/storage-systems/{id}/drives' covers the drives of every system.
+
+Workflows mark their phases, and the requests and poll iterations made during a phase are attributed to it:
+
+    with get_tracer().phase('health', subject=address):
+        health_check(session, api['health_check'])
+
+A phase is tracked per thread. Operations polled by a PollScheduler keep the phase they were submitted from, so the
+probes made on its workers are attributed to the phase that is waiting on them. When a phase takes longer than its
+threshold (see SLOW_PHASES) the slow-phase hook is called with the span of that phase, by default it logs a warning
+that breaks the time down into requests and polling.
+
+Latencies are kept in log-scaled histograms, so percentiles can be reported without keeping every sample. The
+measurements can be exported as JSON or in the Prometheus text format:
+
+    get_tracer().export('rollout.prom')
+"""
+import json
+import logging
+import math
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+LOG = logging.getLogger(__name__)
+
+# The histogram buckets grow by 2^(1/4) from 1ms, so an estimated percentile is within 10% of the true value
+BUCKET_START = 0.001
+BUCKET_GROWTH = 2 ** 0.25
+BUCKET_COUNT = 96
+
+PERCENTILES = (0.5, 0.95, 0.99)
+
+# The number of seconds after which a phase is considered slow
+SLOW_PHASES = {'health': 300,
+               'upload': 600,
+               'stage': 600,
+               'compatibility': 60,
+               'initiate': 60,
+               'activate': 60,
+               'wait': 3600}
+
+# The slowest spans are kept for the report
+MAX_SLOW_SPANS = 100
+
+# (path pattern, replacement) turning a request path into its endpoint
+ENDPOINT_RULES = [(re.compile(r'/storage-systems/[^/]+'), '/storage-systems/{id}'),
+                  (re.compile(r'/(volumes|storage-pools)/[^/]+'), r'/\1/{id}'),
+                  (re.compile(r'/jobs/[^/]+'), '/jobs/{id}'),
+                  (re.compile(r'/files/drive/[^/]+'), '/files/drive/{filename}')]
+
+
+def endpoint_of(url):
+    """Get the endpoint of a url, its API path with the identifiers replaced by placeholders"""
+    path = urlparse(url).path
+    # Anything in front of the API (a reverse proxy prefix) isn't part of the endpoint
+    start = path.find('/devmgr/')
+    if start > 0:
+        path = path[start:]
+    for pattern, replacement in ENDPOINT_RULES:
+        path = pattern.sub(replacement, path)
+    return path
+
+
+def request_size(request):
+    """Get the number of bytes in the body of a prepared request"""
+    length = request.headers.get('Content-Length')
+    if length is not None:
+        return int(length)
+    if isinstance(request.body, (bytes, type(u''))):
+        return len(request.body)
+    return 0
+
+
+def response_size(response, stream=False):
+    """Get the number of bytes in the body of a response, without reading a streamed body"""
+    if not stream:
+        return len(response.content or b'')
+    return int(response.headers.get('Content-Length') or 0)
+
+
+def retry_count(response):
+    """Get the number of times a request was sent again before this response: by urllib3, and after a re-login"""
+    retries = getattr(response.raw, 'retries', None)
+    return len(response.history) + (len(retries.history) if retries is not None else 0)
+
+
+class Histogram(object):
+    """Counts of observations in log-scaled buckets"""
+
+    def __init__(self):
+        self.buckets = [0] * (BUCKET_COUNT + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, value):
+        if value <= BUCKET_START:
+            index = 0
+        else:
+            index = min(BUCKET_COUNT, int(math.log(value / BUCKET_START, BUCKET_GROWTH)) + 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def percentile(self, fraction):
+        """Estimate a percentile, from the geometric middle of the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                break
+        if index == 0:
+            estimate = BUCKET_START
+        else:
+            estimate = BUCKET_START * BUCKET_GROWTH ** (index - 0.5)
+        return min(self.maximum, max(self.minimum, estimate))
+
+    def summary(self):
+        summary = {'count': self.count,
+                   'sum': self.total,
+                   'mean': self.total / self.count if self.count else 0.0,
+                   'min': self.minimum or 0.0,
+                   'max': self.maximum or 0.0}
+        for fraction in PERCENTILES:
+            summary['p{}'.format(int(fraction * 100))] = self.percentile(fraction)
+        return summary
+
+
+class Span(object):
+    """One execution of a phase"""
+
+    def __init__(self, name, subject=None, parent=None):
+        self.name = name
+        self.subject = subject
+        self.parent = parent
+        self.started = time.time()
+        self.finished = None
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.polls = 0
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def describe(self):
+        return {'phase': self.name, 'subject': self.subject, 'started': self.started, 'duration': self.duration,
+                'requests': self.requests, 'request_seconds': self.request_seconds, 'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received, 'retries': self.retries, 'polls': self.polls}
+
+
+def log_slow_phase(span, threshold):
+    """The default slow-phase hook"""
+    LOG.warning("The %s phase%s took %.1fs, over its threshold of %ss: %s requests (%.1fs waiting on responses, "
+                "%s retried), %s poll iterations.", span.name, ' of {}'.format(span.subject) if span.subject else '',
+                span.duration, threshold, span.requests, span.request_seconds, span.retries, span.polls)
+
+
+class Tracer(object):
+    """Collects request metrics by endpoint and phase"""
+
+    def __init__(self, slow_phases=None, on_slow_phase=log_slow_phase):
+        """
+        :param slow_phases: the number of seconds after which each phase is slow, SLOW_PHASES by default
+        :param on_slow_phase: a callable that is given the Span and the threshold of every slow phase, or None
+        """
+        self.slow_phases = dict(SLOW_PHASES if slow_phases is None else slow_phases)
+        self.on_slow_phase = on_slow_phase
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Forget every measurement"""
+        with self._lock:
+            self.started = time.time()
+            self._endpoints = {}
+            self._phases = {}
+            self._slow_spans = []
+
+    def current(self):
+        """Get the span of the innermost phase of the calling thread, or None"""
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def attach(self, span):
+        """Attribute the work done by the calling thread to a span started elsewhere
+        :param span: the span, or None to leave the phase of the thread unchanged
+        """
+        if span is None:
+            yield span
+            return
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+
+    @contextmanager
+    def phase(self, name, subject=None):
+        """Attribute the requests and polls made within the block to a phase
+        :param name: the phase, e.g. 'health', 'upload', 'initiate' or 'wait'
+        :param subject: an optional description of what the phase is working on, for the slow-phase hook
+        """
+        span = Span(name, subject=subject, parent=self.current())
+        with self.attach(span):
+            try:
+                yield span
+            finally:
+                span.finished = time.time()
+                self._finish(span)
+
+    def _phase_stats(self, name):
+        stats = self._phases.get(name)
+        if stats is None:
+            stats = self._phases[name] = {'durations': Histogram(), 'slow': 0, 'requests': 0,
+                                          'request_seconds': 0.0, 'polls': 0}
+        return stats
+
+    def _finish(self, span):
+        threshold = self.slow_phases.get(span.name)
+        slow = threshold is not None and span.duration > threshold
+        with self._lock:
+            stats = self._phase_stats(span.name)
+            stats['durations'].observe(span.duration)
+            if slow:
+                stats['slow'] += 1
+                self._slow_spans.append(span.describe())
+                self._slow_spans.sort(key=lambda described: -described['duration'])
+                del self._slow_spans[MAX_SLOW_SPANS:]
+        if slow and self.on_slow_phase is not None:
+            try:
+                self.on_slow_phase(span, threshold)
+            except Exception:
+                LOG.exception("The slow-phase hook failed.")
+
+    def record_request(self, method, url, status, seconds, sent=0, received=0, retries=0, cached=False):
+        """Record a request made in the current phase
+        :param method: the HTTP method
+        :param url: the url requested
+        :param status: the status code of the response, or None if no response was received
+        :param seconds: the time until the response (its headers, for a streamed response) was received
+        :param sent: the size of the request body in bytes
+        :param received: the size of the response body in bytes
+        :param retries: the number of times the request was sent again
+        :param cached: whether the response was answered from the response cache
+        """
+        span = self.current()
+        key = (span.name if span is not None else None, method, endpoint_of(url))
+        with self._lock:
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = {'latency': Histogram(), 'errors': 0, 'bytes_sent': 0,
+                                                'bytes_received': 0, 'retries': 0, 'cached': 0, 'statuses': {}}
+            stats['latency'].observe(seconds)
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+            stats['retries'] += retries
+            stats['cached'] += 1 if cached else 0
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            if status is None or status >= 400:
+                stats['errors'] += 1
+            if span is not None:
+                span.requests += 1
+                span.request_seconds += seconds
+                span.bytes_sent += sent
+                span.bytes_received += received
+                span.retries += retries
+                phase = self._phase_stats(span.name)
+                phase['requests'] += 1
+                phase['request_seconds'] += seconds
+
+    def record_poll(self, span=None):
+        """Record an iteration of a poll loop
+        :param span: the span the poll is made for, the current one by default
+        """
+        span = span or self.current()
+        with self._lock:
+            if span is not None:
+                span.polls += 1
+            self._phase_stats(span.name if span is not None else None)['polls'] += 1
+
+    def summary(self):
+        """Describe every measurement made since the tracer was created or reset
+        :return: a dict of the requests by endpoint, the phases, and the slowest of the slow spans
+        """
+        with self._lock:
+            endpoints = []
+            for (phase, method, endpoint), stats in sorted(self._endpoints.items(), key=lambda item: str(item[0])):
+                described = dict((key, value) for key, value in stats.items() if key not in ('latency', 'statuses'))
+                statuses = dict((str(status), count) for status, count in stats['statuses'].items())
+                described.update({'phase': phase, 'method': method, 'endpoint': endpoint,
+                                  'latency': stats['latency'].summary(), 'statuses': statuses})
+                endpoints.append(described)
+            phases = {}
+            for name, stats in self._phases.items():
+                described = dict((key, value) for key, value in stats.items() if key != 'durations')
+                described['durations'] = stats['durations'].summary()
+                phases[name or 'none'] = described
+            return {'elapsed': time.time() - self.started,
+                    'endpoints': endpoints,
+                    'phases': phases,
+                    'slow_spans': list(self._slow_spans)}
+
+    def to_json(self, indent=2):
+        return json.dumps(self.summary(), indent=indent, sort_keys=True)
+
+    def prometheus(self, prefix='santricity'):
+        """Render the measurements in the Prometheus text exposition format, latencies as summaries"""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, val in labels)
+                lines.append('{}_{}{}{{{}}} {}'.format(prefix, name, suffix, label_text, repr(float(value))))
+
+        def endpoint_labels(stats):
+            return [('phase', stats['phase'] or 'none'), ('method', stats['method']), ('endpoint', stats['endpoint'])]
+
+        def quantiles(labels, latency):
+            samples = [('', labels + [('quantile', fraction)], latency['p{}'.format(int(fraction * 100))])
+                       for fraction in PERCENTILES]
+            return samples + [('_sum', labels, latency['sum']), ('_count', labels, latency['count'])]
+
+        endpoints = summary['endpoints']
+        metric('request_seconds', 'summary', 'The latency of the API requests.',
+               [sample for stats in endpoints for sample in quantiles(endpoint_labels(stats), stats['latency'])])
+        for name, help_text in (('errors', 'The requests that failed or returned an error status.'),
+                                ('bytes_sent', 'The bytes sent in request bodies.'),
+                                ('bytes_received', 'The bytes received in response bodies.'),
+                                ('retries', 'The times a request was sent again.'),
+                                ('cached', 'The requests answered from the response cache.')):
+            metric('request_{}_total'.format(name), 'counter', help_text,
+                   [('', endpoint_labels(stats), stats[name]) for stats in endpoints])
+
+        phases = sorted(summary['phases'].items())
+        metric('phase_seconds', 'summary', 'The duration of the workflow phases.',
+               [sample for name, stats in phases for sample in quantiles([('phase', name)], stats['durations'])])
+        metric('phase_polls_total', 'counter', 'The poll iterations made during the workflow phases.',
+               [('', [('phase', name)], stats['polls']) for name, stats in phases])
+        metric('phase_slow_total', 'counter', 'The phases that took longer than their threshold.',
+               [('', [('phase', name)], stats['slow']) for name, stats in phases])
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """Write the measurements to a file, in the Prometheus text format if it ends in .prom and as JSON otherwise"""
+        with open(path, 'w') as fp:
+            fp.write(self.prometheus() if path.endswith('.prom') else self.to_json())
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    """Get the Tracer shared by every session"""
+    return _tracer
+
+
+def phase(name, subject=None):
+    """Attribute the requests and polls made within the block to a phase of the shared Tracer, see Tracer.phase()"""
+    return _tracer.phase(name, subject=subject)
+
+
+@contextmanager
+def timed_phase(result, name):
+    """Run a phase of the shared Tracer for the system a result describes, and record how long it took in the result
+    :param result: a result dictionary with the 'name' of the system and a dict of the seconds taken by its 'phases'
+    :param name: the name of the phase
+    """
+    LOG.info("%s: %s...", result['name'], name)
+    start = time.time()
+    try:
+        with _tracer.phase(name, subject=result['name']):
+            yield
+    finally:
+        result['phases'][name] = time.time() - start